@@ -24,5 +24,7 @@ SELECT
 SAFE_CAST(DATETIME(TIMESTAMP(timestamp_captura), "America/Sao_Paulo") AS DATETIME) timestamp_captura,
 SAFE_CAST(sucesso AS BOOLEAN) sucesso,
 SAFE_CAST(erro AS STRING) erro,
+SAFE_CAST(n_registros AS INT64) n_registros,
+SAFE_CAST(tempo_resposta AS FLOAT64) tempo_resposta,
 SAFE_CAST(data AS DATE) data
 from rj-smtr-staging.br_rj_riodejaneiro_brt_gps_staging.registros_logs as t
\ No newline at end of file
@@ -0,0 +1,28 @@
+/*
+
+Query para publicar a tabela.
+
+Esse é o lugar para:
+    - modificar nomes, ordem e tipos de colunas
+    - dar join com outras tabelas
+    - criar colunas extras (e.g. logs, proporções, etc.)
+
+Qualquer coluna definida aqui deve também existir em `table_config.yaml`.
+
+# Além disso, sinta-se à vontade para alterar alguns nomes obscuros
+# para algo um pouco mais explícito.
+
+TIPOS:
+    - Para modificar tipos de colunas, basta substituir STRING por outro tipo válido.
+    - Exemplo: `SAFE_CAST(column_name AS NUMERIC) column_name`
+    - Mais detalhes: https://cloud.google.com/bigquery/docs/reference/standard-sql/data-types
+
+*/
+
+CREATE VIEW rj-smtr.br_rj_riodejaneiro_sigmob.versoes AS
+SELECT 
+SAFE_CAST(endpoint AS STRING) endpoint,
+SAFE_CAST(data_versao_origem AS STRING) data_versao_origem,
+SAFE_CAST(fingerprint AS STRING) fingerprint,
+SAFE_CAST(data_versao AS STRING) data_versao
+from rj-smtr-staging.br_rj_riodejaneiro_sigmob_staging.versoes as t
\ No newline at end of file
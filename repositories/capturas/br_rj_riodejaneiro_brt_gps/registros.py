@@ -1,8 +1,5 @@
 import traceback
-from datetime import timedelta
 
-import requests
-import pendulum
 import pandas as pd
 from dagster import (
     solid,
@@ -17,11 +14,14 @@ from repositories.capturas.resources import (
     mapping,
     timezone_config,
     discord_webhook,
+    http_client,
+    gps_dedup,
+    capture_log_sink,
 )
 from repositories.helpers.constants import constants
-from repositories.helpers.datetime import convert_unix_time_to_datetime
-from repositories.helpers.helpers import safe_cast, map_dict_keys
+from repositories.helpers.gps import normalize_gps, rename_fields, to_json_column
 from repositories.libraries.basedosdados.resources import basedosdados_config
+from repositories.helpers.metrics import get_metrics
 from repositories.helpers.hooks import (
     discord_message_on_failure,
     discord_message_on_success,
@@ -33,6 +33,7 @@ from repositories.capturas.solids import (
     create_current_datetime_partition,
     get_file_path_and_partitions,
     get_raw,
+    mark_gps_ingested,
     save_raw_local,
     save_treated_local,
     upload_logs_to_bq,
@@ -40,50 +41,49 @@ from repositories.capturas.solids import (
 from repositories.libraries.basedosdados.solids import bq_upload, upload_to_bigquery
 
 
+# Numeric columns of the flattened feed, the others are kept as strings
+NUMERIC_COLUMNS = ["latitude", "longitude", "velocidade"]
 
-@solid(
-    required_resource_keys={"basedosdados_config", "timezone_config", 'mapping'},
-    output_defs=[
-        OutputDefinition(name="treated_data", is_required=True),
-        OutputDefinition(name="error", is_required=False)],
-)
-def pre_treatment_br_rj_riodejaneiro_brt_gps(context, data, timestamp, key_column, prev_error):
-
-    columns = [key_column,"timestamp_gps", "timestamp_captura", "content"]
 
-    context.log.info(f"Previous error is {prev_error}")
+def fn_pre_treatment_br_rj_riodejaneiro_brt_gps(
+    context, data, timestamp, key_column, flatten=False
+):
+    """Treats the BRT feed. Mapped fields are stored as JSON in `content`, or
+    as typed columns of their own if `flatten`."""
 
-    if prev_error is not None:
-        yield Output(pd.DataFrame(), output_name="treated_data")
-        yield Output(prev_error, output_name="error")
-        return
+    mapping = context.resources.mapping["map"]
+    if flatten:
+        columns = list(mapping.values()) + ["timestamp_captura"]
+    else:
+        columns = [key_column, "timestamp_gps", "timestamp_captura", "content"]
 
     error = None
     timezone = context.resources.timezone_config["timezone"]
 
-    data = data.json()
-    df = pd.DataFrame(columns=columns)
-    timestamp_captura = pd.to_datetime(timestamp).tz_convert(timezone)
-    context.log.info(f"Timestamp captura is {timestamp_captura}")
-    # map_dict_keys change data keys to match project data structure
-    df["content"] = [map_dict_keys(piece, context.resources.mapping['map']) for piece in data]
-    df[key_column] = [piece[key_column] for piece in data]
-    df["timestamp_captura"] = timestamp_captura
-    df["timestamp_gps"] = df["content"].apply(
-    lambda x: pd.to_datetime(pendulum.from_timestamp(safe_cast(x["timestamp_gps"], int, 0)).replace(tzinfo=None).set(tz="UTC").isoformat()).tz_convert(timezone)
-)
-    context.log.info(f"Timestamp GPS is {df['timestamp_gps']}")
-    # Filter data for 0 <= time diff <= 1min
+    # Fields are renamed to match project data structure
+    df = rename_fields(data.json(), mapping)
+    if flatten:
+        for column in NUMERIC_COLUMNS:
+            if column in df.columns:
+                df[column] = pd.to_numeric(df[column], errors="coerce")
+    else:
+        df["content"] = to_json_column(df)
+
+    # Convert timestamp_gps (epoch in s) to config timezone and
+    # filter data for 0 <= time diff <= 1min
     try:
         context.log.info(f"Shape antes da filtragem: {df.shape}")
-        mask = (df["timestamp_captura"] - df["timestamp_gps"]).apply(
-            lambda x: timedelta(seconds=0) <= x <= timedelta(minutes=1)
-        )
-        df = df[mask]
+        df = normalize_gps(df, "timestamp_gps", timestamp, timezone, unit="s", fill_value=0)
+        context.log.info(f"Timestamp captura is {df['timestamp_captura']}")
+        context.log.info(f"Timestamp GPS is {df['timestamp_gps']}")
         if df.shape[0] == 0:
             raise ValueError("After filtering, the dataframe is empty!")
         else:
             df = df[columns]
+            df, n_duplicates = context.resources.gps_dedup.drop_ingested(
+                df, context.resources.basedosdados_config["dataset_id"]
+            )
+            context.log.info(f"Dropped {n_duplicates} records already captured")
     except Exception as e:
         err = traceback.format_exc()
         log_critical(f"Failed to filter BRT data: \n{err}")
@@ -91,6 +91,34 @@ def pre_treatment_br_rj_riodejaneiro_brt_gps(context, data, timestamp, key_colum
         error = e
     context.log.info(f"Shape depois da filtragem: {df.shape}")
     context.log.info(f"Error now is {error}")
+    return df, error
+
+
+@solid(
+    required_resource_keys={"basedosdados_config", "timezone_config", 'mapping', "gps_dedup"},
+    output_defs=[
+        OutputDefinition(name="treated_data", is_required=True),
+        OutputDefinition(name="error", is_required=False)],
+)
+def pre_treatment_br_rj_riodejaneiro_brt_gps(
+    context, data, timestamp, key_column, prev_error, flatten=False
+):
+
+    context.log.info(f"Previous error is {prev_error}")
+
+    if prev_error is not None:
+        yield Output(pd.DataFrame(), output_name="treated_data")
+        yield Output(prev_error, output_name="error")
+        return
+
+    config = context.resources.basedosdados_config
+    with get_metrics().stage(
+        config["dataset_id"], config["table_id"], "treatment"
+    ) as measure:
+        df, error = fn_pre_treatment_br_rj_riodejaneiro_brt_gps(
+            context, data, timestamp, key_column, flatten=flatten)
+        measure["rows"] = df.shape[0]
+        measure["success"] = int(error is None)
     yield Output(df, output_name="treated_data")
     yield Output(error, output_name="error")
 
@@ -108,7 +136,10 @@ def pre_treatment_br_rj_riodejaneiro_brt_gps(context, data, timestamp, key_colum
                 "timezone_config": timezone_config,
                 "discord_webhook": discord_webhook,
                 "keepalive_key": keepalive_key,
-                "mapping": mapping
+                "mapping": mapping,
+                "http_client": http_client,
+                "gps_dedup": gps_dedup,
+                "capture_log_sink": capture_log_sink,
             },
         ),
     ],
@@ -136,8 +167,15 @@ def br_rj_riodejaneiro_brt_gps_registros():
     treated_data, error = pre_treatment_br_rj_riodejaneiro_brt_gps(
         data, timestamp, prev_error=error)
 
-    upload_logs_to_bq(timestamp, error)
+    upload_logs_to_bq(timestamp, error, data=data, treated_data=treated_data)
 
     treated_file_path = save_treated_local(treated_data, file_path)
 
-    bq_upload(treated_file_path, raw_filepath=raw_file_path, partitions=partitions)
+    uploaded = bq_upload(
+        treated_file_path,
+        raw_filepath=raw_file_path,
+        partitions=partitions,
+        treated_data=treated_data,
+    )
+
+    mark_gps_ingested(treated_data, uploaded)
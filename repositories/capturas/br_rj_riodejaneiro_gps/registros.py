@@ -0,0 +1,53 @@
+from pathlib import Path
+
+from dagster import solid, pipeline, ModeDefinition, PresetDefinition
+
+from repositories.capturas.gps_worker import GPSFeed, capture_feeds
+
+
+@solid(
+    config_schema={"feeds": [str]},
+)
+def capture_gps_feeds(context):
+    """Captures every feed concurrently, with the config of its own
+    `registros.yaml`. Each feed uploads its data and logs independently."""
+
+    feeds = [
+        GPSFeed(Path(__file__).parent.parent / path, log=context.log)
+        for path in context.solid_config["feeds"]
+    ]
+    errors = capture_feeds(feeds)
+
+    # Feeds live only for this run, so what failed to upload is not flushed
+    # again. The run fails, after every feed had the chance to upload its
+    # data, and the local files are removed
+    for feed in feeds:
+        if feed.dataset_id in errors:
+            feed.discard()
+    if errors:
+        raise Exception(f"Failed to capture feeds: {list(errors.keys())}")
+
+
+@pipeline(
+    mode_defs=[ModeDefinition("dev")],
+    preset_defs=[
+        PresetDefinition.from_files(
+            "registros",
+            config_files=[str(Path(__file__).parent / "registros.yaml")],
+            mode="dev",
+        ),
+    ],
+    tags={
+        "pipeline": "br_rj_riodejaneiro_gps_registros",
+        "dagster-k8s/config": {
+            "container_config": {
+                "resources": {
+                    "requests": {"cpu": "500m", "memory": "500Mi"},
+                    "limits": {"cpu": "1000m", "memory": "1Gi"},
+                },
+            }
+        },
+    },
+)
+def br_rj_riodejaneiro_gps_registros():
+    capture_gps_feeds()
@@ -0,0 +1,254 @@
+"""
+Replay of archived GPS captures.
+
+Raw payloads saved under `raw/<dataset_id>/<table_id>/data=.../hora=...` are
+downloaded and treated again with the same pre-treatment functions used on
+capture, and the records of each hour are written as a single staging file,
+replacing the per-minute files of the hour. Hours are processed in parallel,
+each in a process of its own.
+"""
+import os
+import traceback
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pendulum
+import pandas as pd
+from dagster import solid, pipeline, ModeDefinition, PresetDefinition, Field
+
+from repositories.helpers.helpers import read_config
+from repositories.helpers.hooks import disable_critical_alerts
+from repositories.helpers.logging import logger
+from repositories.helpers.payload import RawPayload
+from repositories.helpers.serialization import decompress_raw
+from repositories.helpers.storage import StoragePlus
+from repositories.capturas.solids import save_local_as_bd
+from repositories.capturas.gps_worker import TREATMENTS, build_context, get_solid_inputs
+
+# Raw files are named after the capture time, e.g. 2021-06-01-10-15-00.json.gz
+RAW_FILENAME_FORMAT = "YYYY-MM-DD-HH-mm-ss"
+
+
+def list_raw_blobs(dataset_id: str, table_id: str, start, end) -> dict:
+    """
+    Lists the raw blobs of the hours from `start` to `end`, inclusive.
+    :param dataset_id: Dataset of the feed.
+    :param table_id: Table of the feed.
+    :param start: First hour, as a pendulum datetime.
+    :param end: Last hour, as a pendulum datetime.
+    :return: The blob names of each hour, keyed by partition (data=.../hora=...).
+    """
+    st = StoragePlus(dataset_id=dataset_id, table_id=table_id)
+    partitions = {}
+    hour = start
+    while hour <= end:
+        partitions[hour.strftime("data=%Y-%m-%d/hora=%H")] = []
+        hour = hour.add(hours=1)
+    # One listing per day instead of one per hour
+    for day in sorted({partition.split("/")[0] for partition in partitions}):
+        for blob in st.bucket.list_blobs(prefix=f"raw/{dataset_id}/{table_id}/{day}/"):
+            partition = "/".join(blob.name.split("/")[3:5])
+            if partition in partitions:
+                partitions[partition].append(blob.name)
+    return {partition: sorted(blobs) for partition, blobs in partitions.items() if blobs}
+
+
+def _stem(blob_name: str) -> str:
+    """File name of a blob without its extensions, e.g. 2021-06-01-10-15-00"""
+    return Path(blob_name).name.split(".")[0]
+
+
+def _capture_timestamp(blob_name: str, timezone: str) -> str:
+    """Capture timestamp of a raw blob, from its file name. The name is set
+    right before the request, so it may be a second earlier than the original."""
+    return pendulum.from_format(
+        _stem(blob_name), RAW_FILENAME_FORMAT, tz=timezone
+    ).isoformat()
+
+
+def replay_hour(config_path: str, partition: str, blob_names: list, upload: bool = True) -> dict:
+    """
+    Treats the raw blobs of one hour and saves them as a single staging file.
+    Runs in a worker process, so it builds its own context and clients.
+    :param config_path: The feed `registros.yaml`.
+    :param partition: The hour partition, e.g. data=2021-06-01/hora=10.
+    :param blob_names: The raw blobs of the hour.
+    :param upload: Whether to replace the staging files of the hour in GCS.
+        Hours with errors are never replaced, so no data is lost.
+    :return: A summary of the hour: files, rows, errors and whether it was replaced.
+    """
+    # Failures of past captures were already alerted when they happened
+    disable_critical_alerts()
+    config = read_config(config_path)
+    # Pings repeated across minutes are dropped within the process only, so
+    # the index used by live captures is left untouched
+    if "gps_dedup" in config.get("resources", {}):
+        config["resources"]["gps_dedup"]["config"]["backend"] = "local"
+    context = build_context(config)
+    bd_config = context.resources.basedosdados_config
+    dataset_id, table_id = bd_config["dataset_id"], bd_config["table_id"]
+    timezone = context.resources.timezone_config["timezone"]
+    solid_name, treatment = TREATMENTS[dataset_id]
+    treatment_kwargs = get_solid_inputs(config, solid_name)
+
+    st = StoragePlus(dataset_id=dataset_id, table_id=table_id)
+    frames, errors = [], 0
+    for blob_name in blob_names:
+        try:
+            # Stored bytes are fetched as is, compressed or not
+            content = st.bucket.blob(blob_name).download_as_bytes(raw_download=True)
+            data = RawPayload(content=decompress_raw(content))
+            df, error = treatment(
+                context, data, _capture_timestamp(blob_name, timezone), **treatment_kwargs
+            )
+            if error is not None:
+                errors += 1
+            if not df.empty:
+                frames.append(df)
+        except Exception:
+            errors += 1
+            logger.warning(f"Failed to replay {blob_name}: \n{traceback.format_exc()}")
+
+    summary = {
+        "partition": partition,
+        "files": len(blob_names),
+        "rows": 0,
+        "errors": errors,
+        "replaced": False,
+    }
+    if not frames or (upload and errors):
+        return summary
+    df = pd.concat(frames, ignore_index=True)
+    summary["rows"] = df.shape[0]
+
+    file_format = bd_config.get("file_format", "csv")
+    file_path = save_local_as_bd(
+        df,
+        os.getenv("DATA_FOLDER", "data"),
+        # Not a capture time, so it never overwrites a per-minute file
+        partition.replace("data=", "").replace("/hora=", "-") + "-replay",
+        dataset_id,
+        table_id,
+        "staging",
+        file_format,
+        partitions=partition,
+        compression=bd_config.get("compression"),
+        schema=bd_config.get("schema"),
+    )
+    if upload:
+        # The consolidated file replaces the per-minute files of the replayed
+        # captures, which are deleted only once it is uploaded. Staging files
+        # of minutes without a raw capture hold the only copy of their data.
+        prefix = f"staging/{dataset_id}/{table_id}/{partition}/"
+        replayed = {_stem(blob_name) for blob_name in blob_names}
+        st.upload(path=file_path, partitions=partition, mode="staging", if_exists="replace")
+        kept = []
+        for blob in st.bucket.list_blobs(prefix=prefix):
+            if blob.name == prefix + Path(file_path).name:
+                continue
+            if _stem(blob.name) in replayed:
+                blob.delete()
+            else:
+                kept.append(blob.name)
+        if kept:
+            logger.warning(
+                f"Kept {len(kept)} staging files of {partition} without raw captures: {kept}"
+            )
+        Path(file_path).unlink(missing_ok=True)
+        summary["replaced"] = True
+        summary["kept"] = len(kept)
+    return summary
+
+
+@solid(
+    config_schema={
+        "feed": Field(str, description="Feed config, relative to repositories/capturas"),
+        "start": Field(str, description="First hour to replay, e.g. 2021-06-01 00"),
+        "end": Field(str, description="Last hour to replay, e.g. 2021-06-30 23"),
+        "max_workers": Field(
+            int, is_required=False, description="Worker processes. Default is the CPU count"
+        ),
+        "upload": Field(
+            bool,
+            is_required=False,
+            default_value=True,
+            description="Replace the staging files in GCS. If false, files are kept locally",
+        ),
+    },
+)
+def replay_gps_feed(context):
+    """Replays the raw captures of a GPS feed in a range of hours"""
+    config_path = str(Path(__file__).parent.parent / context.solid_config["feed"])
+    config = read_config(config_path)
+    bd_config = config["resources"]["basedosdados_config"]["config"]
+    timezone = config["resources"]["timezone_config"]["config"]["timezone"]
+    start = pendulum.from_format(context.solid_config["start"], "YYYY-MM-DD HH", tz=timezone)
+    end = pendulum.from_format(context.solid_config["end"], "YYYY-MM-DD HH", tz=timezone)
+
+    hours = list_raw_blobs(bd_config["dataset_id"], bd_config["table_id"], start, end)
+    context.log.info(
+        f"Replaying {sum(len(blobs) for blobs in hours.values())} captures "
+        f"in {len(hours)} hours of {bd_config['dataset_id']}"
+    )
+
+    failed, skipped = [], []
+    # Spawned processes do not inherit the parent's clients and connections
+    with ProcessPoolExecutor(
+        max_workers=context.solid_config.get("max_workers") or os.cpu_count(),
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as executor:
+        futures = {
+            executor.submit(
+                replay_hour, config_path, partition, blobs, context.solid_config["upload"]
+            ): partition
+            for partition, blobs in hours.items()
+        }
+        for future in as_completed(futures):
+            try:
+                summary = future.result()
+            except Exception:
+                failed.append(futures[future])
+                context.log.error(
+                    f"Failed to replay {futures[future]}: \n{traceback.format_exc()}"
+                )
+                continue
+            context.log.info(
+                f"Replayed {summary['partition']}: {summary['rows']} rows "
+                f"from {summary['files']} captures, {summary['errors']} with errors"
+                + (f", kept {summary['kept']} staging files" if summary.get("kept") else "")
+            )
+            if context.solid_config["upload"] and summary["errors"]:
+                skipped.append(summary["partition"])
+
+    if skipped:
+        context.log.warning(
+            f"Kept the staging files of {len(skipped)} hours with errors: {sorted(skipped)}"
+        )
+    if failed:
+        raise Exception(f"Failed to replay {len(failed)} hours: {sorted(failed)}")
+
+
+@pipeline(
+    mode_defs=[ModeDefinition("dev")],
+    preset_defs=[
+        PresetDefinition.from_files(
+            "replay",
+            config_files=[str(Path(__file__).parent / "replay.yaml")],
+            mode="dev",
+        ),
+    ],
+    tags={
+        "pipeline": "br_rj_riodejaneiro_gps_replay",
+        "dagster-k8s/config": {
+            "container_config": {
+                "resources": {
+                    "requests": {"cpu": "2000m", "memory": "2Gi"},
+                    "limits": {"cpu": "4000m", "memory": "4Gi"},
+                },
+            }
+        },
+    },
+)
+def br_rj_riodejaneiro_gps_replay():
+    replay_gps_feed()
@@ -1,4 +1,3 @@
-import requests
 import json
 import time
 from pathlib import Path
@@ -22,6 +21,7 @@ from repositories.capturas.resources import (
     keepalive_key,
     timezone_config,
     discord_webhook,
+    http_client,
 )
 from repositories.libraries.basedosdados.resources import basedosdados_config
 from repositories.helpers.hooks import (
@@ -37,7 +37,7 @@ from repositories.libraries.basedosdados.solids import upload_to_bigquery_v2
 
 
 @solid(
-    required_resource_keys={"basedosdados_config"},
+    required_resource_keys={"basedosdados_config", "http_client"},
     output_defs=[
         OutputDefinition(name="raw_file_path"),
         OutputDefinition(name="file_name"),
@@ -142,14 +142,15 @@ def download_brt_raw_realized_trips(context, post_url, data_url):
         "postman-token": "d7202971-3172-4efa-6679-6154f6886655",
     }
 
-    response = requests.request(
-        "POST", post_url, data=json.dumps(payload), headers=headers,
+    http_client = context.resources.http_client
+    response = http_client.post(
+        post_url, data=json.dumps(payload), headers=headers,
     ).json()
 
     time.sleep(5)
 
     data_url = f'{data_url}_{response["id"]}.csv'
-    data = requests.get(data_url).text
+    data = http_client.get(data_url).text
 
     file_name = date.strftime("%Y-%m-%d.csv")
     raw_file_path = save_local_as_bd(
@@ -197,6 +198,7 @@ def treat_raw_realized_trips(context, raw_file_path, file_name):
                 "timezone_config": timezone_config,
                 "discord_webhook": discord_webhook,
                 "keepalive_key": keepalive_key,
+                "http_client": http_client,
             },
         ),
     ],
@@ -24,6 +24,7 @@ from repositories.capturas.resources import (
     keepalive_key,
     timezone_config,
     discord_webhook,
+    gcp_clients,
 )
 from repositories.libraries.basedosdados.resources import (
     basedosdados_config,
@@ -140,7 +141,8 @@ def get_realized_trips(file_path):
             "dev", resource_defs={"basedosdados_config": basedosdados_config,
                                   "timezone_config": timezone_config,
                                   "discord_webhook": discord_webhook,
-                                  "keepalive_key": keepalive_key}
+                                  "keepalive_key": keepalive_key,
+                                  "gcp_clients": gcp_clients}
         ),
     ],
     preset_defs=[
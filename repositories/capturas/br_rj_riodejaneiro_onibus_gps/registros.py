@@ -1,8 +1,6 @@
 import traceback
 from pathlib import Path
-from datetime import timedelta
 
-import pendulum
 import pandas as pd
 from dagster import (
     solid,
@@ -17,8 +15,13 @@ from repositories.capturas.resources import (
     keepalive_key,
     timezone_config,
     discord_webhook,
+    http_client,
+    gps_dedup,
+    capture_log_sink,
 )
 from repositories.libraries.basedosdados.resources import basedosdados_config
+from repositories.helpers.gps import normalize_gps
+from repositories.helpers.metrics import get_metrics
 from repositories.helpers.hooks import (
     discord_message_on_failure,
     discord_message_on_success,
@@ -30,6 +33,7 @@ from repositories.capturas.solids import (
     create_current_datetime_partition,
     get_file_path_and_partitions,
     get_raw,
+    mark_gps_ingested,
     save_raw_local,
     save_treated_local,
     upload_logs_to_bq,
@@ -37,8 +41,40 @@ from repositories.capturas.solids import (
 from repositories.libraries.basedosdados.solids import bq_upload, upload_to_bigquery
 
 
+def fn_pre_treatment_br_rj_riodejaneiro_onibus_gps(context, data, timestamp):
+
+    error = None
+    timezone = context.resources.timezone_config["timezone"]
+
+    data = data.json()
+    context.log.info(f"Received {len(data)} records")
+    df = pd.DataFrame(data)
+    context.log.info(f"Before converting, datahora is: \n{df['datahora']}")
+
+    # Convert datahora (epoch in ms) to config timezone and
+    # filter data for 0 <= time diff <= 1min
+    try:
+        df_treated = normalize_gps(df, "datahora", timestamp, timezone, unit="ms")
+        context.log.info(f"After converting the timezone, datahora is: \n{df['datahora']}")
+        context.log.info(f"Shape antes da filtragem: {df.shape}")
+        context.log.info(f"Shape após a filtragem: {df_treated.shape}")
+        if df_treated.shape[0] == 0:
+            error = ValueError("After filtering, the dataframe is empty!")
+            log_critical(f"Failed to filter SPPO data: \n{error}")
+        df = df_treated
+        df, n_duplicates = context.resources.gps_dedup.drop_ingested(
+            df, context.resources.basedosdados_config["dataset_id"]
+        )
+        context.log.info(f"Dropped {n_duplicates} records already captured")
+    except:
+        err = traceback.format_exc()
+        log_critical(f"Failed to filter SPPO data: \n{err}")
+
+    return df, error
+
+
 @solid(
-    required_resource_keys={"basedosdados_config", "timezone_config"},
+    required_resource_keys={"basedosdados_config", "timezone_config", "gps_dedup"},
     output_defs=[
         OutputDefinition(name="treated_data", is_required=True),
         OutputDefinition(name="error", is_required=False),
@@ -54,64 +90,15 @@ def pre_treatment_br_rj_riodejaneiro_onibus_gps(
         yield Output(prev_error, output_name="error")
 
     else:
-        error = None
-        timezone = context.resources.timezone_config["timezone"]
-
-        context.log.info(f"data={data.json()}")
-        data = data.json()
-        df = pd.DataFrame(data)
-        timestamp_captura = pd.to_datetime(timestamp)
-        df["timestamp_captura"] = timestamp_captura
-        context.log.info(f"Before converting, datahora is: \n{df['datahora']}")
-
-        # Remove timezone and force it to be config timezone
-        df["datahora"] = (
-            df["datahora"]
-            .astype(float)
-            .apply(
-                lambda ms: pd.to_datetime(
-                    pendulum.from_timestamp(ms / 1000.0)
-                    .replace(tzinfo=None)
-                    .set(tz="UTC")
-                    .isoformat()
-                )
-            )
-        )
-        context.log.info(f"After converting the timezone, datahora is: \n{df['datahora']}")
-
-        # Filter data for 0 <= time diff <= 1min
-        try:
-            datahora_col = "datahora"
-            df_treated = df
-            try:
-                df_treated[datahora_col] = df_treated[datahora_col].apply(
-                    lambda x: x.tz_convert(timezone)
-                )
-            except TypeError:
-                df_treated[datahora_col] = df_treated[datahora_col].apply(
-                    lambda x: x.tz_localize(timezone)
-                )
-            try:
-                df_treated["timestamp_captura"] = df_treated["timestamp_captura"].apply(
-                    lambda x: x.tz_convert(timezone)
-                )
-            except TypeError:
-                df_treated["timestamp_captura"] = df_treated["timestamp_captura"].apply(
-                    lambda x: x.tz_localize(timezone)
-                )
-            mask = (df_treated["timestamp_captura"] - df_treated[datahora_col]).apply(
-                lambda x: timedelta(seconds=0) <= x <= timedelta(minutes=1)
+        config = context.resources.basedosdados_config
+        with get_metrics().stage(
+            config["dataset_id"], config["table_id"], "treatment"
+        ) as measure:
+            df, error = fn_pre_treatment_br_rj_riodejaneiro_onibus_gps(
+                context, data, timestamp
             )
-            df_treated = df_treated[mask]
-            context.log.info(f"Shape antes da filtragem: {df.shape}")
-            context.log.info(f"Shape após a filtragem: {df_treated.shape}")
-            if df_treated.shape[0] == 0:
-                error = ValueError("After filtering, the dataframe is empty!")
-                log_critical(f"Failed to filter SPPO data: \n{error}")
-            df = df_treated
-        except:
-            err = traceback.format_exc()
-            log_critical(f"Failed to filter SPPO data: \n{err}")
+            measure["rows"] = df.shape[0]
+            measure["success"] = int(error is None)
 
         yield Output(df, output_name="treated_data")
         yield Output(error, output_name="error")
@@ -130,6 +117,9 @@ def pre_treatment_br_rj_riodejaneiro_onibus_gps(
                 "timezone_config": timezone_config,
                 "discord_webhook": discord_webhook,
                 "keepalive_key": keepalive_key,
+                "http_client": http_client,
+                "gps_dedup": gps_dedup,
+                "capture_log_sink": capture_log_sink,
             },
         ),
     ],
@@ -158,10 +148,15 @@ def br_rj_riodejaneiro_onibus_gps_registros():
         data, timestamp, prev_error=error
     )
 
-    upload_logs_to_bq(timestamp, error)
+    upload_logs_to_bq(timestamp, error, data=data, treated_data=treated_data)
 
     treated_file_path = save_treated_local(treated_data, file_path)
 
-    bq_upload(
-        raw_filepath=raw_file_path, filepath=treated_file_path, partitions=partitions
+    uploaded = bq_upload(
+        raw_filepath=raw_file_path,
+        filepath=treated_file_path,
+        partitions=partitions,
+        treated_data=treated_data,
     )
+
+    mark_gps_ingested(treated_data, uploaded)
@@ -1,23 +1,29 @@
 import os
 import re
 import uuid
+import tempfile
+import mimetypes
 from pathlib import Path
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 import jinja2
 import pendulum
 import pandas as pd
-import basedosdados as bd
 from dateutil import parser
-from dagster import solid, pipeline, ModeDefinition, PresetDefinition, RetryPolicy
+from dagster import solid, pipeline, ModeDefinition, PresetDefinition, RetryPolicy, Field
 from dagster.experimental import DynamicOutputDefinition, DynamicOutput
 
 from repositories.capturas.resources import (
     timezone_config,
     discord_webhook,
+    ftp_pool,
 )
 from repositories.libraries.basedosdados.resources import basedosdados_config
+from repositories.helpers.constants import constants
 from repositories.helpers.datetime import convert_datetime_to_unix_time
+from repositories.helpers.ftp_manifest import FTPManifest
 from repositories.helpers.helpers import read_config
 from repositories.helpers.hooks import (
     discord_message_on_failure,
@@ -25,7 +31,7 @@ from repositories.helpers.hooks import (
     redis_keepalive_on_failure,
     redis_keepalive_on_succes,
 )
-from repositories.helpers.io import connect_ftp
+from repositories.helpers.serialization import RollingFileWriter, save_dataframe
 from repositories.libraries.basedosdados.solids import (
     append_to_bigquery,
     create_table_bq,
@@ -33,19 +39,45 @@ from repositories.libraries.basedosdados.solids import (
 from repositories.helpers.storage import StoragePlus
 
 ALLOWED_FOLDERS = ["SPPO", "STPL"]
-FTPS_DIRECTORY = os.getenv("FTPS_DATA", "/opt/dagster/app/data/FTPS_DATA")
+MANIFEST_NAME = "br_rj_riodejaneiro_rdo"
 
 #
 # Previous solids, now functions
 #
-def fn_download_file_from_ftp(ftp_path: str, local_path: str) -> None:
-    """Downloads a file from FTP to the local storage"""
-    Path(local_path).parent.mkdir(parents=True, exist_ok=True)
-    ftp_client = connect_ftp(
-        os.getenv("FTPS_HOST"), os.getenv("FTPS_USERNAME"), os.getenv("FTPS_PWD")
+@contextmanager
+def fn_stream_file_from_ftp(
+    context, ftp_path: str, partitions: str, table_id: str, dataset_id: str
+):
+    """
+    Transfers a file from FTP once, writing it to its raw blob in GCS and to
+    a local buffer at the same time, instead of saving it to disk, uploading
+    it and downloading it back.
+    :return: The buffer with the file content, positioned at its start. It
+    is kept in memory up to STREAM_BUFFER_MAX_BYTES and spills to disk after.
+    """
+    filename = Path(ftp_path).name
+    st = StoragePlus(table_id=table_id, dataset_id=dataset_id)
+    context.log.debug(
+        f"Streaming {ftp_path} to mode raw of {dataset_id}.{table_id} with partitions {partitions}"
     )
-    ftp_client.retrbinary("RETR " + ftp_path, open(local_path, "wb").write)
-    ftp_client.quit()
+    with tempfile.SpooledTemporaryFile(
+        max_size=constants.STREAM_BUFFER_MAX_BYTES.value
+    ) as buffer:
+        with st.open_upload(
+            filename,
+            mode="raw",
+            partitions=partitions,
+            content_type=mimetypes.guess_type(filename)[0],
+        ) as raw_file:
+
+            def write(chunk):
+                raw_file.write(chunk)
+                buffer.write(chunk)
+
+            # Failed transfers resume where they stopped, so chunks are only appended
+            context.resources.ftp_pool.retrieve(ftp_path, write)
+        buffer.seek(0)
+        yield buffer
 
 
 def fn_parse_file_path_and_partitions(context, bucket_path):
@@ -71,91 +103,66 @@ def fn_parse_file_path_and_partitions(context, bucket_path):
     return filename, filetype, file_path, partitions
 
 
-def fn_upload_file_to_storage(
-    context, file_path, partitions=None, mode="raw", table_id=None, dataset_id=None
-):
-
-    # Upload to storage
-    # If not specific table_id, use resource one
-    if not table_id:
-        table_id = context.resources.basedosdados_config["table_id"]
-    if not dataset_id:
-        dataset_id = context.resources.basedosdados_config["dataset_id"]
-
-    st = bd.Storage(table_id=table_id, dataset_id=dataset_id)
-
-    context.log.debug(f"Table ID: {table_id}, Dataset ID: {dataset_id}")
-    context.log.debug(
-        f"Uploading file {file_path} to mode {mode} with partitions {partitions}"
-    )
-    st.upload(path=file_path, mode=mode, partitions=partitions, if_exists="replace")
-
-    return True
+def fn_divide_columns(df, cols_to_divide=None, value=100):
+    if cols_to_divide:
+        # Divide columns by value, for every row at once
+        df[cols_to_divide] = df[cols_to_divide] / value
+    return df
 
 
-def fn_get_file_from_storage(
+def fn_load_and_save_csv_chunked(
     context,
+    raw_file,
     file_path,
-    filename,
-    partitions,
-    mode="raw",
-    filetype="xlsx",
-    uploaded=True,
-    table_id=None,
-    dataset_id=None,
+    read_csv_kwargs: dict,
+    reindex_kwargs: dict,
+    dtypes: dict = None,
+    cols_to_divide: list = None,
+    mode="staging",
+    file_format="csv",
+    compression=None,
+    schema=None,
+    chunk_rows=constants.CSV_CHUNK_ROWS.value,
 ):
-
-    # Download from storage
-    # If not specific table_id, use resource one
-    if not table_id:
-        table_id = context.resources.basedosdados_config["table_id"]
-    if not dataset_id:
-        dataset_id = context.resources.basedosdados_config["dataset_id"]
-
-    _file_path = file_path.format(mode=mode, filetype=filetype)
-
-    st = StoragePlus(table_id=table_id, dataset_id=dataset_id)
-    context.log.debug(f"File path: {_file_path}")
-    context.log.debug(f"filename: {filename}")
-    context.log.debug(f"partition: {partitions}")
-    context.log.debug(f"mode: {mode}")
-    st.download(
-        filename=filename + "." + filetype,
-        file_path=_file_path,
-        partitions=partitions,
-        mode=mode,
-        if_exists="replace",
-    )
-    return _file_path
-
-
-def fn_load_and_reindex_csv(
-    file_path: str, read_csv_kwargs: dict, reindex_kwargs: dict
-):
-    # Rearrange columns
-    # df = pd.read_csv(file_path, delimiter=delimiter,
-    #                  skiprows=header_lines,
-    #                  names=original_header,
-    #                  index_col=False)
-    df = pd.read_csv(file_path, **read_csv_kwargs)
-    df = df.reindex(**reindex_kwargs)
-    return df
-
-
-def fn_add_timestamp(context, df):
+    """
+    Loads, treats and saves a RDO file `chunk_rows` rows at a time, so memory
+    use does not depend on the file size. Each chunk is reindexed, stamped
+    with the capture time and has `cols_to_divide` divided, then appended to
+    the treated file.
+    :param raw_file: Path or file object of the raw CSV.
+    :param file_path: Treated file path template, as returned by `fn_parse_file_path_and_partitions`.
+    :param dtypes: Type of each column, e.g. {"linha": "str", "buc_receita": "float64"}.
+    Columns left out are inferred by pandas, chunk by chunk.
+    :return: The treated file path.
+    """
+    _file_path = Path(file_path.format(mode=mode, filetype=file_format))
+    _file_path.parent.mkdir(parents=True, exist_ok=True)
+    context.log.info(f"Saving df to {_file_path}")
     timezone = context.resources.timezone_config["timezone"]
+    # Every chunk of the file gets the same capture time
     timestamp_captura = pd.to_datetime(pendulum.now(timezone).isoformat())
-    df["timestamp_captura"] = timestamp_captura
-    context.log.debug(", ".join(list(df.columns)))
-
-    return df
 
-
-def fn_divide_columns(df, cols_to_divide=None, value=100):
-    if cols_to_divide:
-        # Divide columns by value
-        df[cols_to_divide] = df[cols_to_divide].apply(lambda x: x / value, axis=1)
-    return df
+    chunk = None
+    with RollingFileWriter(
+        lambda id: _file_path,
+        file_format=file_format,
+        max_bytes=float("inf"),
+        compression=compression,
+        schema=schema,
+    ) as writer:
+        for chunk in pd.read_csv(
+            raw_file, dtype=dtypes, chunksize=chunk_rows, **read_csv_kwargs
+        ):
+            chunk = chunk.reindex(**reindex_kwargs)
+            chunk["timestamp_captura"] = timestamp_captura
+            chunk = fn_divide_columns(chunk, cols_to_divide)
+            writer.write(chunk)
+    if not writer.paths and chunk is not None:
+        # Files without records still get a treated file, with the header only
+        save_dataframe(
+            chunk, str(_file_path), file_format=file_format, compression=compression, schema=schema
+        )
+    return str(_file_path)
 
 
 def fn_upload_to_bigquery(
@@ -194,20 +201,66 @@ def fn_upload_to_bigquery(
         )
 
 
-def fn_save_treated_local(context, df, file_path, mode="staging"):
+def fn_list_folder(ftp_pool, folder_name: str) -> dict:
+    """
+    Lists the files of an FTP folder, in a session of its own so folders
+    can be listed in parallel.
+    :return: The MLSD facts of each file, keyed by its path.
+    """
+    with ftp_pool.session() as ftp_client:
+        return {
+            str(Path(folder_name, filename)): facts
+            for filename, facts in ftp_client.mlsd(
+                folder_name, facts=["type", "size", "modify"]
+            )
+            if facts.get("type") == "file"
+        }
+
+
+def fn_build_run_config(ftp_path: str, facts: dict) -> dict:
+    """Builds the run config of a file from the config of its folder and prefix"""
+    folder_name, filename = ftp_path.split("/")
+    fileprefix = filename.split("_")[0].lower()
+    config = read_config(Path(__file__).parent / f"{folder_name}_{fileprefix}.yaml")
+    table_id = config["resources"]["basedosdados_config"]["config"]["table_id"]
+    date = tuple(re.findall("\d+", filename))
+    ano = date[2][:4]
+    mes = date[2][4:6]
+    dia = date[2][6:]
+    relative_filepath = Path(
+        "raw/br_rj_riodejaneiro_rdo",
+        table_id,
+        f"ano={ano}",
+        f"mes={mes}",
+        f"dia={dia}",
+    )
 
-    _file_path = file_path.format(mode=mode, filetype="csv")
-    _file_path = Path(_file_path)
-    _file_path.parent.mkdir(parents=True, exist_ok=True)
-    _file_path = str(_file_path)
-    context.log.info(f"Saving df to {_file_path}")
-    df.to_csv(_file_path, index=False)
-    return _file_path
+    config["solids"]["download_file_from_ftp"]["inputs"] = {
+        "ftp_path": {"value": ftp_path},
+    }
+    config["solids"]["parse_file_path_and_partitions"]["inputs"]["bucket_path"][
+        "value"
+    ] = f"{relative_filepath}/{filename}"
+    # Recorded in the manifest once the file is processed
+    config["manifest"] = {"ftp_path": ftp_path, "facts": facts}
+    return config
 
 
 @solid(
+    required_resource_keys={"ftp_pool"},
     output_defs=[DynamicOutputDefinition(dict)],
     retry_policy=RetryPolicy(max_retries=3, delay=30),
+    config_schema={
+        "backfill": Field(
+            bool,
+            is_required=False,
+            default_value=False,
+            description=(
+                "Also process the files modified in the 24 hours before "
+                "execution_date at 11:30, even if the manifest has them"
+            ),
+        ),
+    },
 )
 def get_runs(context, execution_date):
     execution_date = datetime.strptime(execution_date, "%Y-%m-%d")
@@ -216,85 +269,73 @@ def get_runs(context, execution_date):
     min_timestamp = convert_datetime_to_unix_time(this_time_yesterday)
     max_timestamp = convert_datetime_to_unix_time(now)
     context.log.info(f"{execution_date} of type {type(execution_date)}")
-    ftp_client = connect_ftp(
-        os.getenv("FTPS_HOST"), os.getenv("FTPS_USERNAME"), os.getenv("FTPS_PWD")
-    )
+    pool = context.resources.ftp_pool
+
+    folder_names = []
+    with pool.session() as ftp_client:
+        for folder in ftp_client.mlsd("/"):
+            if folder[1]["type"] == "dir" and folder[0] in ALLOWED_FOLDERS:
+                folder_names.append(folder[0].lower())
+            else:
+                context.log.warning(
+                    f"Skipping file {folder[0]} since it is not inside a folder"
+                )
+
+    # Read file lists, one pooled session per folder
+    listing = {}
+    with ThreadPoolExecutor(max_workers=max(len(folder_names), 1)) as executor:
+        for files in executor.map(
+            lambda folder_name: fn_list_folder(pool, folder_name), folder_names
+        ):
+            listing.update(files)
+    context.log.info(f"Listed {len(listing)} files in folders {folder_names}")
+
+    manifest = FTPManifest(MANIFEST_NAME)
+    if manifest.is_empty():
+        # On the first run, files before the last day are taken as processed
+        manifest.record_many(
+            {
+                path: facts
+                for path, facts in listing.items()
+                if datetime.timestamp(parser.parse(facts["modify"])) < min_timestamp
+            }
+        )
 
-    # Change to working directory
-    ftp_client.cwd("/")
-    for folder in ftp_client.mlsd():
-
-        # Config yaml file will be folder_fileprefix.yaml
-        if folder[1]["type"] == "dir" and folder[0] in ALLOWED_FOLDERS:
-            # CWD to folder
-            context.log.info(f"Entering folder {folder[0]}")
-            folder_name = folder[0].lower()
-
-            # Read file list
-            for filepath in ftp_client.mlsd(folder_name):
-                filename = filepath[0]
-                fileprefix = filename.split("_")[0].lower()
-                timestamp = filepath[1]["modify"]
-                file_mtime = datetime.timestamp(parser.parse(timestamp))
-
-                if file_mtime >= min_timestamp and file_mtime < max_timestamp:
-
-                    # Download file to local folder
-                    try:
-                        config = read_config(
-                            Path(__file__).parent / f"{folder_name}_{fileprefix}.yaml"
-                        )
-                        table_id = config["resources"]["basedosdados_config"]["config"][
-                            "table_id"
-                        ]
-                        date = tuple(re.findall("\d+", filename))
-                        ano = date[2][:4]
-                        mes = date[2][4:6]
-                        dia = date[2][6:]
-                        relative_filepath = Path(
-                            "raw/br_rj_riodejaneiro_rdo",
-                            table_id,
-                            f"ano={ano}",
-                            f"mes={mes}",
-                            f"dia={dia}",
-                        )
-                        local_filepath = Path(FTPS_DIRECTORY, relative_filepath)
-                        Path(local_filepath).mkdir(parents=True, exist_ok=True)
-
-                        ftp_path = str(Path(folder_name, filename))
-                        local_path = str(Path(local_filepath, filename))
-
-                        # Run pipeline
-                        config["solids"]["download_file_from_ftp"]["inputs"] = {
-                            "ftp_path": {"value": ftp_path},
-                            "local_path": {"value": local_path},
-                        }
-                        config["solids"]["parse_file_path_and_partitions"]["inputs"][
-                            "bucket_path"
-                        ]["value"] = f"{relative_filepath}/{filename}"
-                        config["solids"]["upload_file_to_storage"] = {
-                            "inputs": {"file_path": {"value": local_path}}
-                        }
-                        yield DynamicOutput(
-                            config,
-                            mapping_key=f"{folder_name}_{fileprefix}_{uuid.uuid4().hex}",
-                        )
-
-                    except jinja2.TemplateNotFound as err:
-                        context.log.warning(
-                            f"Config file for file {filename} was not found. Skipping file."
-                        )
-                        context.log.warning(f"{Path(__file__).parent}")
-                ftp_client.cwd("/")
-        else:
-            context.log.warning(
-                f"Skipping file {folder[0]} since it is not inside a folder"
-            )
+    # New files and files modified since they were processed, whenever they landed
+    new_files = manifest.diff(listing)
+    if context.solid_config["backfill"]:
+        # Past dates are processed again, as with the old 24 hour window
+        new_files.update(
+            {
+                path: facts
+                for path, facts in listing.items()
+                if min_timestamp
+                <= datetime.timestamp(parser.parse(facts["modify"]))
+                < max_timestamp
+            }
+        )
+    context.log.info(f"Found {len(new_files)} new or modified files")
+    missing_configs = set()
+    for ftp_path, facts in sorted(new_files.items()):
+        try:
+            config = fn_build_run_config(ftp_path, facts)
+        except jinja2.TemplateNotFound:
+            missing_configs.add(ftp_path.split("_")[0])
             continue
+        folder_name, filename = ftp_path.split("/")
+        fileprefix = filename.split("_")[0].lower()
+        yield DynamicOutput(
+            config,
+            mapping_key=f"{folder_name}_{fileprefix}_{uuid.uuid4().hex}",
+        )
+    if missing_configs:
+        context.log.warning(
+            f"Config files were not found for prefixes {sorted(missing_configs)}. Skipping their files."
+        )
 
 
 @solid(
-    required_resource_keys={"timezone_config", "basedosdados_config"},
+    required_resource_keys={"timezone_config", "basedosdados_config", "ftp_pool"},
     retry_policy=RetryPolicy(max_retries=3, delay=30),
 )
 def execute_run(context, run_config: dict):
@@ -303,16 +344,10 @@ def execute_run(context, run_config: dict):
     table_id = run_config["resources"]["basedosdados_config"]["config"]["table_id"]
     dataset_id = run_config["resources"]["basedosdados_config"]["config"]["dataset_id"]
 
-    # Get file from FTPS and save it locally
+    # Parse file path and get partitions
     ftp_path = run_config["solids"]["download_file_from_ftp"]["inputs"]["ftp_path"][
         "value"
     ]
-    local_path = run_config["solids"]["download_file_from_ftp"]["inputs"]["local_path"][
-        "value"
-    ]
-    fn_download_file_from_ftp(ftp_path, local_path)
-
-    # Parse file path and get partitions
     bucket_path = run_config["solids"]["parse_file_path_and_partitions"]["inputs"][
         "bucket_path"
     ]["value"]
@@ -320,23 +355,6 @@ def execute_run(context, run_config: dict):
         context, bucket_path
     )
 
-    # Upload file to GCS
-    uploaded = fn_upload_file_to_storage(
-        context, local_path, partitions, table_id=table_id, dataset_id=dataset_id
-    )
-
-    # Get file from GCS
-    raw_file_path = fn_get_file_from_storage(
-        context,
-        file_path=file_path,
-        filename=filename,
-        partitions=partitions,
-        filetype=filetype,
-        uploaded=uploaded,
-        table_id=table_id,
-        dataset_id=dataset_id,
-    )
-
     # Extract, load and transform
     try:
         read_csv_kwargs = run_config["solids"]["load_and_reindex_csv"]["config"][
@@ -356,10 +374,7 @@ def execute_run(context, run_config: dict):
             f"Error reading reindex_kwargs config file for {filename} in folder {file_path}. Skipping file."
         )
         reindex_kwargs = None
-    treated_data = fn_load_and_reindex_csv(
-        raw_file_path, read_csv_kwargs=read_csv_kwargs, reindex_kwargs=reindex_kwargs
-    )
-    treated_data = fn_add_timestamp(context, treated_data)
+
     try:
         cols_to_divide = run_config["solids"]["divide_columns"]["inputs"][
             "cols_to_divide"
@@ -369,10 +384,33 @@ def execute_run(context, run_config: dict):
             f"No cols_to_divide was found in config file. Using default cols_to_divide."
         )
         cols_to_divide = None
-    treated_data = fn_divide_columns(treated_data, cols_to_divide)
-
-    # Save treated file locally
-    treated_file_path = fn_save_treated_local(context, treated_data, file_path)
+    dtypes = (
+        run_config["solids"]
+        .get("load_and_reindex_csv", {})
+        .get("config", {})
+        .get("dtypes")
+    )
+    if dtypes is None:
+        context.log.warning(f"No dtypes were found in config file. Inferring dtypes.")
+
+    # Get file from FTPS, uploading it to GCS raw while it is read, and save
+    # it treated locally, in the format set for the table
+    bd_config = run_config["resources"]["basedosdados_config"]["config"]
+    with fn_stream_file_from_ftp(
+        context, ftp_path, partitions, table_id=table_id, dataset_id=dataset_id
+    ) as raw_file:
+        treated_file_path = fn_load_and_save_csv_chunked(
+            context,
+            raw_file,
+            file_path,
+            read_csv_kwargs=read_csv_kwargs,
+            reindex_kwargs=reindex_kwargs,
+            dtypes=dtypes,
+            cols_to_divide=cols_to_divide,
+            file_format=bd_config.get("file_format", "csv"),
+            compression=bd_config.get("compression"),
+            schema=bd_config.get("schema"),
+        )
 
     # Upload treated to BigQuery
     modes = run_config["solids"]["upload_to_bigquery"]["inputs"]["modes"]["value"]
@@ -385,6 +423,11 @@ def execute_run(context, run_config: dict):
         dataset_id=dataset_id,
     )
 
+    if "manifest" in run_config:
+        FTPManifest(MANIFEST_NAME).record(
+            run_config["manifest"]["ftp_path"], run_config["manifest"]["facts"]
+        )
+
 
 @discord_message_on_failure
 @discord_message_on_success
@@ -396,6 +439,7 @@ def execute_run(context, run_config: dict):
                 "basedosdados_config": basedosdados_config,
                 "timezone_config": timezone_config,
                 "discord_webhook": discord_webhook,
+                "ftp_pool": ftp_pool,
             },
         ),
     ],
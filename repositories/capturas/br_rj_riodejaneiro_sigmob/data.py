@@ -1,35 +1,226 @@
+import json
+import time
 import shutil
+import hashlib
 import traceback
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import jinja2
-import requests
 import pandas as pd
-from basedosdados import Table
-from dagster import solid, pipeline, ModeDefinition, RetryPolicy
+from dagster import solid, pipeline, ModeDefinition, RetryPolicy, Output, OutputDefinition
+from redis.exceptions import RedisError
 
+from repositories.helpers.clients import get_redis
 from repositories.helpers.hooks import log_critical
+from repositories.helpers.logging import logger
 from repositories.helpers.constants import constants
-from repositories.capturas.resources import endpoints
+from repositories.helpers.pagination import PaginationCheckpoint, prefetch_pages
+from repositories.helpers.serialization import RollingFileWriter
+from repositories.helpers.uploads import UploadExecutor
+from repositories.capturas.resources import endpoints, http_client
 from repositories.analises.resources import schedule_run_date
 from repositories.libraries.basedosdados.resources import basedosdados_config, bd_client
+from repositories.libraries.basedosdados.solids import create_or_append_table
 
 
-def generate_df_and_save(data: dict, fname: Path):
-    # Generate dataframe
+def generate_df(data: list, key_column: str) -> pd.DataFrame:
+    # Generate dataframe, with the whole record in content
     df = pd.DataFrame()
-    df[data["key_column"]] = [
-        piece[data["key_column"]] for piece in data["data"]
-    ]
-    df["content"] = [piece for piece in data["data"]]
+    df[key_column] = [piece[key_column] for piece in data]
+    df["content"] = [piece for piece in data]
+    return df
+
+
+# Table recording which snapshot version holds the data of each endpoint
+VERSIONS_TABLE_ID = "versoes"
+
+
+def get_next_page(data: dict):
+    """Returns the URL of the page after `data`, or None if it is the last one"""
+    if data is None:
+        return None
+    if "next" in data and data["next"] != "EOF" and data["next"] != "":
+        return data["next"]
+    return None
+
+
+def _fingerprint_key(key: str) -> str:
+    return f"sigmob_fingerprint:{key}"
+
+
+def get_fingerprint(key: str) -> dict:
+    """
+    Gets the fingerprint of the last uploaded snapshot of an endpoint.
+    :return: A dict with `fingerprint`, `data_versao`, `pages`, `etag` and
+    `last_modified`, or None if there is none or Redis is unavailable.
+    """
+    try:
+        value = get_redis().get(_fingerprint_key(key))
+    except RedisError as e:
+        logger.warning(f"Could not read fingerprint of {key}: {e}")
+        return None
+    return json.loads(value) if value else None
+
+
+def update_fingerprint(fingerprint: str, records: list) -> str:
+    """Chains the hash of a page of `records` to `fingerprint`, so the
+    fingerprint of an endpoint can be computed page by page and resumed"""
+    page_hash = hashlib.sha256(
+        json.dumps(records, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+    return hashlib.sha256((fingerprint + page_hash).encode("utf-8")).hexdigest()
+
+
+def fn_request_endpoint(context, key: str, endpoint: dict, run_date: str) -> dict:
+    """
+    Requests every page of an endpoint, fetching the next page while the
+    current one is written. Records are written incrementally to rolling files
+    of up to SIGMOB_MAX_FILE_BYTES, so memory use does not depend on the
+    endpoint size.
+
+    Progress is checkpointed every time a file is completed, so a retry or a
+    new run for the same `run_date` resumes from the first page not yet saved.
+
+    The records are fingerprinted as they are written. If the fingerprint
+    matches the one of the last uploaded snapshot, the files are removed and
+    the endpoint points to that snapshot's `data_versao` instead.
+    :return: The final checkpoint state, with the written `paths`, the
+    `fingerprint` and the `data_versao` holding the data of the endpoint.
+    """
+    file_format = endpoint.get("file_format", "csv")
+    key_column = endpoint["key_column"]
+    path_template = jinja2.Template(
+        "{{ run_date }}/{{ key }}/data_versao={{ run_date }}/{{ key }}_version-{{ run_date }}-{{ id }}.{{ file_format }}")
+
+    checkpoint = PaginationCheckpoint(Path(run_date) / "_checkpoints" / f"{key}.json")
+    state = checkpoint.load()
+    if state is not None and state["done"]:
+        context.log.info(f"{key} was already requested, skipping")
+        return state
+    previous = get_fingerprint(key)
+    if previous is not None and previous["data_versao"] == run_date:
+        # Reruns of a date upload its snapshot again
+        previous = None
+    if state is None:
+        state = {"next_url": endpoint["url"], "paths": [], "fingerprint": "", "pages": 0}
+    paths = state["paths"]
+    fingerprint = state["fingerprint"]
+    page_count = state["pages"]
+    # Files left incomplete by a failed attempt would be uploaded otherwise
+    for path in Path(run_date, key).rglob("*"):
+        if path.is_file() and path not in paths:
+            path.unlink()
+    if paths:
+        context.log.info(f"Resuming {key} after {len(paths)} files")
+
+    # Single page endpoints are not downloaded again if the API tells they
+    # did not change since the last snapshot
+    conditional_headers = {}
+    if previous is not None and previous["pages"] == 1 and page_count == 0:
+        if previous.get("etag"):
+            conditional_headers["If-None-Match"] = previous["etag"]
+        if previous.get("last_modified"):
+            conditional_headers["If-Modified-Since"] = previous["last_modified"]
+    validators = {"etag": state.get("etag"), "last_modified": state.get("last_modified")}
+
+    def fetch(url):
+        context.log.info(f"URL = {url}")
+        is_first_page = url == endpoint["url"]
+        data = context.resources.http_client.get(
+            url,
+            timeout=constants.SIGMOB_GET_REQUESTS_TIMEOUT.value,
+            max_retries=endpoint.get("max_retries"),
+            headers=conditional_headers if is_first_page else None,
+        )
+        if is_first_page and data.status_code == 304:
+            return None
+        # Raise exception if not 200
+        data.raise_for_status()
+        if is_first_page:
+            validators["etag"] = data.headers.get("ETag")
+            validators["last_modified"] = data.headers.get("Last-Modified")
+        return data.json()
+
+    writer = RollingFileWriter(
+        lambda id: path_template.render(
+            run_date=run_date, key=key, id="{:03}".format(id), file_format=file_format
+        ),
+        file_format=file_format,
+        max_bytes=constants.SIGMOB_MAX_FILE_BYTES.value,
+        # Content is stored as JSON in Parquet files
+        schema={key_column: "STRING", "content": "STRING"},
+        paths=paths,
+    )
+    not_modified = False
+    with writer:
+        for url, data in prefetch_pages(fetch, state["next_url"], get_next_page):
+            if data is None:
+                not_modified = True
+                break
+            page_count += 1
+            records = data["result"] if "result" in data else data["data"]
+            fingerprint = update_fingerprint(fingerprint, records)
+            writer.write(generate_df(records, key_column))
+            if len(writer.closed_paths) > len(paths):
+                paths = list(writer.closed_paths)
+                checkpoint.save(
+                    get_next_page(data),
+                    paths,
+                    fingerprint=fingerprint,
+                    pages=page_count,
+                    **validators,
+                )
+
+    if not_modified:
+        fingerprint = previous["fingerprint"]
+        page_count = previous["pages"]
+        # Kept so the next run sends the conditional headers again
+        validators["etag"] = previous.get("etag")
+        validators["last_modified"] = previous.get("last_modified")
+        context.log.info(f"{key} was not modified since {previous['data_versao']}")
+    else:
+        context.log.info(f"Saved {page_count} pages of {key} in {len(writer.paths)} files")
+    data_versao = run_date
+    if previous is not None and fingerprint == previous["fingerprint"]:
+        # The previous snapshot already holds this data
+        shutil.rmtree(Path(run_date, key), ignore_errors=True)
+        data_versao = previous["data_versao"]
+        context.log.info(f"{key} is the same as version {data_versao}, skipping upload")
+    checkpoint.save(
+        None,
+        writer.paths if data_versao == run_date else [],
+        done=True,
+        fingerprint=fingerprint,
+        pages=page_count,
+        data_versao=data_versao,
+        **validators,
+    )
+    return checkpoint.load()
 
-    # Save dataframe to CSV
-    df.to_csv(fname, index=False)
+
+def fn_request_endpoint_with_retries(context, key: str, endpoint: dict, run_date: str) -> dict:
+    """
+    Requests an endpoint, retrying up to SIGMOB_ENDPOINT_MAX_RETRIES times if
+    it fails. Each retry resumes from the last checkpoint of the endpoint.
+    """
+    for attempt in range(constants.SIGMOB_ENDPOINT_MAX_RETRIES.value + 1):
+        try:
+            return fn_request_endpoint(context, key, endpoint, run_date)
+        except Exception:
+            if attempt == constants.SIGMOB_ENDPOINT_MAX_RETRIES.value:
+                raise
+            context.log.warning(
+                f"Failed to request {key}, retrying: \n{traceback.format_exc()}")
+            time.sleep(constants.SIGMOB_ENDPOINT_RETRY_DELAY.value)
 
 
 @solid(
-    required_resource_keys={"endpoints", "schedule_run_date"},
-    retry_policy=RetryPolicy(max_retries=3, delay=5),
+    required_resource_keys={"endpoints", "schedule_run_date", "http_client"},
+    output_defs=[
+        OutputDefinition(name="paths"),
+        OutputDefinition(name="failed"),
+    ],
 )
 def request_data(context):
 
@@ -39,103 +230,58 @@ def request_data(context):
 
     # Initialize empty dict for storing file paths
     paths_dict = {}
-
-    # Iterate over endpoints
-    for key in endpoints.keys():
-        context.log.info("#" * 80)
-        context.log.info(f"KEY = {key}")
-
-        # Start with empty contents, page count = 0 and id = 0
-        contents = None
-        id = 0
-        page_count = 0
-
-        # Setup a template for every CSV file
-        path_template = jinja2.Template(
-            "{{ run_date }}/{{ key }}/data_versao={{ run_date }}/{{ key }}_version-{{ run_date }}-{{ id }}.csv")
-
-        # The first next is the initial URL
-        next = endpoints[key]["url"]
-
-        # Iterate over pages
-        while next:
-            page_count += 1
-
+    versions = []
+    failed = {}
+
+    # Endpoints are requested concurrently and retried one by one, so a slow
+    # or failing endpoint does not hold back or restart the others
+    with ThreadPoolExecutor(
+        max_workers=constants.SIGMOB_MAX_CONCURRENT_ENDPOINTS.value
+    ) as executor:
+        futures = {
+            executor.submit(
+                fn_request_endpoint_with_retries, context, key, endpoint, run_date
+            ): key
+            for key, endpoint in endpoints.items()
+        }
+        for future in as_completed(futures):
+            key = futures[future]
             try:
-
-                # Get data
-                context.log.info(f"URL = {next}")
-                data = requests.get(
-                    next, timeout=constants.SIGMOB_GET_REQUESTS_TIMEOUT.value)
-
-                # Raise exception if not 200
-                data.raise_for_status()
-                data = data.json()
-
-                # Store contents
-                if contents is None:
-                    contents = {
-                        "data": data["result"] if "result" in data else data["data"],
-                        "key_column": endpoints[key]["key_column"],
-                    }
-                else:
-                    contents["data"].extend(data["data"])
-
-                # Get next page
-                if "next" in data and data["next"] != "EOF" and data["next"] != "":
-                    next = data["next"]
-                else:
-                    next = None
-
-            except Exception as e:
-                err = traceback.format_exc()
-                log_critical(f"Failed to request data from SIGMOB: \n{err}")
-                raise e
-
-            # Create a new file for every (constants.SIGMOB_PAGES_FOR_CSV_FILE.value) pages
-            if page_count % constants.SIGMOB_PAGES_FOR_CSV_FILE.value == 0:
-
-                # Increment file ID
-                id += 1
-                #"{{ run_date }}/{{ key }}/data_versao={{ run_date }}/{{ key }}_version-{{ run_date }}-{{ id }}.csv"
-                path = Path(path_template.render(
-                    run_date=run_date,
-                    key=key,
-                    id="{:03}".format(id))
-                )
-                context.log.info(
-                    f"Reached page count {page_count}, saving file at {path}")
-
-                # If it's the first file, create directories and save path
-                if id == 1:
-                    paths_dict[key] = path
-                    path.parent.mkdir(parents=True, exist_ok=True)
-
-                # Save CSV file
-                generate_df_and_save(contents, path)
-
-                # Reset contents
-                contents = None
-
-        # Save last file
-        if contents is not None:
-            id += 1
-            path = Path(path_template.render(
-                run_date=run_date,
-                key=key,
-                id="{:03}".format(id))
+                state = future.result()
+            except Exception:
+                failed[key] = traceback.format_exc()
+                continue
+            if state["paths"]:
+                paths_dict[key] = state["paths"][0]
+            versions.append(
+                {
+                    "endpoint": key,
+                    "data_versao_origem": state["data_versao"],
+                    "fingerprint": state["fingerprint"],
+                }
             )
-            if id == 1:
-                paths_dict[key] = path
-                path.parent.mkdir(parents=True, exist_ok=True)
-            generate_df_and_save(contents, path)
-            context.log.info(
-                f"Saved last file with page count {page_count} at {path}")
 
-        # Move on to the next endpoint.
+    if failed:
+        log_critical(
+            f"Failed to request data from SIGMOB endpoints {sorted(failed)}: \n"
+            + "\n".join(failed.values())
+        )
+    # Endpoints that succeeded are still uploaded
+    if failed and not paths_dict:
+        raise Exception(f"Failed to request every SIGMOB endpoint: {sorted(failed)}")
+
+    # Unchanged endpoints are not uploaded, this table tells where their data is
+    paths_dict[VERSIONS_TABLE_ID] = Path(
+        f"{run_date}/{VERSIONS_TABLE_ID}/data_versao={run_date}/"
+        f"{VERSIONS_TABLE_ID}_version-{run_date}.csv"
+    )
+    paths_dict[VERSIONS_TABLE_ID].parent.mkdir(parents=True, exist_ok=True)
+    pd.DataFrame(versions).to_csv(paths_dict[VERSIONS_TABLE_ID], index=False)
 
-    # Return paths
-    return paths_dict
+    # Return paths, and the failed endpoints so the run fails once the
+    # others are uploaded
+    yield Output(paths_dict, output_name="paths")
+    yield Output(sorted(failed), output_name="failed")
 
 
 @solid(
@@ -143,41 +289,53 @@ def request_data(context):
     retry_policy=RetryPolicy(max_retries=3, delay=30),
 )
 def upload_to_bq(context, paths):
-    for key in paths.keys():
-        context.log.info("#" * 80)
-        context.log.info(f"KEY = {key}")
-        tb = Table(key, context.resources.basedosdados_config["dataset_id"],)
-        tb_dir = paths[key].parent.parent
-        context.log.info(f"tb_dir = {tb_dir}")
-
-        if not tb.table_exists("staging"):
-            context.log.info(
-                "Table does not exist in STAGING, creating table...")
-            tb.create(
-                path=tb_dir,
-                if_table_exists="pass",
-                if_storage_data_exists="replace",
-                if_table_config_exists="pass",
+    # Each endpoint is a table of its own, so they are uploaded concurrently
+    with UploadExecutor(log=context.log) as executor:
+        for key in paths.keys():
+            tb_dir = paths[key].parent.parent
+            context.log.info(f"KEY = {key}, tb_dir = {tb_dir}")
+            executor.submit(
+                key,
+                create_or_append_table,
+                context,
+                context.resources.basedosdados_config["dataset_id"],
+                key,
+                tb_dir,
+                paths[key].suffix[1:],
+                # Not safe to repeat, the solid's retry policy reruns every table
+                max_retries=0,
             )
-            context.log.info("Table created in STAGING")
-        else:
-            context.log.info(
-                "Table already exists in STAGING, appending to it...")
-            tb.append(filepath=tb_dir, if_exists="replace",
-                      timeout=600, chunk_size=1024*1024*10)
-            context.log.info("Appended to table on STAGING successfully.")
-
-        if not tb.table_exists("prod"):
-            context.log.info("Table does not exist in PROD, publishing...")
-            tb.publish(if_exists="pass")
-            context.log.info("Published table in PROD successfully.")
-        else:
-            context.log.info("Table already published in PROD.")
     context.log.info(f"Returning -> {tb_dir.parent}")
 
     return tb_dir.parent
 
 
+@solid
+def record_fingerprints(context, path, failed):
+    """Records the fingerprint of each endpoint once its snapshot is uploaded,
+    so the next runs can tell whether the endpoint changed. Fails if any
+    endpoint failed, keeping the local checkpoints for a rerun."""
+    for checkpoint_path in sorted(Path(path, "_checkpoints").glob("*.json")):
+        state = PaginationCheckpoint(checkpoint_path).load()
+        if state is None or not state["done"]:
+            continue
+        get_redis().set(
+            _fingerprint_key(checkpoint_path.stem),
+            json.dumps(
+                {
+                    "fingerprint": state["fingerprint"],
+                    "data_versao": state["data_versao"],
+                    "pages": state["pages"],
+                    "etag": state["etag"],
+                    "last_modified": state["last_modified"],
+                }
+            ),
+        )
+    if failed:
+        raise Exception(f"Failed to request SIGMOB endpoints: {failed}")
+    return path
+
+
 @solid
 def cleanup_local(context, path):
     shutil.rmtree(path)
@@ -192,6 +350,7 @@ def cleanup_local(context, path):
                 "bd_client": bd_client,
                 "schedule_run_date": schedule_run_date,
                 "endpoints": endpoints,
+                "http_client": http_client,
             },
         )
     ],
@@ -208,8 +367,10 @@ def cleanup_local(context, path):
     },
 )
 def br_rj_riodejaneiro_sigmob_data():
+    paths, failed = request_data()
     cleanup_local(
-        upload_to_bq(
-            request_data()
+        record_fingerprints(
+            upload_to_bq(paths),
+            failed,
         )
     )
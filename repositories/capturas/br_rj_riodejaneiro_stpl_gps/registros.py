@@ -1,8 +1,5 @@
 import traceback
-from datetime import timedelta
 
-import pytz
-import pendulum
 import pandas as pd
 from dagster import (
     solid,
@@ -16,8 +13,13 @@ from repositories.capturas.resources import (
     keepalive_key,
     timezone_config,
     discord_webhook,
+    http_client,
+    gps_dedup,
+    capture_log_sink,
 )
 from repositories.libraries.basedosdados.resources import basedosdados_config
+from repositories.helpers.gps import normalize_gps
+from repositories.helpers.metrics import get_metrics
 from repositories.helpers.hooks import (
     discord_message_on_failure,
     discord_message_on_success,
@@ -29,6 +31,7 @@ from repositories.capturas.solids import (
     create_current_datetime_partition,
     get_file_path_and_partitions,
     get_raw,
+    mark_gps_ingested,
     save_raw_local,
     save_treated_local,
     upload_logs_to_bq,
@@ -36,17 +39,7 @@ from repositories.capturas.solids import (
 from repositories.libraries.basedosdados.solids import upload_to_bigquery
 
 
-@solid(
-    required_resource_keys={"basedosdados_config", "timezone_config"},
-    output_defs=[
-        OutputDefinition(name="treated_data", is_required=True),
-        OutputDefinition(name="error", is_required=False)],
-)
-def pre_treatment_br_rj_riodejaneiro_stpl_gps(context, data, timestamp, prev_error=None):
-
-    if prev_error is not None:
-        yield Output(pd.DataFrame(), output_name="treated_data")
-        yield Output(prev_error, output_name="error")
+def fn_pre_treatment_br_rj_riodejaneiro_stpl_gps(context, data, timestamp):
 
     error = None
 
@@ -54,47 +47,49 @@ def pre_treatment_br_rj_riodejaneiro_stpl_gps(context, data, timestamp, prev_err
 
     data = data.json()
     df = pd.DataFrame(data["veiculos"])
-    timestamp_captura = pd.to_datetime(timestamp)
-    df["timestamp_captura"] = timestamp_captura
-    df["dataHora"] = df["dataHora"].apply(
-        lambda ms: pd.to_datetime(
-            pendulum.from_timestamp(ms / 1000.0, timezone).isoformat()
-        )
-    )
 
-    # Filter data for 0 <= time diff <= 1min
+    # Convert dataHora (epoch in ms) to config timezone and
+    # filter data for 0 <= time diff <= 1min
     try:
-        datahora_col = "dataHora"
-        df_treated = df
-        try:
-            df_treated[datahora_col] = df_treated[datahora_col].apply(
-                lambda x: x.tz_convert(timezone)
-            )
-        except TypeError:
-            df_treated[datahora_col] = df_treated[datahora_col].apply(
-                lambda x: x.tz_localize(timezone)
-            )
-        try:
-            df_treated["timestamp_captura"] = df_treated["timestamp_captura"].apply(
-                lambda x: x.tz_convert(timezone)
-            )
-        except TypeError:
-            df_treated["timestamp_captura"] = df_treated["timestamp_captura"].apply(
-                lambda x: x.tz_localize(timezone)
-            )
-        mask = (df_treated["timestamp_captura"] - df_treated[datahora_col]).apply(
-            lambda x: timedelta(seconds=0) <= x <= timedelta(minutes=1)
-        )
-        df_treated = df_treated[mask]
+        df_treated = normalize_gps(df, "dataHora", timestamp, timezone, unit="ms")
         context.log.info(f"Shape antes da filtragem: {df.shape}")
         context.log.info(f"Shape após a filtrage: {df_treated.shape}")
         if df_treated.shape[0] == 0:
             error = ValueError("After filtering, the dataframe is empty!")
         df = df_treated
+        df, n_duplicates = context.resources.gps_dedup.drop_ingested(
+            df, context.resources.basedosdados_config["dataset_id"]
+        )
+        context.log.info(f"Dropped {n_duplicates} records already captured")
     except:
         err = traceback.format_exc()
         log_critical(f"Failed to filter STPL data: \n{err}")
 
+    return df, error
+
+
+@solid(
+    required_resource_keys={"basedosdados_config", "timezone_config", "gps_dedup"},
+    output_defs=[
+        OutputDefinition(name="treated_data", is_required=True),
+        OutputDefinition(name="error", is_required=False)],
+)
+def pre_treatment_br_rj_riodejaneiro_stpl_gps(context, data, timestamp, prev_error=None):
+
+    if prev_error is not None:
+        yield Output(pd.DataFrame(), output_name="treated_data")
+        yield Output(prev_error, output_name="error")
+        return
+
+    config = context.resources.basedosdados_config
+    with get_metrics().stage(
+        config["dataset_id"], config["table_id"], "treatment"
+    ) as measure:
+        df, error = fn_pre_treatment_br_rj_riodejaneiro_stpl_gps(
+            context, data, timestamp)
+        measure["rows"] = df.shape[0]
+        measure["success"] = int(error is None)
+
     yield Output(df, output_name="treated_data")
     yield Output(error, output_name="error")
 
@@ -112,6 +107,9 @@ def pre_treatment_br_rj_riodejaneiro_stpl_gps(context, data, timestamp, prev_err
                 "timezone_config": timezone_config,
                 "discord_webhook": discord_webhook,
                 "keepalive_key": keepalive_key,
+                "http_client": http_client,
+                "gps_dedup": gps_dedup,
+                "capture_log_sink": capture_log_sink,
             },
         ),
     ],
@@ -139,8 +137,10 @@ def br_rj_riodejaneiro_stpl_gps_registros():
     treated_data, error = pre_treatment_br_rj_riodejaneiro_stpl_gps(
         data, timestamp, prev_error=error)
 
-    upload_logs_to_bq(timestamp, error)
+    upload_logs_to_bq(timestamp, error, data=data, treated_data=treated_data)
 
     treated_file_path = save_treated_local(treated_data, file_path)
 
-    upload_to_bigquery([raw_file_path, treated_file_path], partitions)
+    uploaded = upload_to_bigquery([raw_file_path, treated_file_path], partitions)
+
+    mark_gps_ingested(treated_data, uploaded)
@@ -0,0 +1,421 @@
+"""
+Resident capture worker for the minute-level GPS feeds.
+
+Instead of launching one Dagster run per feed every minute, this process polls
+every feed listed in `gps_worker.yaml` on a fixed cadence, keeps the treated
+records in memory and flushes them to GCS/BigQuery every `flush_interval`
+minutes or `flush_rows` rows, whichever comes first. The `keepalive_key` of
+each feed is refreshed on every poll, so the watchdog keeps working as before.
+
+Feeds are polled concurrently, each in its own thread, so a slow API does
+not delay the capture of the others.
+
+Usage:
+    python -m repositories.capturas.gps_worker
+"""
+import os
+import asyncio
+import time
+import signal
+import traceback
+from pathlib import Path
+from types import SimpleNamespace
+
+import pendulum
+import pandas as pd
+
+from repositories.helpers.capture_logs import CaptureLogSink, build_log_record
+from repositories.helpers.clients import get_redis_pal
+from repositories.helpers.constants import constants
+from repositories.helpers.dedup import GPSDedupIndex
+from repositories.helpers.helpers import read_config
+from repositories.helpers.hooks import log_critical
+from repositories.helpers.http import HTTPClient
+from repositories.helpers.logging import logger
+from repositories.helpers.metrics import get_metrics
+from repositories.helpers.storage import StoragePlus
+from repositories.helpers.uploads import UploadError, UploadExecutor
+from repositories.helpers.write_api import WriteAPISink
+from repositories.capturas.solids import (
+    fn_flush_capture_logs,
+    fn_get_raw,
+    save_local_as_bd,
+)
+from repositories.libraries.basedosdados.solids import (
+    append_dataframe,
+    create_or_append_table,
+)
+from repositories.capturas.br_rj_riodejaneiro_onibus_gps.registros import (
+    fn_pre_treatment_br_rj_riodejaneiro_onibus_gps,
+)
+from repositories.capturas.br_rj_riodejaneiro_brt_gps.registros import (
+    fn_pre_treatment_br_rj_riodejaneiro_brt_gps,
+)
+from repositories.capturas.br_rj_riodejaneiro_stpl_gps.registros import (
+    fn_pre_treatment_br_rj_riodejaneiro_stpl_gps,
+)
+
+# Treatment function and the solid whose inputs it takes, keyed by dataset_id
+TREATMENTS = {
+    "br_rj_riodejaneiro_onibus_gps": (
+        "pre_treatment_br_rj_riodejaneiro_onibus_gps",
+        fn_pre_treatment_br_rj_riodejaneiro_onibus_gps,
+    ),
+    "br_rj_riodejaneiro_brt_gps": (
+        "pre_treatment_br_rj_riodejaneiro_brt_gps",
+        fn_pre_treatment_br_rj_riodejaneiro_brt_gps,
+    ),
+    "br_rj_riodejaneiro_stpl_gps": (
+        "pre_treatment_br_rj_riodejaneiro_stpl_gps",
+        fn_pre_treatment_br_rj_riodejaneiro_stpl_gps,
+    ),
+}
+
+
+def build_context(config: dict, log=logger) -> SimpleNamespace:
+    """Builds a solid-like context from a pipeline run config, so the `fn_`
+    functions used by the solids can be called outside of Dagster."""
+    resources = {
+        name: resource.get("config", {})
+        for name, resource in config.get("resources", {}).items()
+    }
+    # Every feed shares the process-wide HTTP session
+    resources["http_client"] = HTTPClient(**resources.get("http_client", {}))
+    if "gps_dedup" in resources:
+        resources["gps_dedup"] = GPSDedupIndex(**resources["gps_dedup"])
+    resources["capture_log_sink"] = CaptureLogSink(**resources.get("capture_log_sink", {}))
+    return SimpleNamespace(log=log, resources=SimpleNamespace(**resources))
+
+
+def get_solid_inputs(config: dict, solid_name: str) -> dict:
+    """Gets the input values of `solid_name` from a pipeline run config"""
+    inputs = config.get("solids", {}).get(solid_name, {}).get("inputs", {})
+    return {key: value["value"] for key, value in inputs.items()}
+
+
+class GPSFeed:
+    """A single GPS feed, configured by its pipeline `registros.yaml`"""
+
+    def __init__(self, config_path, log=logger):
+        self.config = read_config(config_path)
+        self.context = build_context(self.config, log)
+        self.dataset_id = self.context.resources.basedosdados_config["dataset_id"]
+        self.table_id = self.context.resources.basedosdados_config["table_id"]
+        self.keepalive_key = self.context.resources.keepalive_key["key"]
+        self.file_format = self.context.resources.basedosdados_config.get(
+            "file_format", "csv"
+        )
+        self.data_folder = os.getenv("DATA_FOLDER", "data")
+
+        self.request_kwargs = get_solid_inputs(self.config, "get_raw")
+        solid_name, self.treatment = TREATMENTS[self.dataset_id]
+        self.treatment_kwargs = get_solid_inputs(self.config, solid_name)
+
+        self.log_sink = self.context.resources.capture_log_sink
+        self.logs_table_id = self.table_id + "_logs"
+
+        self.frames = []
+        self.raw_files = []
+        self.n_rows = 0
+        self.last_flush = time.monotonic()
+
+    def poll(self):
+        """Captures and treats one minute of data, buffering the results"""
+        data, timestamp, error = fn_get_raw(self.context, **self.request_kwargs)
+        n_records = None
+        try:
+            if error is None and not data.ok:
+                error = f"API returned status {data.status_code}"
+            if error is None:
+                self.raw_files.append(self.save_raw(data, timestamp))
+                with get_metrics().stage(
+                    self.dataset_id, self.table_id, "treatment"
+                ) as measure:
+                    df, error = self.treatment(
+                        self.context, data, timestamp, **self.treatment_kwargs
+                    )
+                    measure["rows"] = df.shape[0]
+                    measure["success"] = int(error is None)
+                n_records = df.shape[0]
+                if not df.empty:
+                    self.frames.append(df)
+                    self.n_rows += df.shape[0]
+        except Exception as e:
+            error = e
+            log_critical(
+                f"Failed to capture {self.dataset_id}: \n{traceback.format_exc()}"
+            )
+        finally:
+            self.log_sink.record(
+                self.dataset_id,
+                self.logs_table_id,
+                [
+                    build_log_record(
+                        timestamp,
+                        error,
+                        n_records=n_records,
+                        elapsed=getattr(data, "elapsed", None),
+                    )
+                ],
+            )
+            self.keepalive()
+
+    def save_raw(self, data, timestamp):
+        capture_time = pendulum.parse(timestamp)
+        return save_local_as_bd(
+            data.content,
+            self.data_folder,
+            capture_time.strftime("%Y-%m-%d-%H-%M-%S"),
+            self.dataset_id,
+            self.table_id,
+            "raw",
+            "json",
+            partitions=capture_time.strftime("data=%Y-%m-%d/hora=%H"),
+            raw_compression=self.context.resources.basedosdados_config.get(
+                "raw_compression"
+            ),
+        )
+
+    def keepalive(self):
+        rp = get_redis_pal()
+        rp.set(self.keepalive_key, 1)
+
+    def should_flush(self, flush_interval, flush_rows):
+        elapsed = time.monotonic() - self.last_flush
+        return self.n_rows >= flush_rows or elapsed >= flush_interval * constants.MINUTE.value
+
+    def flush(self, force_logs=False):
+        """Uploads buffered raw files and treated records, and the buffered
+        logs if they are due or `force_logs`"""
+        staging_files = []
+        n_rows, n_captures = self.n_rows, len(self.raw_files)
+        bd_config = self.context.resources.basedosdados_config
+        write_api = dict(bd_config.get("write_api") or {})
+        archive_raw = write_api.pop("archive_raw", True)
+        df = self.buffered_records()
+        if df is not None and bd_config.get("write_api") is not None:
+            WriteAPISink(**write_api).write(
+                self.dataset_id,
+                self.table_id,
+                df,
+                bd_config.get("schema"),
+            )
+            # The rows are committed, so only the raw files are kept for retry
+            self.mark_ingested(df)
+            self.clear_records()
+        elif df is not None:
+            filename = (
+                pd.to_datetime(df["timestamp_captura"])
+                .min()
+                .strftime("%Y-%m-%d-%H-%M-%S")
+            )
+            # A batch may span more than one hour, so split it by partition
+            partitions = pd.to_datetime(df["timestamp_captura"]).dt.strftime(
+                "data=%Y-%m-%d/hora=%H"
+            )
+            appended = []
+            try:
+                for partition, df_partition in df.groupby(partitions):
+                    if bd_config.get("upload_mode") == "memory" and append_dataframe(
+                        self.context,
+                        self.dataset_id,
+                        self.table_id,
+                        df_partition,
+                        filename,
+                        partition,
+                    ):
+                        appended.append(partition)
+                        continue
+                    staging_files.append(
+                        save_local_as_bd(
+                            df_partition,
+                            self.data_folder,
+                            filename,
+                            self.dataset_id,
+                            self.table_id,
+                            "staging",
+                            self.file_format,
+                            partitions=partition,
+                            compression=bd_config.get("compression"),
+                            schema=bd_config.get("schema"),
+                        )
+                    )
+            finally:
+                if appended:
+                    # Appended partitions are in staging already, keep the others
+                    self.mark_ingested(df[partitions.isin(appended)])
+                    remaining = df[~partitions.isin(appended)]
+                    self.clear_records()
+                    if not remaining.empty:
+                        self.frames = [remaining]
+                        self.n_rows = remaining.shape[0]
+
+        st = StoragePlus(table_id=self.table_id, dataset_id=self.dataset_id)
+        try:
+            # Raw files and the staging table are independent, so they are uploaded together
+            with UploadExecutor(log=self.context.log) as executor:
+                # With the Write API, the raw archive in GCS is optional
+                if archive_raw:
+                    for raw_file in self.raw_files:
+                        executor.submit(
+                            str(raw_file),
+                            st.upload,
+                            path=raw_file,
+                            partitions=raw_file.parent.relative_to(
+                                Path(self.data_folder, "raw", self.dataset_id, self.table_id)
+                            ).as_posix(),
+                            mode="raw",
+                            if_exists="replace",
+                        )
+                if staging_files:
+                    executor.submit(
+                        "staging",
+                        create_or_append_table,
+                        self.context,
+                        self.dataset_id,
+                        self.table_id,
+                        f"{self.data_folder}/staging/{self.dataset_id}/{self.table_id}",
+                        self.file_format,
+                        # Appends and table creation are not safe to repeat
+                        max_retries=0,
+                    )
+        except UploadError as e:
+            if staging_files and "staging" not in e.errors:
+                # Only the raw uploads failed, the records are in staging already
+                self.mark_ingested(pd.concat(self.frames, ignore_index=True))
+                self.clear_records()
+            raise
+        finally:
+            # Staging files are written again from the buffered frames on the
+            # next flush, and would be appended twice if kept
+            for path in staging_files:
+                Path(path).unlink(missing_ok=True)
+
+        if staging_files:
+            self.mark_ingested(pd.concat(self.frames, ignore_index=True))
+
+        fn_flush_capture_logs(
+            self.log_sink, self.dataset_id, self.logs_table_id, force=force_logs
+        )
+
+        for path in self.raw_files:
+            Path(path).unlink(missing_ok=True)
+
+        self.context.log.info(
+            f"Flushed {n_rows} rows from {n_captures} captures of {self.dataset_id}"
+        )
+        self.clear_records()
+        self.raw_files = []
+        self.last_flush = time.monotonic()
+
+    def buffered_records(self):
+        """Concatenates the buffered records, dropping the ones ingested since
+        they were polled and the ones repeated across polls"""
+        if not self.frames:
+            return None
+        df = pd.concat(self.frames, ignore_index=True)
+        dedup = getattr(self.context.resources, "gps_dedup", None)
+        if dedup is not None:
+            df, n_duplicates = dedup.drop_ingested(df, self.dataset_id)
+            if n_duplicates:
+                self.context.log.info(
+                    f"Dropped {n_duplicates} records of {self.dataset_id} already captured"
+                )
+        if df.empty:
+            self.clear_records()
+            return None
+        self.frames = [df]
+        self.n_rows = df.shape[0]
+        return df
+
+    def mark_ingested(self, df):
+        """Adds written records to the deduplication index, if any"""
+        dedup = getattr(self.context.resources, "gps_dedup", None)
+        if dedup is not None:
+            dedup.mark_ingested(df, self.dataset_id)
+
+    def clear_records(self):
+        """Drops the buffered treated records, e.g. once they are written"""
+        self.frames = []
+        self.n_rows = 0
+
+    def discard(self):
+        """Drops the buffered records and deletes the buffered raw files, for
+        callers that will not flush this feed again"""
+        for path in self.raw_files:
+            Path(path).unlink(missing_ok=True)
+        self.clear_records()
+        self.raw_files = []
+
+
+async def _run_feed(feed, poll, flush, force_logs):
+    loop = asyncio.get_running_loop()
+    if poll:
+        await loop.run_in_executor(None, feed.poll)
+    if flush:
+        # Uploads start as soon as this feed is treated, regardless of the others
+        await loop.run_in_executor(None, feed.flush, force_logs)
+
+
+async def _run_feeds(feeds, poll, flush, force_logs):
+    return await asyncio.gather(
+        *[_run_feed(feed, poll, flush, force_logs) for feed in feeds],
+        return_exceptions=True,
+    )
+
+
+def capture_feeds(feeds, poll=True, flush=True, force_logs=False) -> dict:
+    """
+    Polls and flushes `feeds` concurrently. Each feed is flushed as soon as it
+    is polled, and a failure in one feed does not affect the others.
+    :param feeds: The GPSFeed objects to capture.
+    :param poll: Whether to poll the feeds. Default is True.
+    :param flush: Whether to flush the feeds. Default is True.
+    :param force_logs: Whether to flush the logs even if they are not due. Default is False.
+    :return: The exceptions raised by each failed feed, keyed by dataset_id.
+    """
+    results = asyncio.run(_run_feeds(feeds, poll, flush, force_logs))
+    errors = {}
+    for feed, result in zip(feeds, results):
+        if isinstance(result, Exception):
+            # Buffers are kept, so a later flush of the same feed retries them
+            errors[feed.dataset_id] = result
+            log_critical(
+                f"Failed to capture {feed.dataset_id}: \n"
+                + "".join(traceback.format_exception(type(result), result, result.__traceback__))
+            )
+    return errors
+
+
+def run(config_path=Path(__file__).parent / "gps_worker.yaml"):
+    config = read_config(config_path)
+    poll_interval = config["config"]["poll_interval"]
+    flush_interval = config["config"]["flush_interval"]
+    flush_rows = config["config"]["flush_rows"]
+
+    feeds = [GPSFeed(Path(__file__).parent / path) for path in config["feeds"]]
+
+    # Flush whatever is in memory before shutting down
+    stop = SimpleNamespace(requested=False)
+
+    def request_stop(signum, frame):
+        logger.info(f"Received signal {signum}, stopping after this cycle")
+        stop.requested = True
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    while not stop.requested:
+        cycle_start = time.monotonic()
+        capture_feeds(feeds, flush=False)
+        capture_feeds(
+            [feed for feed in feeds if feed.should_flush(flush_interval, flush_rows)],
+            poll=False,
+        )
+        time.sleep(max(0, poll_interval - (time.monotonic() - cycle_start)))
+
+    capture_feeds(feeds, poll=False, force_logs=True)
+
+
+if __name__ == "__main__":
+    run()
@@ -1,5 +1,14 @@
+import os
+
 from dagster import resource, Field
 
+from repositories.helpers.capture_logs import CaptureLogSink
+from repositories.helpers.clients import GCPClients, RedisClients
+from repositories.helpers.constants import constants
+from repositories.helpers.dedup import GPSDedupIndex
+from repositories.helpers.ftp_pool import FTPSessionPool
+from repositories.helpers.http import HTTPClient
+
 
 @resource(
     {
@@ -48,3 +57,146 @@ def discord_webhook(context):
 )
 def keepalive_key(context):
     return context.resource_config
+
+
+@resource(
+    {
+        "timeout": Field(
+            float,
+            is_required=False,
+            default_value=float(constants.CAPTURA_GET_TIMEOUT.value),
+            description="Request timeout, in seconds",
+        ),
+        "max_retries": Field(
+            int,
+            is_required=False,
+            default_value=constants.HTTP_MAX_RETRIES.value,
+            description="Retries for timeouts, connection errors and 429/5xx responses",
+        ),
+        "backoff_factor": Field(
+            float,
+            is_required=False,
+            default_value=float(constants.HTTP_BACKOFF_FACTOR.value),
+            description="Base of the jittered exponential backoff, in seconds",
+        ),
+        "pool_maxsize": Field(
+            int,
+            is_required=False,
+            default_value=constants.HTTP_POOL_MAXSIZE.value,
+            description="Connections kept alive per host",
+        ),
+    }
+)
+def http_client(context):
+    return HTTPClient(log=context.log, **context.resource_config)
+
+
+@resource
+def gcp_clients(context):
+    return GCPClients()
+
+
+@resource(
+    {
+        "host": Field(
+            str,
+            is_required=False,
+            default_value=constants.REDIS_HOST.value,
+            description="Redis host",
+        )
+    }
+)
+def redis_client(context):
+    return RedisClients(context.resource_config["host"])
+
+
+@resource(
+    {
+        "key_columns": Field(
+            list,
+            is_required=True,
+            description="Columns identifying a GPS ping, e.g. vehicle and GPS timestamp",
+        ),
+        "backend": Field(
+            str,
+            is_required=False,
+            default_value="redis",
+            description="Where ingested pings are kept, redis or local",
+        ),
+        "ttl": Field(
+            int,
+            is_required=False,
+            default_value=constants.GPS_DEDUP_TTL.value,
+            description="Seconds a ping is remembered for",
+        ),
+        "maxsize": Field(
+            int,
+            is_required=False,
+            default_value=constants.GPS_DEDUP_MAXSIZE.value,
+            description="Maximum number of pings kept by the local backend",
+        ),
+        "enabled": Field(
+            bool,
+            is_required=False,
+            default_value=True,
+            description="Whether to drop pings already ingested",
+        ),
+    }
+)
+def gps_dedup(context):
+    return GPSDedupIndex(**context.resource_config)
+
+
+@resource(
+    {
+        "backend": Field(
+            str,
+            is_required=False,
+            default_value="redis",
+            description="Where log records are buffered, redis or local",
+        ),
+        "flush_interval": Field(
+            int,
+            is_required=False,
+            default_value=constants.CAPTURE_LOGS_FLUSH_INTERVAL.value,
+            description="Minutes between two bulk loads of the buffered records",
+        ),
+        "spool_dir": Field(
+            str,
+            is_required=False,
+            description="Folder of the local backend spool files",
+        ),
+    }
+)
+def capture_log_sink(context):
+    return CaptureLogSink(**context.resource_config)
+
+
+@resource(
+    {
+        "max_sessions": Field(
+            int,
+            is_required=False,
+            default_value=constants.FTP_MAX_SESSIONS.value,
+            description="FTPS sessions kept open, which bounds the parallel transfers",
+        ),
+        "max_retries": Field(
+            int,
+            is_required=False,
+            default_value=constants.FTP_MAX_RETRIES.value,
+            description="Times a failed transfer is resumed from the last byte received",
+        ),
+    }
+)
+def ftp_pool(context):
+    pool = FTPSessionPool(
+        os.getenv("FTPS_HOST"),
+        os.getenv("FTPS_USERNAME"),
+        os.getenv("FTPS_PWD"),
+        log=context.log,
+        **context.resource_config,
+    )
+    try:
+        yield pool
+    finally:
+        pool.close()
@@ -1,15 +1,43 @@
+from os import getenv
 from dagster import schedule, daily_schedule
 from pathlib import Path
 from repositories.helpers.helpers import read_config
 from datetime import datetime, time
 
 
+def _flag(name: str) -> bool:
+    return getenv(name, "false").lower() == "true"
+
+
+def gps_pipelines_enabled(context):
+    # When the resident GPS worker is deployed, minute schedules are skipped
+    return not (_flag("GPS_WORKER_ENABLED") or _flag("GPS_CONCURRENT_ENABLED"))
+
+
+def gps_concurrent_enabled(context):
+    # When enabled, the GPS feeds are captured together by a single pipeline
+    return _flag("GPS_CONCURRENT_ENABLED") and not _flag("GPS_WORKER_ENABLED")
+
+
+@schedule(
+    cron_schedule="* * * * *",
+    pipeline_name="br_rj_riodejaneiro_gps_registros",
+    name="br_rj_riodejaneiro_gps_registros",
+    mode="dev",
+    execution_timezone="America/Sao_Paulo",
+    should_execute=gps_concurrent_enabled,
+)
+def br_rj_riodejaneiro_gps_registros(context):
+    return read_config(Path(__file__).parent / "br_rj_riodejaneiro_gps/registros.yaml")
+
+
 @schedule(
     cron_schedule="* * * * *",
     pipeline_name="br_rj_riodejaneiro_stpl_gps_registros",
     name="br_rj_riodejaneiro_stpl_gps_registros",
     mode="dev",
     execution_timezone="America/Sao_Paulo",
+    should_execute=gps_pipelines_enabled,
 )
 def br_rj_riodejaneiro_stpl_gps_registros(context):
     timezone = context.scheduled_execution_time.timezone.name
@@ -26,6 +54,7 @@ def br_rj_riodejaneiro_stpl_gps_registros(context):
     name="br_rj_riodejaneiro_brt_gps_registros",
     mode="dev",
     execution_timezone="America/Sao_Paulo",
+    should_execute=gps_pipelines_enabled,
 )
 def br_rj_riodejaneiro_brt_gps_registros(context):
     timezone = context.scheduled_execution_time.timezone.name
@@ -42,6 +71,7 @@ def br_rj_riodejaneiro_brt_gps_registros(context):
     name="br_rj_riodejaneiro_onibus_gps_registros",
     mode="dev",
     execution_timezone="America/Sao_Paulo",
+    should_execute=gps_pipelines_enabled,
 )
 def br_rj_riodejaneiro_onibus_gps_registros(context):
     timezone = context.scheduled_execution_time.timezone.name
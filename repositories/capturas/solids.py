@@ -14,16 +14,24 @@ import pandas as pd
 from pathlib import Path
 import shutil
 import os
+import tempfile
 from openpyxl import load_workbook
 import re
-from google.cloud import storage
 
 import basedosdados as bd
-from basedosdados import Table
 
 # Temporario, essa funcao vai ser incorporada a base dos dados
-from repositories.helpers.storage import StoragePlus
-from repositories.helpers.io import get_credentials_from_env
+from repositories.helpers.storage import StoragePlus, TablePlus
+from repositories.helpers.capture_logs import build_log_record
+from repositories.helpers.logging import logger
+from repositories.helpers.metrics import get_metrics
+from repositories.helpers.payload import RawPayload
+from repositories.helpers.serialization import save_dataframe, save_raw
+from repositories.helpers.table_state import (
+    invalidate_table_state,
+    mark_table_exists,
+    table_exists,
+)
 
 
 @solid(
@@ -101,50 +109,121 @@ def parse_file_path_and_partitions(context, bucket_path):
     yield Output(partitions, output_name="partitions")
 
 
-@solid(required_resource_keys={'basedosdados_config', 'timezone_config'})
-def upload_logs_to_bq(context, timestamp, error):
-
-    dataset_id = context.resources.basedosdados_config['dataset_id']
-    table_id = context.resources.basedosdados_config['table_id'] + "_logs"
+def fn_upload_logs_to_bq(dataset_id, table_id, df, timestamp):
+    """Uploads capture log records in `df` to the `table_id` logs table. Columns
+    the existing staging table lacks, e.g. `n_registros` in tables created before
+    it was added, are left out, so the table can still read the files."""
 
+    # BD Table object
+    tb = TablePlus(table_id, dataset_id)
+    exists = table_exists(tb, "staging")
+    if exists:
+        columns = tb.staging_columns() or []
+        missing = [column for column in df.columns if column not in columns]
+        if missing:
+            logger.warning(
+                f"Staging table {dataset_id}.{table_id} has no columns {missing}, "
+                "recreate it from its table_config.yaml to upload them"
+            )
+            df = df.drop(columns=missing)
+
+    # each call gets its own folder, so concurrent uploads don't collide
+    root = tempfile.mkdtemp(prefix=f"{dataset_id}_")
     filepath = Path(
-        f"{timestamp}/{table_id}/data={pendulum.parse(timestamp).date()}/{table_id}_{timestamp}.csv")
+        f"{root}/{table_id}/data={pendulum.parse(timestamp).date()}/{table_id}_{timestamp}.csv")
     # create partition directory
     filepath.parent.mkdir(exist_ok=True, parents=True)
-    # create dataframe to be uploaded
-    df = pd.DataFrame(
-        {"timestamp_captura": [pd.to_datetime(timestamp)], "sucesso": [
-            error is None], "erro": [error]}
-    )
     # save local
     df.to_csv(filepath, index=False)
-    # BD Table object
-    tb = Table(table_id, dataset_id)
     # create and publish if table does not exist, append to it otherwise
-    if not tb.table_exists("staging"):
-        tb.create(
-            path=f"{timestamp}/{table_id}",
-            if_table_exists="replace",
-            if_storage_data_exists="replace",
-            if_table_config_exists="pass",
-        )
-    elif not tb.table_exists("prod"):
-        tb.publish(if_exists="replace")
-    else:
-        tb.append(filepath=f"{timestamp}/{table_id}", if_exists='replace')
+    try:
+        if not exists:
+            tb.create(
+                path=f"{root}/{table_id}",
+                if_table_exists="replace",
+                if_storage_data_exists="replace",
+                if_table_config_exists="pass",
+            )
+            mark_table_exists(dataset_id, table_id, "staging")
+        else:
+            tb.append(
+                filepath=f"{root}/{table_id}", if_exists='replace', check_exists=False
+            )
+            if not table_exists(tb, "prod"):
+                tb.publish(if_exists="replace")
+                mark_table_exists(dataset_id, table_id, "prod")
+    except Exception:
+        invalidate_table_state(dataset_id, table_id)
+        shutil.rmtree(root)
+        raise
 
     # delete local file
-    shutil.rmtree(f"{timestamp}")
+    shutil.rmtree(root)
+
+
+def fn_flush_capture_logs(sink, dataset_id, table_id, force=False):
+    """Uploads the log records buffered in `sink` in a single load per date,
+    if the sink is due or `force`. Returns the number of uploaded records."""
+
+    if not (force or sink.due(dataset_id, table_id)):
+        return 0
+    df = sink.pop(dataset_id, table_id)
+    dates = df["timestamp_captura"].map(lambda x: x.date())
+    n_records = 0
+    with get_metrics().stage(dataset_id, table_id, "flush_logs") as measure:
+        for date in sorted(dates.unique()):
+            df_date = df[dates == date]
+            try:
+                fn_upload_logs_to_bq(
+                    dataset_id,
+                    table_id,
+                    df_date,
+                    df_date["timestamp_captura"].min().isoformat(),
+                )
+            except Exception:
+                # Keep what was not uploaded for the next flush
+                sink.restore(dataset_id, table_id, df[dates >= date])
+                raise
+            n_records += df_date.shape[0]
+            measure["rows"] = n_records
+    return n_records
 
 
 @solid(
-    output_defs=[
-        OutputDefinition(name="data", is_required=False),
-        OutputDefinition(name="timestamp", is_required=False),
-        OutputDefinition(name="error", is_required=False)],
-    required_resource_keys={"basedosdados_config", "timezone_config"},
+    required_resource_keys={
+        "basedosdados_config",
+        "timezone_config",
+        "capture_log_sink",
+    }
 )
-def get_raw(context, url, headers=None, kind=None):
+def upload_logs_to_bq(context, timestamp, error, data=None, treated_data=None):
+
+    dataset_id = context.resources.basedosdados_config['dataset_id']
+    table_id = context.resources.basedosdados_config['table_id'] + "_logs"
+    sink = context.resources.capture_log_sink
+
+    sink.record(
+        dataset_id,
+        table_id,
+        [
+            build_log_record(
+                timestamp,
+                error,
+                n_records=None if treated_data is None else treated_data.shape[0],
+                elapsed=getattr(data, "elapsed", None),
+            )
+        ],
+    )
+    # The local backend only lives for this run, so it is flushed right away
+    n_records = fn_flush_capture_logs(
+        sink, dataset_id, table_id, force=sink.backend == "local"
+    )
+    if n_records:
+        context.log.info(f"Uploaded {n_records} log records to {dataset_id}.{table_id}")
+
+
+def fn_get_raw(context, url, headers=None, kind=None):
+    """Requests data from `url`, returning the response, capture timestamp and error"""
 
     data = None
     error = None
@@ -154,51 +233,106 @@ def get_raw(context, url, headers=None, kind=None):
         url = url + "?" +"".join([k + "=" + v for k, v in headers.items()])
         headers = None
 
-    try:
-        data = requests.get(url, headers=headers, timeout=60)
-        context.log.info(f"Data requested from API - Status: {data.status_code}")
-        context.log.info(f"Data requested from API - Content: {data.json()}")
-    except requests.exceptions.ReadTimeout as e:
-        context.log.info("Error: {}".format(e))
-        error = e
-    except Exception as e:
-        error = f"Unknown exception while trying to fetch data from {url}: {e}"
-        context.log.info(error)
+    config = context.resources.basedosdados_config
+    with get_metrics().stage(config["dataset_id"], config["table_id"], "request") as measure:
+        try:
+            data = RawPayload.from_response(
+                context.resources.http_client.get(url, headers=headers)
+            )
+            context.log.info(f"Data requested from API - Status: {data.status_code}")
+            context.log.info(f"Data requested from API - Size: {data.size} bytes")
+            measure["bytes"] = data.size
+            measure["success"] = int(data.ok)
+        except requests.exceptions.ReadTimeout as e:
+            context.log.info("Error: {}".format(e))
+            error = e
+            measure["success"] = 0
+        except Exception as e:
+            error = f"Unknown exception while trying to fetch data from {url}: {e}"
+            context.log.info(error)
+            measure["success"] = 0
+
+    return data, timestamp.isoformat(), error
+
+
+@solid(
+    output_defs=[
+        OutputDefinition(name="data", is_required=False),
+        OutputDefinition(name="timestamp", is_required=False),
+        OutputDefinition(name="error", is_required=False)],
+    required_resource_keys={"basedosdados_config", "timezone_config", "http_client"},
+)
+def get_raw(context, url, headers=None, kind=None):
+
+    data, timestamp, error = fn_get_raw(context, url, headers, kind)
 
     if error:
-        yield Output(timestamp.isoformat(), output_name="timestamp")
+        yield Output(timestamp, output_name="timestamp")
         yield Output(error, output_name="error")
-        yield Output(dict(), output_name="data")
+        yield Output(RawPayload(b"{}", status_code=None), output_name="data")
     elif data.ok:
         yield Output(data, output_name="data")
-        yield Output(timestamp.isoformat(), output_name="timestamp")
+        yield Output(timestamp, output_name="timestamp")
         yield Output(error, output_name="error")
 
 
-@solid
+@solid(
+    required_resource_keys={"basedosdados_config"},
+)
 def save_raw_local(context, data, file_path, mode="raw"):
 
+    config = context.resources.basedosdados_config
+    compression = config.get("raw_compression")
     _file_path = file_path.format(mode=mode, filetype="json")
-    Path(_file_path).parent.mkdir(parents=True, exist_ok=True)
-    try:
-        json.dump(data.json(), Path(_file_path).open("w"))
-    except Exception as e:
-        json.dump(dict(), Path(_file_path).open("w"))
-        context.log.error(f"Error while trying to save data to {_file_path}: {e}")
+    with get_metrics().stage(config["dataset_id"], config["table_id"], "save_raw") as measure:
+        try:
+            # Raw content is written as received, without decoding it
+            _file_path = save_raw(data.content, _file_path, compression=compression)
+        except Exception as e:
+            _file_path = save_raw(b"{}", _file_path, compression=compression)
+            context.log.error(f"Error while trying to save data to {_file_path}: {e}")
+            measure["success"] = 0
+        measure["bytes"] = _file_path.stat().st_size
 
-    return _file_path
+    return str(_file_path)
 
 
-@solid
+@solid(
+    required_resource_keys={"basedosdados_config"},
+)
 def save_treated_local(context, df, file_path, mode="staging"):
 
-    _file_path = file_path.format(mode=mode, filetype="csv")
-    Path(_file_path).parent.mkdir(parents=True, exist_ok=True)
-    df.to_csv(_file_path, index=False)
+    config = context.resources.basedosdados_config
+    file_format = config.get("file_format", "csv")
+    _file_path = file_path.format(mode=mode, filetype=file_format)
+    if config.get("upload_mode") == "memory":
+        # bq_upload uploads the dataframe itself, saving it only if needed
+        return _file_path
+    with get_metrics().stage(config["dataset_id"], config["table_id"], "save_treated") as measure:
+        save_dataframe(
+            df,
+            _file_path,
+            file_format=file_format,
+            compression=config.get("compression"),
+            schema=config.get("schema"),
+        )
+        measure["rows"] = df.shape[0]
+        measure["bytes"] = Path(_file_path).stat().st_size
 
     return _file_path
 
 
+@solid(
+    required_resource_keys={"basedosdados_config", "gps_dedup"},
+)
+def mark_gps_ingested(context, treated_data, uploaded=None):
+    """Adds the treated records to the GPS deduplication index. `uploaded` is
+    the output of the upload solid, so records are only marked once written"""
+    context.resources.gps_dedup.mark_ingested(
+        treated_data, context.resources.basedosdados_config["dataset_id"]
+    )
+
+
 @solid(
     required_resource_keys={"basedosdados_config"},
 )
@@ -245,7 +379,11 @@ def save_local_as_bd(
     mode,
     filetype,
     partitions=None,
+    raw_compression=None,
+    **save_kwargs,
 ):
+    """Saves data at the basedosdados folder structure. Raw payloads (bytes,
+    str or dict) are compressed with `raw_compression` (gzip or zstd) if given."""
 
     file_name = f"{file_name}.{filetype}"
 
@@ -254,11 +392,15 @@ def save_local_as_bd(
     else:
         file_path = f"{data_folder}/{mode}/{dataset_id}/{table_id}/{partitions}/"
 
-    return save_local(data, file_path, file_name)
+    return save_local(
+        data, file_path, file_name, raw_compression=raw_compression, **save_kwargs
+    )
 
 
-def save_local(data, file_path="tmp", file_name="tmp"):
-    """Saves data locally."""
+def save_local(data, file_path="tmp", file_name="tmp", raw_compression=None, **save_kwargs):
+    """Saves data locally. Dataframes are saved as Parquet if `file_name`
+    ends with .parquet and as CSV otherwise. Other data is compressed with
+    `raw_compression` if given, which appends .gz or .zst to `file_name`."""
 
     if file_path == "tmp":
         file_path = "TMP/"
@@ -268,7 +410,14 @@ def save_local(data, file_path="tmp", file_name="tmp"):
     Path(file_path).parent.mkdir(parents=True, exist_ok=True)
 
     if isinstance(data, pd.DataFrame):
-        data.to_csv(file_path, index=False)
+        file_format = "parquet" if file_path.suffix == ".parquet" else "csv"
+        save_dataframe(data, file_path, file_format=file_format, **save_kwargs)
+    elif raw_compression is not None:
+        if isinstance(data, dict):
+            data = json.dumps(data)
+        file_path = save_raw(data, file_path, compression=raw_compression)
+    elif isinstance(data, bytes):
+        Path(file_path).write_bytes(data)
     elif isinstance(data, dict):
         json.dump(data, Path(file_path).open("w"))
     else:
@@ -317,7 +466,7 @@ def upload_file_to_storage(
 
 
 @solid(
-    required_resource_keys={"basedosdados_config"},
+    required_resource_keys={"basedosdados_config", "gcp_clients"},
 )
 def upload_blob_to_storage(
     context, blob_path, partitions=None, mode="raw", table_id=None, bucket_name="", credential_mode="staging"
@@ -348,13 +497,11 @@ def upload_blob_to_storage(
     if not table_id:
         table_id = context.resources.basedosdados_config["table_id"]
     dataset_id = context.resources.basedosdados_config["dataset_id"]
-    credentials = get_credentials_from_env(mode=credential_mode)
-    client = storage.Client(credentials=credentials)
     blob_name = f"{mode}/{dataset_id}/{table_id}/"
     if partitions is not None:
         blob_name += _resolve_partitions(partitions=partitions)
     blob_name += blob_path.split("/")[-1]
-    bucket = client.bucket(bucket_name)
+    bucket = context.resources.gcp_clients.bucket(bucket_name, mode=credential_mode)
     blob = bucket.blob(blob_name)
     input_blob = get_blob(blob_path, bucket_name, mode=credential_mode)
     context.log.debug(
@@ -0,0 +1,124 @@
+import os
+import json
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from repositories.helpers.clients import get_redis
+from repositories.helpers.constants import constants
+
+BACKENDS = ["redis", "local"]
+
+# Columns of the `_logs` tables, in order
+LOG_COLUMNS = ["timestamp_captura", "sucesso", "erro", "n_registros", "tempo_resposta"]
+
+
+def build_log_record(timestamp, error=None, n_records=None, elapsed=None) -> dict:
+    """
+    Builds a capture log record.
+    :param timestamp: Capture timestamp, as an ISO string.
+    :param error: The capture error, if any.
+    :param n_records: Number of treated records.
+    :param elapsed: API response time, in seconds.
+    :return: The record, with the columns of the `_logs` tables.
+    """
+    return {
+        "timestamp_captura": str(timestamp),
+        "sucesso": error is None,
+        "erro": None if error is None else str(error),
+        "n_registros": n_records,
+        "tempo_resposta": elapsed,
+    }
+
+
+class CaptureLogSink:
+    """
+    Buffer of capture log records, so the `_logs` tables get one bulk load
+    every `flush_interval` minutes instead of one append per capture.
+
+    The `redis` backend keeps records in a list shared by every run. The
+    `local` backend spools them to a JSON lines file in `spool_dir`, for
+    processes that run for long, like the GPS worker. Its interval is
+    counted per instance, so pipeline runs flush it when they finish.
+    """
+
+    def __init__(
+        self,
+        backend: str = "redis",
+        flush_interval: int = constants.CAPTURE_LOGS_FLUSH_INTERVAL.value,
+        spool_dir: str = None,
+    ):
+        if backend not in BACKENDS:
+            raise ValueError(f"Backend must be one of {BACKENDS}, got {backend}")
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.spool_dir = Path(spool_dir or Path(os.getenv("DATA_FOLDER", "data"), "logs"))
+        self._last_flush = {}
+
+    @staticmethod
+    def _key(dataset_id: str, table_id: str) -> str:
+        return f"capture_logs:{dataset_id}.{table_id}"
+
+    def _spool(self, dataset_id: str, table_id: str) -> Path:
+        return self.spool_dir / f"{dataset_id}.{table_id}.jsonl"
+
+    def record(self, dataset_id: str, table_id: str, records: list):
+        """Buffers log `records` of the `table_id` logs table"""
+        lines = [json.dumps(record, default=str) for record in records]
+        if not lines:
+            return
+        if self.backend == "redis":
+            get_redis().rpush(self._key(dataset_id, table_id), *lines)
+        else:
+            spool = self._spool(dataset_id, table_id)
+            spool.parent.mkdir(parents=True, exist_ok=True)
+            with spool.open("a") as f:
+                f.write("\n".join(lines) + "\n")
+
+    def due(self, dataset_id: str, table_id: str) -> bool:
+        """Whether the records of `table_id` should be flushed now. With the
+        `redis` backend, only one caller per interval gets True."""
+        if self.backend == "redis":
+            return bool(
+                get_redis().set(
+                    self._key(dataset_id, table_id) + ":flushed",
+                    1,
+                    nx=True,
+                    ex=self.flush_interval * constants.MINUTE.value,
+                )
+            )
+        key = self._key(dataset_id, table_id)
+        now = time.monotonic()
+        last_flush = self._last_flush.setdefault(key, now)
+        if now - last_flush >= self.flush_interval * constants.MINUTE.value:
+            self._last_flush[key] = now
+            return True
+        return False
+
+    def pop(self, dataset_id: str, table_id: str) -> pd.DataFrame:
+        """Removes and returns every buffered record of `table_id`"""
+        if self.backend == "redis":
+            pipe = get_redis().pipeline()
+            pipe.lrange(self._key(dataset_id, table_id), 0, -1)
+            pipe.delete(self._key(dataset_id, table_id))
+            lines, _ = pipe.execute()
+        else:
+            spool = self._spool(dataset_id, table_id)
+            if not spool.exists():
+                return pd.DataFrame(columns=LOG_COLUMNS)
+            # Records written while flushing go to a new spool file
+            flushing = spool.rename(spool.with_suffix(".flushing"))
+            lines = flushing.read_text().splitlines()
+            flushing.unlink()
+        df = pd.DataFrame([json.loads(line) for line in lines], columns=LOG_COLUMNS)
+        df["timestamp_captura"] = pd.to_datetime(df["timestamp_captura"])
+        # Records buffered before the column existed have no count
+        df["n_registros"] = df["n_registros"].astype("Int64")
+        return df
+
+    def restore(self, dataset_id: str, table_id: str, df: pd.DataFrame):
+        """Buffers popped records again, e.g. after a failed flush"""
+        df = df.assign(timestamp_captura=df["timestamp_captura"].map(lambda x: x.isoformat()))
+        df = df.astype(object).where(df.notna(), None)
+        self.record(dataset_id, table_id, df.to_dict("records"))
@@ -0,0 +1,109 @@
+"""
+Process-wide clients. Credentials, GCP clients, bucket handles and Redis
+connection pools are built on first use and reused by every caller in the
+process, instead of once per function call.
+"""
+import os
+import json
+import base64
+from functools import lru_cache
+
+from redis import Redis, ConnectionPool
+from redis_pal import RedisPal
+from google.oauth2 import service_account
+from google.cloud import storage, bigquery
+
+from repositories.helpers.constants import constants
+
+
+@lru_cache(maxsize=None)
+def get_credentials(mode: str = "prod") -> service_account.Credentials:
+    """Gets credentials from env vars, decoding them only once per mode"""
+    if mode not in ["prod", "staging"]:
+        raise ValueError("Mode must be 'prod' or 'staging'")
+    env: str = os.getenv(f"BASEDOSDADOS_CREDENTIALS_{mode.upper()}", "")
+    if env == "":
+        raise ValueError(
+            f"BASEDOSDADOS_CREDENTIALS_{mode.upper()} env var not set!")
+    info: dict = json.loads(base64.b64decode(env))
+    return service_account.Credentials.from_service_account_info(info)
+
+
+@lru_cache(maxsize=None)
+def get_storage_client(mode: str = "prod") -> storage.Client:
+    """Returns the Storage client of `mode`"""
+    return storage.Client(credentials=get_credentials(mode=mode))
+
+
+@lru_cache(maxsize=None)
+def get_bigquery_client(mode: str = "prod", project: str = None) -> bigquery.Client:
+    """Returns the BigQuery client of `mode`, billed to `project` if given"""
+    return bigquery.Client(project=project, credentials=get_credentials(mode=mode))
+
+
+@lru_cache(maxsize=None)
+def get_bigquery_write_client(mode: str = "prod"):
+    """Returns the BigQuery Storage Write API client of `mode`"""
+    try:
+        # Version 1, pinned by basedosdados, has no write client
+        from google.cloud.bigquery_storage_v1 import BigQueryWriteClient
+    except ImportError:
+        raise ImportError(
+            "The Storage Write API requires google-cloud-bigquery-storage>=2.9. "
+            "Install it with `pip install -r requirements-write-api.txt`")
+    return BigQueryWriteClient(credentials=get_credentials(mode=mode))
+
+
+@lru_cache(maxsize=None)
+def get_bucket(bucket_name: str, mode: str = "prod") -> storage.Bucket:
+    """Returns a handle to `bucket_name`, without fetching its metadata"""
+    return get_storage_client(mode=mode).bucket(bucket_name)
+
+
+@lru_cache(maxsize=None)
+def get_redis_pool(host: str = constants.REDIS_HOST.value) -> ConnectionPool:
+    """Returns the connection pool of the Redis server at `host`"""
+    return ConnectionPool(host=host)
+
+
+def get_redis(host: str = constants.REDIS_HOST.value) -> Redis:
+    """Returns a Redis client over the shared connection pool"""
+    return Redis(connection_pool=get_redis_pool(host))
+
+
+def get_redis_pal(host: str = constants.REDIS_HOST.value) -> RedisPal:
+    """Returns a RedisPal client over the shared connection pool"""
+    return RedisPal(connection_pool=get_redis_pool(host))
+
+
+class GCPClients:
+    """GCP clients shared by the whole process, used by the `gcp_clients` resource"""
+
+    def credentials(self, mode: str = "prod") -> service_account.Credentials:
+        return get_credentials(mode=mode)
+
+    def storage(self, mode: str = "prod") -> storage.Client:
+        return get_storage_client(mode=mode)
+
+    def bigquery(self, mode: str = "prod", project: str = None) -> bigquery.Client:
+        return get_bigquery_client(mode=mode, project=project)
+
+    def bucket(self, bucket_name: str, mode: str = "prod") -> storage.Bucket:
+        return get_bucket(bucket_name, mode=mode)
+
+
+class RedisClients:
+    """Redis clients over one shared connection pool, used by the `redis_client` resource"""
+
+    def __init__(self, host: str = constants.REDIS_HOST.value):
+        self.host = host
+
+    @property
+    def redis(self) -> Redis:
+        """Plain client, for Redlock and raw commands"""
+        return get_redis(self.host)
+
+    @property
+    def pal(self) -> RedisPal:
+        """RedisPal client, for serialized get/set"""
+        return get_redis_pal(self.host)
@@ -17,6 +17,9 @@ class constants(Enum):
     YEAR = 365 * DAY
     SECOND_TO_MS = 1000
 
+    # Timezone of the captures, used for naive DATETIME columns
+    TIMEZONE = getenv("TIMEZONE", "America/Sao_Paulo")
+
     REDIS_HOST = getenv("REDIS_HOST", "dagster-redis-master")
     REDIS_LOCK_AUTO_RELEASE_TIME = 12 * HOUR * SECOND_TO_MS
     REDIS_KEY_MAT_VIEWS_BLOBS_SET = "materialized_views_files_set"
@@ -35,9 +38,53 @@ class constants(Enum):
     MAESTRO_BQ_DEFAULT_BRANCH = "master"
     CRITICAL_DISCORD_WEBHOOK = getenv("CRITICAL_DISCORD_WEBHOOK", "")
     SIGMOB_GET_REQUESTS_TIMEOUT = 3600  # 1 hour
-    SIGMOB_PAGES_FOR_CSV_FILE = 10
+    SIGMOB_MAX_FILE_BYTES = 100 * 1024 * 1024  # 100 MB
+    SIGMOB_MAX_CONCURRENT_ENDPOINTS = 4
+    SIGMOB_ENDPOINT_MAX_RETRIES = 3
+    SIGMOB_ENDPOINT_RETRY_DELAY = 5 * SECOND
 
     MATERIALIZED_VIEWS_UPDATE_SENSOR_MIN_INTERVAL = 1 * MINUTE
     MATERIALIZED_VIEWS_EXECUTE_SENSOR_MIN_INTERVAL = 5 * MINUTE
 
     CAPTURA_GET_TIMEOUT = 1 * MINUTE
+
+    HTTP_POOL_MAXSIZE = 10
+    HTTP_MAX_RETRIES = 3
+    HTTP_BACKOFF_FACTOR = 1 * SECOND
+    HTTP_RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+    # GPS pings are remembered for a few captures to drop repeated ones
+    GPS_DEDUP_TTL = 5 * MINUTE
+    GPS_DEDUP_MAXSIZE = 200000
+
+    # Minutes between two bulk loads of the capture logs
+    CAPTURE_LOGS_FLUSH_INTERVAL = 10
+
+    # Existing tables are cached in Redis, so BigQuery is not asked every run
+    TABLE_STATE_TTL = 1 * HOUR
+
+    # Independent blobs are uploaded concurrently, retrying transient errors
+    UPLOAD_MAX_WORKERS = 8
+    UPLOAD_MAX_RETRIES = 3
+    UPLOAD_BACKOFF_FACTOR = 1 * SECOND
+
+    # Larger dataframes are streamed to GCS in chunks of this many rows
+    UPLOAD_CHUNK_ROWS = 100000
+
+    # Large CSV files are read and treated this many rows at a time
+    CSV_CHUNK_ROWS = 50000
+
+    # FTPS sessions kept open, and so concurrent transfers, per process
+    FTP_MAX_SESSIONS = 4
+    FTP_MAX_RETRIES = 3
+
+    # Streamed files are kept in memory up to this size, then spill to disk
+    STREAM_BUFFER_MAX_BYTES = 64 * 1024 * 1024  # 64 MB
+
+    # Per-stage capture metrics: textfile (Prometheus), redis (RedisTimeSeries) or none
+    METRICS_BACKEND = getenv("METRICS_BACKEND", "none")
+    METRICS_TEXTFILE_DIR = getenv("METRICS_TEXTFILE_DIR", "/var/lib/node_exporter/textfile")
+    METRICS_RETENTION = 7 * DAY
+
+    # Appends to the Storage Write API are limited to 10 MB per request
+    WRITE_API_MAX_REQUEST_BYTES = 9 * 1024 * 1024
@@ -0,0 +1,139 @@
+import time
+from collections import OrderedDict
+
+import pandas as pd
+from redis.exceptions import RedisError
+
+from repositories.helpers.clients import get_redis
+from repositories.helpers.constants import constants
+from repositories.helpers.logging import logger
+
+BACKENDS = ["redis", "local"]
+
+
+def build_keys(df: pd.DataFrame, key_columns: list, namespace: str) -> pd.Series:
+    """
+    Builds the index key of every row, e.g. `br_rj_riodejaneiro_onibus_gps:A12345:1625000000000000000`.
+    :param df: The dataframe with GPS records.
+    :param key_columns: Columns identifying a ping, usually the vehicle and the GPS timestamp.
+    :param namespace: Prefix of the keys, usually the dataset_id.
+    :return: A Series of keys, aligned with `df`.
+    """
+    keys = pd.Series(namespace, index=df.index)
+    for column in key_columns:
+        values = df[column]
+        if pd.api.types.is_datetime64_any_dtype(values):
+            # Epoch in ns, so the same instant always has the same key
+            values = values.astype("int64")
+        keys = keys + ":" + values.astype(str)
+    return keys
+
+
+class GPSDedupIndex:
+    """
+    Index of the GPS pings ingested in the last `ttl` seconds, used to drop
+    pings the APIs repeat in consecutive captures.
+
+    The `redis` backend is shared by every process, so it works across
+    pipeline runs. The `local` backend keeps up to `maxsize` keys in memory,
+    evicting the oldest first, so it only helps processes that capture many
+    times, like the GPS worker.
+    """
+
+    def __init__(
+        self,
+        key_columns: list,
+        backend: str = "redis",
+        ttl: int = constants.GPS_DEDUP_TTL.value,
+        maxsize: int = constants.GPS_DEDUP_MAXSIZE.value,
+        enabled: bool = True,
+    ):
+        if backend not in BACKENDS:
+            raise ValueError(f"Backend must be one of {BACKENDS}, got {backend}")
+        self.key_columns = key_columns
+        self.backend = backend
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.enabled = enabled
+        self._seen = OrderedDict()
+
+    def _contains_redis(self, keys: list) -> list:
+        pipe = get_redis().pipeline(transaction=False)
+        for key in keys:
+            pipe.exists(f"gps_dedup:{key}")
+        return [bool(found) for found in pipe.execute()]
+
+    def _contains_local(self, keys: list) -> list:
+        now = time.monotonic()
+        return [self._seen.get(key, 0) > now for key in keys]
+
+    def _mark_redis(self, keys: list):
+        pipe = get_redis().pipeline(transaction=False)
+        for key in keys:
+            pipe.set(f"gps_dedup:{key}", 1, ex=self.ttl)
+        pipe.execute()
+
+    def _mark_local(self, keys: list):
+        expires = time.monotonic() + self.ttl
+        for key in keys:
+            self._seen[key] = expires
+            self._seen.move_to_end(key)
+        while len(self._seen) > self.maxsize:
+            self._seen.popitem(last=False)
+
+    def contains(self, keys: list) -> list:
+        """
+        Checks `keys` against the index, without adding them.
+        :param keys: The keys to check.
+        :return: For each key, whether it is in the index.
+        """
+        if self.backend == "redis":
+            return self._contains_redis(keys)
+        return self._contains_local(keys)
+
+    def mark(self, keys: list):
+        """
+        Adds `keys` to the index.
+        :param keys: The keys to add.
+        """
+        if self.backend == "redis":
+            self._mark_redis(keys)
+        else:
+            self._mark_local(keys)
+
+    def drop_ingested(self, df: pd.DataFrame, namespace: str):
+        """
+        Drops the rows of `df` already ingested. Repeated rows within `df` are
+        also dropped. Rows are only added to the index by `mark_ingested`, once
+        they are written, so a failed upload does not lose them. If Redis is
+        unavailable, nothing is dropped, since downstream queries tolerate duplicates.
+        :param df: The dataframe with GPS records.
+        :param namespace: Prefix of the keys, usually the dataset_id.
+        :return: The deduplicated dataframe and the number of dropped rows.
+        """
+        if not self.enabled or df.empty:
+            return df, 0
+        keys = build_keys(df, self.key_columns, namespace)
+        try:
+            ingested = pd.Series(self.contains(keys.tolist()), index=df.index)
+        except RedisError as e:
+            logger.warning(f"Could not deduplicate {namespace}, keeping every row: {e}")
+            return df, 0
+        mask = ~ingested & ~keys.duplicated()
+        return df[mask], int((~mask).sum())
+
+    def mark_ingested(self, df: pd.DataFrame, namespace: str):
+        """
+        Adds the rows of `df` to the index. Call it only after they are written.
+        If Redis is unavailable, the rows are not marked and may be ingested
+        again by the next capture.
+        :param df: The dataframe with GPS records.
+        :param namespace: Prefix of the keys, usually the dataset_id.
+        """
+        if not self.enabled or df is None or df.empty:
+            return
+        keys = build_keys(df, self.key_columns, namespace)
+        try:
+            self.mark(keys.unique().tolist())
+        except RedisError as e:
+            logger.warning(f"Could not mark {namespace} records as ingested: {e}")
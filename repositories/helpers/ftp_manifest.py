@@ -0,0 +1,65 @@
+"""
+Index of the files already processed from an FTP server, kept in Redis so
+discovery does not depend on when files land. A file is identified by its
+path, size and modify time, so files re-uploaded with new content are
+processed again.
+"""
+from redis.exceptions import RedisError
+
+from repositories.helpers.clients import get_redis
+from repositories.helpers.logging import logger
+
+
+def file_version(facts: dict) -> str:
+    """Identifies the content of a file from its MLSD facts"""
+    return f"{facts.get('size', '')}:{facts.get('modify', '')}"
+
+
+class FTPManifest:
+    """
+    Files processed from an FTP server, in the Redis hash `ftp_manifest:<name>`
+    mapping each path to its version.
+
+    Usage:
+        manifest = FTPManifest("rdo")
+        for path, facts in manifest.diff(listing).items():
+            process(path)
+            manifest.record(path, facts)
+    """
+
+    def __init__(self, name: str):
+        self.key = f"ftp_manifest:{name}"
+
+    def is_empty(self) -> bool:
+        return not get_redis().exists(self.key)
+
+    def diff(self, listing: dict) -> dict:
+        """
+        Compares a listing with the manifest.
+        :param listing: MLSD facts of each file, keyed by path.
+        :return: The files of `listing` that are new or changed.
+        """
+        if not listing:
+            return {}
+        paths = list(listing.keys())
+        versions = get_redis().hmget(self.key, paths)
+        return {
+            path: listing[path]
+            for path, version in zip(paths, versions)
+            if version is None or version.decode() != file_version(listing[path])
+        }
+
+    def record(self, path: str, facts: dict):
+        """Records that `path` was processed. Failures are only logged, the
+        file is processed again on the next run."""
+        try:
+            get_redis().hset(self.key, path, file_version(facts))
+        except RedisError as e:
+            logger.warning(f"Could not record {path} in {self.key}: {e}")
+
+    def record_many(self, listing: dict):
+        """Records every file of `listing`, e.g. to seed a new manifest"""
+        if listing:
+            get_redis().hset(
+                self.key, mapping={path: file_version(facts) for path, facts in listing.items()}
+            )
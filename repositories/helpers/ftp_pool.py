@@ -0,0 +1,115 @@
+import ftplib
+import threading
+from contextlib import contextmanager
+
+from repositories.helpers.constants import constants
+from repositories.helpers.io import connect_ftp
+from repositories.helpers.logging import logger
+
+
+class _CallbackError(Exception):
+    """Wraps errors raised by a transfer callback, which are not retried"""
+
+
+class FTPSessionPool:
+    """
+    Logged in FTPS sessions shared by the solids of a run, so the implicit
+    TLS handshake and login are done once per session instead of once per
+    file. At most `max_sessions` sessions exist at once, which also bounds
+    the parallel transfers.
+
+    Usage:
+        pool = FTPSessionPool(host, username, password)
+        with pool.session() as ftp_client:
+            ftp_client.mlsd("SPPO")
+        pool.retrieve("SPPO/file.csv", f.write)
+        pool.close()
+    """
+
+    def __init__(
+        self,
+        host: str,
+        username: str,
+        password: str,
+        max_sessions: int = constants.FTP_MAX_SESSIONS.value,
+        max_retries: int = constants.FTP_MAX_RETRIES.value,
+        log=logger,
+    ):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.max_retries = max_retries
+        self.log = log
+        self._semaphore = threading.BoundedSemaphore(max_sessions)
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def _acquire_client(self):
+        while True:
+            with self._lock:
+                client = self._idle.pop() if self._idle else None
+            if client is None:
+                return connect_ftp(self.host, self.username, self.password)
+            try:
+                # Servers drop idle sessions, so check it is still alive
+                client.voidcmd("NOOP")
+                return client
+            except ftplib.all_errors:
+                client.close()
+
+    @contextmanager
+    def session(self):
+        """Yields a logged in session, waiting if `max_sessions` are in use. The
+        session is discarded if the block raises, since its state is unknown."""
+        with self._semaphore:
+            client = self._acquire_client()
+            try:
+                yield client
+            except BaseException:
+                client.close()
+                raise
+            with self._lock:
+                self._idle.append(client)
+
+    def retrieve(self, ftp_path: str, callback) -> int:
+        """
+        Downloads a file, calling `callback` with each chunk. If the transfer
+        fails, it is resumed with REST from the last byte received, in a new
+        session, up to `max_retries` times.
+        :param ftp_path: Path of the file on the server.
+        :param callback: Function that takes each chunk, in order.
+        :return: The number of bytes received.
+        """
+        offset = 0
+
+        def write(chunk):
+            nonlocal offset
+            try:
+                callback(chunk)
+            except Exception as e:
+                raise _CallbackError() from e
+            offset += len(chunk)
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.session() as client:
+                    client.retrbinary("RETR " + ftp_path, write, rest=offset or None)
+                return offset
+            except _CallbackError as e:
+                raise e.__cause__
+            except ftplib.all_errors as e:
+                if attempt == self.max_retries:
+                    raise
+                self.log.warning(
+                    f"Transfer of {ftp_path} failed at byte {offset} ({e}), resuming"
+                )
+
+    def close(self):
+        """Ends the idle sessions"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for client in idle:
+            try:
+                client.quit()
+            except ftplib.all_errors:
+                client.close()
@@ -0,0 +1,109 @@
+from datetime import timedelta
+
+import pandas as pd
+
+
+def epoch_to_datetime(
+    values, timezone: str, unit: str = "ms", fill_value: float = None
+) -> pd.Series:
+    """
+    Converts epoch timestamps to timezone-aware datetimes.
+    :param values: Epoch timestamps. Values that can't be parsed become NaT.
+    :param timezone: Timezone of the converted datetimes.
+    :param unit: Unit of the epoch timestamps. Default is "ms".
+    :param fill_value: Value used for timestamps that can't be parsed. Default is None.
+    :return: A Series of datetimes in `timezone`.
+    """
+    values = pd.to_numeric(pd.Series(values), errors="coerce")
+    if fill_value is not None:
+        values = values.fillna(fill_value)
+    return pd.to_datetime(values, unit=unit, utc=True).dt.tz_convert(timezone)
+
+
+def compute_lag(df: pd.DataFrame, timestamp_col: str, capture_col: str = "timestamp_captura") -> pd.Series:
+    """
+    Computes how long before the capture each GPS record was emitted.
+    :param df: The dataframe with GPS records.
+    :param timestamp_col: Column with the GPS timestamp.
+    :param capture_col: Column with the capture timestamp. Default is "timestamp_captura".
+    :return: A Series of timedeltas.
+    """
+    return df[capture_col] - df[timestamp_col]
+
+
+def filter_by_lag(
+    df: pd.DataFrame,
+    timestamp_col: str,
+    capture_col: str = "timestamp_captura",
+    min_lag: timedelta = timedelta(seconds=0),
+    max_lag: timedelta = timedelta(minutes=1),
+) -> pd.DataFrame:
+    """
+    Keeps GPS records emitted between `min_lag` and `max_lag` before the capture.
+    :param df: The dataframe with GPS records.
+    :param timestamp_col: Column with the GPS timestamp.
+    :param capture_col: Column with the capture timestamp. Default is "timestamp_captura".
+    :param min_lag: Minimum lag, inclusive. Default is 0 seconds.
+    :param max_lag: Maximum lag, inclusive. Default is 1 minute.
+    :return: The filtered dataframe.
+    """
+    lag = compute_lag(df, timestamp_col, capture_col)
+    return df[(lag >= min_lag) & (lag <= max_lag)]
+
+
+def normalize_gps(
+    df: pd.DataFrame,
+    timestamp_col: str,
+    timestamp_captura,
+    timezone: str,
+    unit: str = "ms",
+    fill_value: float = None,
+) -> pd.DataFrame:
+    """
+    Converts the GPS epoch column and the capture timestamp to `timezone`
+    and keeps only records emitted up to 1 minute before the capture.
+    :param df: The dataframe with GPS records.
+    :param timestamp_col: Column with the GPS epoch timestamp.
+    :param timestamp_captura: Capture timestamp, as a string or datetime.
+    :param timezone: Timezone of the treated data.
+    :param unit: Unit of the epoch timestamps. Default is "ms".
+    :param fill_value: Value used for timestamps that can't be parsed. Default is None.
+    :return: The treated dataframe.
+    """
+    df[timestamp_col] = epoch_to_datetime(
+        df[timestamp_col], timezone, unit=unit, fill_value=fill_value
+    )
+    timestamp_captura = pd.Timestamp(timestamp_captura)
+    if timestamp_captura.tzinfo is None:
+        timestamp_captura = timestamp_captura.tz_localize(timezone)
+    df["timestamp_captura"] = timestamp_captura.tz_convert(timezone)
+    return filter_by_lag(df, timestamp_col)
+
+
+def rename_fields(records, mapping: dict) -> pd.DataFrame:
+    """
+    Builds a dataframe from API records keeping only the fields in `mapping`,
+    renamed to the project names. Fields missing from every record become
+    empty columns.
+    :param records: List of dicts, as decoded from the API response.
+    :param mapping: Mapping of API field names to project column names.
+    :return: The dataframe, with columns in the mapping order.
+    """
+    df = pd.DataFrame.from_records(records) if len(records) else pd.DataFrame()
+    return df.reindex(columns=list(mapping.keys())).rename(columns=mapping)
+
+
+def to_json_column(df: pd.DataFrame, columns: list = None) -> pd.Series:
+    """
+    Serializes each row of `df` as a JSON object, in a single vectorized pass.
+    :param df: The dataframe to serialize.
+    :param columns: Columns to include. Default is all.
+    :return: A Series of JSON strings, aligned with `df`.
+    """
+    df = df if columns is None else df[columns]
+    if df.empty:
+        return pd.Series([], index=df.index, dtype=object)
+    # Not splitlines, which also splits at unicode line breaks inside values
+    lines = df.to_json(orient="records", lines=True, force_ascii=False)
+    lines = lines.rstrip("\n").split("\n")
+    return pd.Series(lines, index=df.index)
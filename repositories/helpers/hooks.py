@@ -7,12 +7,15 @@ from pathlib import Path
 import shutil
 import pandas as pd
 from croniter import croniter
-from redis import Redis
-from redis_pal import RedisPal
 from discord import Webhook, File, RequestsWebhookAdapter
 from dagster import success_hook, failure_hook, HookContext
+from repositories.helpers.clients import get_redis_pal
 from repositories.helpers.constants import constants
 from repositories.helpers.io import decode_str
+from repositories.helpers.logging import logger
+
+# Turned off by processes that reprocess past data, e.g. the GPS replay
+_critical_alerts = {"enabled": True}
 
 
 def post_message_to_discord(message, url):
@@ -20,9 +23,17 @@ def post_message_to_discord(message, url):
 
 
 def log_critical(message):
+    if not _critical_alerts["enabled"]:
+        logger.warning(message)
+        return
     post_message_to_discord(message, constants.CRITICAL_DISCORD_WEBHOOK.value)
 
 
+def disable_critical_alerts():
+    """Makes `log_critical` only log locally, in the current process"""
+    _critical_alerts["enabled"] = False
+
+
 def post_to_discord_v2(url, username=None, message=None, filename=None):
     ### Todas as classes referenciadas, são classes do Discord (Webhook, RequestsWebhookAdapter e File)
     webhook = Webhook.from_url(url=url, adapter=RequestsWebhookAdapter())
@@ -56,13 +67,13 @@ def discord_message_on_failure(context: HookContext):
 
 @success_hook(required_resource_keys={"keepalive_key"})
 def redis_keepalive_on_succes(context: HookContext):
-    rp = RedisPal(host=constants.REDIS_HOST.value)
+    rp = get_redis_pal()
     rp.set(context.resources.keepalive_key["key"], 1)
 
 
 @failure_hook(required_resource_keys={"discord_webhook", "keepalive_key"})
 def redis_keepalive_on_failure(context: HookContext):
-    rp = RedisPal(host=constants.REDIS_HOST.value)
+    rp = get_redis_pal()
     rp.set(context.resources.keepalive_key["key"], 1)
     message = f"Although solid {context.solid.name} has failed, a keep-alive was sent to Redis!"
     url = context.resources.discord_webhook["url"]
@@ -0,0 +1,96 @@
+import time
+import random
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from repositories.helpers.constants import constants
+from repositories.helpers.logging import logger
+
+# Sessions are shared by every client in the process, keyed by pool size
+_SESSIONS = {}
+
+
+def get_session(pool_maxsize: int = constants.HTTP_POOL_MAXSIZE.value) -> requests.Session:
+    """
+    Gets the process-wide session, so connections (and TLS sessions) are
+    kept alive between requests.
+    :param pool_maxsize: Maximum number of connections kept per host.
+    :return: The shared session.
+    """
+    if pool_maxsize not in _SESSIONS:
+        session = requests.Session()
+        # Retries are handled by HTTPClient, so the adapter never retries
+        adapter = HTTPAdapter(
+            pool_connections=pool_maxsize, pool_maxsize=pool_maxsize, max_retries=0
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update({"Accept-Encoding": "gzip, deflate"})
+        _SESSIONS[pool_maxsize] = session
+    return _SESSIONS[pool_maxsize]
+
+
+class HTTPClient:
+    """
+    HTTP client over the process-wide session, retrying timeouts, connection
+    errors and `retry_statuses` with jittered exponential backoff.
+    """
+
+    def __init__(
+        self,
+        timeout: float = constants.CAPTURA_GET_TIMEOUT.value,
+        max_retries: int = constants.HTTP_MAX_RETRIES.value,
+        backoff_factor: float = constants.HTTP_BACKOFF_FACTOR.value,
+        retry_statuses: list = constants.HTTP_RETRY_STATUSES.value,
+        pool_maxsize: int = constants.HTTP_POOL_MAXSIZE.value,
+        log=logger,
+    ):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.retry_statuses = retry_statuses
+        self.session = get_session(pool_maxsize)
+        self.log = log
+
+    def backoff(self, attempt: int) -> float:
+        """Seconds to wait before retrying, with full jitter"""
+        return random.uniform(0, self.backoff_factor * 2 ** attempt)
+
+    def request(self, method: str, url: str, max_retries: int = None, **kwargs) -> requests.Response:
+        """
+        Sends a request, retrying it on failure.
+        :param method: HTTP method.
+        :param url: Request URL.
+        :param max_retries: Retries for this request. Default is the client's.
+        :param kwargs: Passed to `requests.Session.request`.
+        :return: The last response. Responses with `retry_statuses` are returned
+        once retries are exhausted; connection errors and timeouts are raised.
+        """
+        max_retries = self.max_retries if max_retries is None else max_retries
+        kwargs.setdefault("timeout", self.timeout)
+        # Query strings may carry API keys, so they are not logged
+        endpoint = urlsplit(url)._replace(query="").geturl()
+        for attempt in range(max_retries + 1):
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt == max_retries:
+                    raise
+                self.log.warning(f"{method} {endpoint} failed ({e}), retrying")
+            else:
+                self.log.info(
+                    f"{method} {endpoint} - Status: {response.status_code} - "
+                    f"Time: {time.perf_counter() - start:.3f}s - Attempt: {attempt + 1}"
+                )
+                if response.status_code not in self.retry_statuses or attempt == max_retries:
+                    return response
+            time.sleep(self.backoff(attempt))
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
@@ -18,4 +18,13 @@ class ImplicitFTP_TLS(ftplib.FTP_TLS):
         """When modifying the socket, ensure that it is ssl wrapped."""
         if value is not None and not isinstance(value, ssl.SSLSocket):
             value = self.context.wrap_socket(value)
-        self._sock = value
\ No newline at end of file
+        self._sock = value
+
+    def ntransfercmd(self, cmd, rest=None):
+        """Opens the data connection, resuming the TLS session of the control
+        connection. Saves a full handshake per transfer, and servers that
+        require session reuse on PROT P refuse data connections otherwise."""
+        conn, size = ftplib.FTP.ntransfercmd(self, cmd, rest)
+        if self._prot_p:
+            conn = self.context.wrap_socket(conn, session=self.sock.session)
+        return conn, size
@@ -21,6 +21,7 @@ from google.api_core.exceptions import Conflict
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
+from repositories.helpers import clients
 from repositories.helpers.constants import constants
 from repositories.helpers.implicit_ftp import ImplicitFTP_TLS
 from repositories.helpers.datetime import convert_datetime_to_datetime_string
@@ -29,9 +30,8 @@ def decode_str(string):
     return base64.b64decode(string).decode('utf-8')
     
 def get_bigquery_client() -> bigquery.Client:
-    """Returns a BigQuery client"""
-    credentials = get_credentials_from_env()
-    return bigquery.Client(project=os.getenv("BQ_PROJECT_NAME"), credentials=credentials)
+    """Returns the shared BigQuery client"""
+    return clients.get_bigquery_client(project=os.getenv("BQ_PROJECT_NAME"))
 
 
 def test_query(query: str) -> Union[None, str]:
@@ -86,21 +86,13 @@ def get_session_builder() -> sessionmaker:
 
 
 def get_credentials_from_env(mode: str = "prod") -> service_account.Credentials:
-    """Gets credentials from env vars"""
-    if mode not in ["prod", "staging"]:
-        raise ValueError("Mode must be 'prod' or 'staging'")
-    env: str = os.getenv(f"BASEDOSDADOS_CREDENTIALS_{mode.upper()}", "")
-    if env == "":
-        raise ValueError(
-            f"BASEDOSDADOS_CREDENTIALS_{mode.upper()} env var not set!")
-    info: dict = json.loads(base64.b64decode(env))
-    return service_account.Credentials.from_service_account_info(info)
+    """Gets credentials from env vars, cached for the whole process"""
+    return clients.get_credentials(mode=mode)
 
 
 def get_list_of_blobs(prefix: str, bucket_name: str, mode: str = "prod") -> list:
     """Gets list of blobs from `bucket_name` with `prefix`, which can be a path"""
-    credentials = get_credentials_from_env(mode=mode)
-    client = storage.Client(credentials=credentials)
+    client = clients.get_storage_client(mode=mode)
     l: list = client.list_blobs(bucket_name, prefix=prefix)
     l = [blob for blob in l if not blob.name.endswith("/")]
     return l
@@ -108,9 +100,8 @@ def get_list_of_blobs(prefix: str, bucket_name: str, mode: str = "prod") -> list
 
 def get_blob(name: str, bucket_name: str, mode: str = "prod") -> Blob:
     """Gets a single blob from `bucket_name`"""
-    credentials = get_credentials_from_env(mode=mode)
-    client = storage.Client(credentials=credentials)
-    bucket = client.get_bucket(bucket_name)
+    # The bucket handle is not fetched, only the blob is
+    bucket = clients.get_bucket(bucket_name, mode=mode)
     return bucket.get_blob(name)
 
 
@@ -212,9 +203,8 @@ def update_view(table_name: str, defaults_dict: dict, dataset_name: str, view_na
     if table_name is None or table_name == "":
         raise Exception("Table name can't be None or empty!")
 
-    # Setup credentials and BQ client
-    credentials = get_credentials_from_env()
-    client = bigquery.Client(credentials=credentials)
+    # Setup BQ client
+    client = clients.get_bigquery_client()
 
     # Delete
     if (delete):
@@ -0,0 +1,130 @@
+"""
+Per-stage metrics of the captures: duration, payload bytes and row counts.
+
+Each stage (request, treatment, uploads, table checks...) is measured with
+`get_metrics().stage(...)` and exported as soon as it ends, so pipelines
+that run their solids in separate processes need no coordination:
+
+    with get_metrics().stage(dataset_id, table_id, "request") as measure:
+        data = request()
+        measure["bytes"] = data.size
+
+The backend is set by the METRICS_BACKEND env var: `textfile` writes one
+Prometheus file per stage to METRICS_TEXTFILE_DIR, for the node exporter
+textfile collector; `redis` adds samples to RedisTimeSeries keys; `none`
+(the default) disables metrics.
+"""
+import os
+import time
+import tempfile
+from pathlib import Path
+from functools import lru_cache
+from contextlib import contextmanager
+
+from repositories.helpers.clients import get_redis
+from repositories.helpers.constants import constants
+from repositories.helpers.logging import logger
+
+BACKENDS = ["textfile", "redis", "none"]
+
+# Exported fields of a stage and their descriptions
+FIELDS = {
+    "seconds": "Duration of the stage",
+    "bytes": "Payload bytes handled by the stage",
+    "rows": "Rows handled by the stage",
+    "success": "Whether the stage finished without errors",
+    "timestamp_seconds": "When the stage finished, as a Unix timestamp",
+}
+
+PREFIX = "maestro_capture"
+
+
+class CaptureMetrics:
+    """Measures capture stages and exports them to `backend`"""
+
+    def __init__(
+        self,
+        backend: str = constants.METRICS_BACKEND.value,
+        textfile_dir: str = constants.METRICS_TEXTFILE_DIR.value,
+        retention: int = constants.METRICS_RETENTION.value,
+    ):
+        if backend not in BACKENDS:
+            raise ValueError(f"Backend must be one of {BACKENDS}, got {backend}")
+        self.backend = backend
+        self.textfile_dir = Path(textfile_dir)
+        self.retention = retention
+
+    @contextmanager
+    def stage(self, dataset_id: str, table_id: str, stage: str):
+        """
+        Measures the duration of a stage, exporting it when the block exits,
+        even if it raises. Set `bytes` and `rows` in the yielded dict to export
+        them, and `success` to 0 for errors handled within the block.
+        """
+        measure = {}
+        start = time.perf_counter()
+        success = False
+        try:
+            yield measure
+            success = True
+        finally:
+            measure["seconds"] = time.perf_counter() - start
+            measure["success"] = int(success and measure.get("success", 1))
+            measure["timestamp_seconds"] = time.time()
+            self.export(dataset_id, table_id, stage, measure)
+
+    def export(self, dataset_id: str, table_id: str, stage: str, measure: dict):
+        """Exports the fields of a stage. Failures are only logged, metrics
+        never interrupt a capture."""
+        if self.backend == "none":
+            return
+        labels = {"dataset_id": dataset_id, "table_id": table_id, "stage": stage}
+        try:
+            values = {
+                field: measure[field] for field in FIELDS if measure.get(field) is not None
+            }
+            if self.backend == "textfile":
+                self._export_textfile(labels, values)
+            else:
+                self._export_redis(labels, values)
+        except Exception as e:
+            logger.warning(f"Could not export metrics of {dataset_id}.{table_id} {stage}: {e}")
+
+    def _export_textfile(self, labels: dict, values: dict):
+        label_str = ",".join(f'{key}="{value}"' for key, value in labels.items())
+        lines = []
+        for field, value in values.items():
+            lines.append(f"# HELP {PREFIX}_{field} {FIELDS[field]}")
+            lines.append(f"# TYPE {PREFIX}_{field} gauge")
+            lines.append(f"{PREFIX}_{field}{{{label_str}}} {value}")
+        self.textfile_dir.mkdir(parents=True, exist_ok=True)
+        path = self.textfile_dir / (
+            f"{PREFIX}_{labels['dataset_id']}_{labels['table_id']}_{labels['stage']}.prom"
+        )
+        # The collector must never read a partially written file
+        fd, tmp_path = tempfile.mkstemp(dir=self.textfile_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+    def _export_redis(self, labels: dict, values: dict):
+        pipe = get_redis().pipeline(transaction=False)
+        timestamp_ms = int(values["timestamp_seconds"] * constants.SECOND_TO_MS.value)
+        for field, value in values.items():
+            if field == "timestamp_seconds":
+                continue
+            key = f"{PREFIX}:{labels['dataset_id']}.{labels['table_id']}:{labels['stage']}:{field}"
+            label_args = [item for key_value in labels.items() for item in key_value]
+            pipe.execute_command(
+                "TS.ADD", key, timestamp_ms, value,
+                "RETENTION", self.retention * constants.SECOND_TO_MS.value,
+                "ON_DUPLICATE", "LAST",
+                "LABELS", *label_args, "field", field,
+            )
+        pipe.execute()
+
+
+@lru_cache(maxsize=None)
+def get_metrics() -> CaptureMetrics:
+    """Returns the process-wide metrics, configured by env vars"""
+    return CaptureMetrics()
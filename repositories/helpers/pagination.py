@@ -0,0 +1,77 @@
+import os
+import json
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+
+def prefetch_pages(fetch, url, get_next):
+    """
+    Iterates over the pages of a paginated API, fetching the next page in a
+    background thread while the caller processes the current one. At most two
+    pages are held in memory at once.
+    :param fetch: Function that takes a URL and returns the decoded page.
+    :param url: URL of the first page.
+    :param get_next: Function that takes a page and returns the next URL, or None.
+    :return: A generator of (url, page) tuples.
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(fetch, url)
+        while future is not None:
+            page = future.result()
+            next_url = get_next(page)
+            current_url, url = url, next_url
+            future = executor.submit(fetch, next_url) if next_url else None
+            yield current_url, page
+
+
+class PaginationCheckpoint:
+    """
+    Progress of a paginated request, saved as a JSON file next to the data:
+    the URL of the next page to fetch and the files completed so far. A
+    retry, or a new run writing to the same folder, resumes from it instead
+    of fetching every page again.
+
+    Usage:
+        checkpoint = PaginationCheckpoint("data/_checkpoints/endpoint.json")
+        state = checkpoint.load()  # None if there is nothing to resume
+        checkpoint.save(next_url, paths)
+        checkpoint.save(None, paths, done=True)
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def load(self) -> dict:
+        """
+        Loads the saved progress.
+        :return: A dict with `next_url`, `paths` and `done`, or None if no
+        progress was saved or any of its files is missing.
+        """
+        if not self.path.exists():
+            return None
+        state = json.loads(self.path.read_text())
+        state["paths"] = [Path(path) for path in state["paths"]]
+        if not all(path.exists() for path in state["paths"]):
+            return None
+        return state
+
+    def save(self, next_url: str, paths: list, done: bool = False, **extra):
+        """
+        Saves the progress, replacing the previous one atomically.
+        :param next_url: URL of the first page not in `paths`.
+        :param paths: Files completed so far.
+        :param done: Whether every page was fetched.
+        :param extra: Other JSON serializable values to keep, returned by `load`.
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        state = {
+            **extra,
+            "next_url": next_url,
+            "paths": [str(path) for path in paths],
+            "done": done,
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=self.path.parent, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,61 @@
+import json
+
+from repositories.helpers.serialization import read_raw
+
+
+class RawPayload:
+    """
+    Raw content of an API response, decoded at most once.
+
+    Only the raw bytes and the response metadata are pickled when the payload
+    is passed between solids, the decoded records are cached on first access.
+    """
+
+    def __init__(self, content: bytes = b"", status_code: int = 200, elapsed: float = None):
+        self.content = content
+        self.status_code = status_code
+        self.elapsed = elapsed
+        self._records = None
+        self._decoded = False
+
+    @classmethod
+    def from_response(cls, response):
+        """Builds a payload from a `requests.Response`"""
+        return cls(
+            content=response.content,
+            status_code=response.status_code,
+            elapsed=response.elapsed.total_seconds(),
+        )
+
+    @classmethod
+    def from_file(cls, file_path):
+        """Builds a payload from a saved raw file, compressed or not"""
+        return cls(content=read_raw(file_path))
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code is not None and self.status_code < 400
+
+    @property
+    def size(self) -> int:
+        return len(self.content)
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8")
+
+    def json(self):
+        """Returns the decoded records, parsing the raw content only once"""
+        if not self._decoded:
+            self._records = json.loads(self.content)
+            self._decoded = True
+        return self._records
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_records"] = None
+        state["_decoded"] = False
+        return state
+
+    def __repr__(self):
+        return f"RawPayload(status_code={self.status_code}, size={self.size})"
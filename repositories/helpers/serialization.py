@@ -0,0 +1,350 @@
+import io
+import gzip
+import json
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from repositories.helpers.constants import constants
+
+FILE_FORMATS = ["csv", "parquet"]
+
+# Codecs for raw payloads, with the suffix appended to the file name. The
+# codec name is also the `Content-Encoding` of the uploaded blob.
+RAW_COMPRESSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+# Leading bytes of each compressed stream, used when reading raw files back
+_RAW_MAGIC = {"gzip": b"\x1f\x8b", "zstd": b"\x28\xb5\x2f\xfd"}
+
+# BigQuery column types accepted in table schemas and their Arrow equivalents
+ARROW_TYPES = {
+    "STRING": pa.string(),
+    "INT64": pa.int64(),
+    "FLOAT64": pa.float64(),
+    "NUMERIC": pa.float64(),
+    "BOOL": pa.bool_(),
+    "DATE": pa.date32(),
+    "DATETIME": pa.timestamp("us"),
+    "TIMESTAMP": pa.timestamp("us", tz="UTC"),
+}
+
+
+def check_file_format(file_format: str):
+    if file_format not in FILE_FORMATS:
+        raise ValueError(
+            f"File format must be one of {FILE_FORMATS}, got {file_format}")
+
+
+def build_arrow_schema(schema: dict) -> pa.Schema:
+    """
+    Builds an Arrow schema from a mapping of column names to BigQuery types.
+    :param schema: Mapping of column names to BigQuery types, e.g. {"linha": "STRING"}.
+    :return: The Arrow schema, with columns in the mapping order.
+    """
+    fields = []
+    for name, bq_type in schema.items():
+        if bq_type.upper() not in ARROW_TYPES:
+            raise ValueError(
+                f"Type {bq_type} of column {name} is not supported. "
+                f"Use one of {list(ARROW_TYPES.keys())}")
+        fields.append(pa.field(name, ARROW_TYPES[bq_type.upper()]))
+    return pa.schema(fields)
+
+
+def _to_json_string(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def dataframe_to_arrow(
+    df: pd.DataFrame, schema: dict = None, timezone: str = constants.TIMEZONE.value
+) -> pa.Table:
+    """
+    Converts a dataframe to an Arrow table, casting it to `schema` if given.
+    Nested values (dicts, lists) in STRING columns are serialized as JSON.
+    :param df: The dataframe to convert.
+    :param schema: Optional mapping of column names to BigQuery types.
+    :param timezone: Timezone of the wall time stored in DATETIME columns.
+    :return: The Arrow table.
+    """
+    if schema is None:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    arrow_schema = build_arrow_schema(schema)
+    df = df[arrow_schema.names].copy()
+    for field in arrow_schema:
+        if field.type == pa.string() and df[field.name].dtype == object:
+            df[field.name] = df[field.name].map(_to_json_string)
+        elif (
+            field.type == ARROW_TYPES["DATETIME"]
+            and pd.api.types.is_datetime64tz_dtype(df[field.name])
+        ):
+            # A plain cast would keep the UTC wall time, hours apart from CSV files
+            df[field.name] = df[field.name].dt.tz_convert(timezone).dt.tz_localize(None)
+    return pa.Table.from_pandas(df, preserve_index=False).cast(arrow_schema)
+
+
+def save_dataframe(
+    df: pd.DataFrame,
+    file_path,
+    file_format: str = "csv",
+    compression: str = None,
+    schema: dict = None,
+):
+    """
+    Saves a dataframe to `file_path` as CSV or Parquet.
+    :param df: The dataframe to save.
+    :param file_path: Where to save the dataframe.
+    :param file_format: One of FILE_FORMATS. Default is "csv".
+    :param compression: Parquet compression codec (snappy, zstd, gzip). Default is snappy.
+    :param schema: Optional mapping of column names to BigQuery types, only used for Parquet.
+    :return: The file path.
+    """
+    check_file_format(file_format)
+    Path(file_path).parent.mkdir(parents=True, exist_ok=True)
+    if file_format == "parquet":
+        pq.write_table(
+            dataframe_to_arrow(df, schema),
+            str(file_path),
+            compression=compression or "snappy",
+        )
+    else:
+        df.to_csv(file_path, index=False)
+    return file_path
+
+
+def write_dataframe(
+    df: pd.DataFrame,
+    file_obj,
+    file_format: str = "csv",
+    compression: str = None,
+    schema: dict = None,
+    chunk_rows: int = None,
+):
+    """
+    Writes a dataframe to a binary file object, like a buffer or a blob writer,
+    `chunk_rows` rows at a time so large frames are never serialized at once.
+    :param df: The dataframe to write.
+    :param file_obj: The binary file object.
+    :param file_format: One of FILE_FORMATS. Default is "csv".
+    :param compression: Parquet compression codec (snappy, zstd, gzip). Default is snappy.
+    :param schema: Optional mapping of column names to BigQuery types, only used for Parquet.
+    :param chunk_rows: Rows per chunk (and per Parquet row group). Default is all rows.
+    """
+    check_file_format(file_format)
+    chunk_rows = chunk_rows or max(len(df), 1)
+    if file_format == "parquet":
+        writer = None
+        for start in range(0, max(len(df), 1), chunk_rows):
+            table = dataframe_to_arrow(df.iloc[start:start + chunk_rows], schema)
+            if writer is None:
+                writer = pq.ParquetWriter(
+                    file_obj, table.schema, compression=compression or "snappy")
+            else:
+                # Chunks without a schema may infer different types, e.g. all nulls
+                table = table.cast(writer.schema)
+            writer.write_table(table)
+        writer.close()
+        return
+    for start in range(0, max(len(df), 1), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows]
+        file_obj.write(chunk.to_csv(index=False, header=start == 0).encode("utf-8"))
+
+
+def dataframe_to_buffer(
+    df: pd.DataFrame,
+    file_format: str = "csv",
+    compression: str = None,
+    schema: dict = None,
+) -> io.BytesIO:
+    """
+    Serializes a dataframe to an in-memory buffer, as `save_dataframe` would
+    save it to a file.
+    :return: The buffer, positioned at its start.
+    """
+    buffer = io.BytesIO()
+    write_dataframe(df, buffer, file_format=file_format, compression=compression, schema=schema)
+    buffer.seek(0)
+    return buffer
+
+
+class RollingFileWriter:
+    """
+    Writes dataframes incrementally to a sequence of files, starting a new
+    one once the current file reaches `max_bytes`, so memory use does not
+    depend on the total size of the data.
+
+    Usage:
+        with RollingFileWriter(lambda id: Path(f"data-{id:03}.csv")) as writer:
+            for df in frames:
+                writer.write(df)
+        writer.paths  # every file written
+    """
+
+    def __init__(
+        self,
+        path_fn,
+        file_format: str = "csv",
+        max_bytes: int = 100 * 1024 * 1024,
+        compression: str = None,
+        schema: dict = None,
+        paths: list = None,
+    ):
+        """
+        :param path_fn: Function that takes the file number, starting at 1, and returns its path.
+        :param file_format: One of FILE_FORMATS. Default is "csv".
+        :param max_bytes: Size from which a new file is started. Default is 100 MB.
+        :param compression: Parquet compression codec (snappy, zstd, gzip). Default is snappy.
+        :param schema: Optional mapping of column names to BigQuery types, only used for Parquet.
+        :param paths: Files already written, to resume a previous writer. New files are numbered after them.
+        """
+        check_file_format(file_format)
+        self.path_fn = path_fn
+        self.file_format = file_format
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.schema = schema
+        self.paths = [Path(path) for path in paths or []]
+        self._file = None
+        self._parquet_writer = None
+
+    def _open(self):
+        path = Path(self.path_fn(len(self.paths) + 1))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.paths.append(path)
+        self._file = path.open("wb")
+
+    @property
+    def closed_paths(self) -> list:
+        """Files that are complete, i.e. every file but the one being written"""
+        return self.paths if self._file is None else self.paths[:-1]
+
+    def _close_file(self):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def write(self, df: pd.DataFrame):
+        """Appends `df` to the current file, rolling over to a new file after
+        it if the current one reached `max_bytes`"""
+        if df.empty:
+            return
+        if self._file is None:
+            self._open()
+        if self.file_format == "parquet":
+            table = dataframe_to_arrow(df, self.schema)
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(
+                    self._file, table.schema, compression=self.compression or "snappy")
+            else:
+                # Frames without a schema may infer different types, e.g. all nulls
+                table = table.cast(self._parquet_writer.schema)
+            self._parquet_writer.write_table(table)
+        else:
+            self._file.write(
+                df.to_csv(index=False, header=self._file.tell() == 0).encode("utf-8"))
+        if self._file.tell() >= self.max_bytes:
+            self._close_file()
+
+    def close(self):
+        self._close_file()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(
+            "zstd compression requires the zstandard package. "
+            "Install it with `pip install zstandard` or use gzip instead")
+    return zstandard
+
+
+def check_raw_compression(compression: str):
+    if compression is not None and compression not in RAW_COMPRESSIONS:
+        raise ValueError(
+            f"Raw compression must be one of {list(RAW_COMPRESSIONS.keys())}, got {compression}")
+
+
+def get_content_encoding(file_path) -> str:
+    """
+    Gets the codec of a raw file from its suffix.
+    :param file_path: Path of the raw file.
+    :return: The codec name (gzip, zstd), or None if the file is not compressed.
+    """
+    suffix = Path(file_path).suffix
+    for compression, compression_suffix in RAW_COMPRESSIONS.items():
+        if suffix == compression_suffix:
+            return compression
+    return None
+
+
+def compress_raw(content: bytes, compression: str = None) -> bytes:
+    """
+    Compresses a raw payload.
+    :param content: The raw bytes.
+    :param compression: One of RAW_COMPRESSIONS, or None to keep the content as is.
+    :return: The compressed bytes.
+    """
+    check_raw_compression(compression)
+    if compression == "gzip":
+        # mtime is fixed so the same payload always yields the same bytes
+        return gzip.compress(content, compresslevel=6, mtime=0)
+    if compression == "zstd":
+        return _zstandard().ZstdCompressor(level=3).compress(content)
+    return content
+
+
+def decompress_raw(content: bytes) -> bytes:
+    """
+    Decompresses a raw payload, detecting the codec from its leading bytes.
+    Uncompressed content is returned as is.
+    :param content: The raw bytes.
+    :return: The decompressed bytes.
+    """
+    if content.startswith(_RAW_MAGIC["gzip"]):
+        return gzip.decompress(content)
+    if content.startswith(_RAW_MAGIC["zstd"]):
+        # Frames written by `compress_raw` carry their content size
+        return _zstandard().ZstdDecompressor().decompress(content)
+    return content
+
+
+def save_raw(content, file_path, compression: str = None):
+    """
+    Saves a raw payload, compressing it if `compression` is given.
+    :param content: The raw bytes or text.
+    :param file_path: Where to save the payload. The codec suffix is appended to it.
+    :param compression: One of RAW_COMPRESSIONS. Default is None (uncompressed).
+    :return: The path of the saved file.
+    """
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    file_path = Path(file_path)
+    if compression is not None:
+        file_path = file_path.with_name(file_path.name + RAW_COMPRESSIONS[compression])
+    content = compress_raw(content, compression)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    file_path.write_bytes(content)
+    return file_path
+
+
+def read_raw(file_path) -> bytes:
+    """
+    Reads a raw file saved by `save_raw`, compressed or not.
+    :param file_path: Path of the raw file.
+    :return: The decompressed bytes.
+    """
+    return decompress_raw(Path(file_path).read_bytes())
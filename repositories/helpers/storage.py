@@ -1,10 +1,182 @@
+import tempfile
 import basedosdados as bd
 from pathlib import Path
+from contextlib import contextmanager
+
+from basedosdados.exceptions import BaseDosDadosException
+from basedosdados.upload.dataset import Dataset
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+
+from repositories.helpers.constants import constants
+from repositories.helpers.serialization import (
+    FILE_FORMATS,
+    check_file_format,
+    dataframe_to_buffer,
+    get_content_encoding,
+    write_dataframe,
+)
+
 
 class StoragePlus(bd.Storage):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
+    def upload(
+        self,
+        path,
+        mode="all",
+        partitions=None,
+        if_exists="raise",
+        chunk_size=None,
+        **upload_args,
+    ):
+        """ Same as `bd.Storage.upload`, but folders may also contain Parquet files,
+        which are uploaded keeping their hive partitions. Compressed raw files
+        (.gz, .zst) are uploaded with the matching `Content-Encoding`."""
+        path = Path(path)
+        if not path.is_dir():
+            content_encoding = get_content_encoding(path)
+            if content_encoding is not None:
+                return self._upload_encoded(
+                    path, content_encoding, mode=mode, partitions=partitions,
+                    if_exists=if_exists, chunk_size=chunk_size, **upload_args)
+            return super().upload(
+                path, mode=mode, partitions=partitions, if_exists=if_exists,
+                chunk_size=chunk_size, **upload_args)
+
+        for filepath in path.glob("**/*"):
+            if filepath.is_file() and filepath.suffix[1:] in FILE_FORMATS:
+                part = filepath.parent.relative_to(path).as_posix()
+                super().upload(
+                    filepath,
+                    mode=mode,
+                    partitions=part if part != "." else None,
+                    if_exists=if_exists,
+                    chunk_size=chunk_size,
+                    **upload_args,
+                )
+
+    def _upload_encoded(
+        self,
+        path,
+        content_encoding,
+        mode="all",
+        partitions=None,
+        if_exists="raise",
+        chunk_size=None,
+        **upload_args,
+    ):
+        """ Uploads a single compressed file, setting the blob `Content-Encoding`.
+        GCS decompresses gzip blobs on download for clients that do not accept
+        gzip; zstd blobs are always served as stored."""
+        modes = ["raw", "staging"] if mode == "all" else [mode]
+        # The content type is the one of the file without the codec suffix
+        content_type = "application/json" if path.stem.endswith(".json") else "text/csv"
+        for m in modes:
+            blob = self._get_blob(path.name, m, partitions, if_exists, chunk_size)
+            if blob is None:
+                continue
+            blob.content_encoding = content_encoding
+            upload_args["timeout"] = upload_args.get("timeout", None)
+            blob.upload_from_filename(str(path), content_type=content_type, **upload_args)
+
+    def _get_blob(self, filename, mode, partitions=None, if_exists="raise", chunk_size=None):
+        """ Returns the blob `Storage.upload` would write `filename` to, or None
+        if it exists and `if_exists` is 'pass'."""
+        self._check_mode(mode)
+        blob = self.bucket.blob(
+            self._build_blob_name(filename, mode, partitions), chunk_size=chunk_size
+        )
+        if blob.exists() and if_exists != "replace":
+            if if_exists == "pass":
+                return None
+            raise BaseDosDadosException(
+                f"Data already exists at {self.bucket_name}/{blob.name}. "
+                "Set if_exists to 'replace' to overwrite data"
+            )
+        return blob
+
+    def upload_dataframe(
+        self,
+        df,
+        filename,
+        mode="staging",
+        partitions=None,
+        if_exists="raise",
+        file_format="csv",
+        compression=None,
+        schema=None,
+        chunk_rows=constants.UPLOAD_CHUNK_ROWS.value,
+        chunk_size=None,
+    ):
+        """ Uploads a dataframe to the blob `upload` would use for the file
+        `<filename>.<file_format>`, without writing it to disk. Frames of up to
+        `chunk_rows` rows are serialized to a buffer; larger ones are streamed
+        to the blob in chunks. Returns the blob name, or None if skipped."""
+        check_file_format(file_format)
+        content_type = "application/octet-stream" if file_format == "parquet" else "text/csv"
+        blob = self._get_blob(
+            f"{filename}.{file_format}", mode, partitions, if_exists, chunk_size
+        )
+        if blob is None:
+            return None
+        if len(df) <= chunk_rows or not hasattr(blob, "open"):
+            blob.upload_from_file(
+                dataframe_to_buffer(
+                    df, file_format=file_format, compression=compression, schema=schema
+                ),
+                content_type=content_type,
+                timeout=None,
+            )
+        else:
+            with blob.open("wb", content_type=content_type) as f:
+                write_dataframe(
+                    df,
+                    f,
+                    file_format=file_format,
+                    compression=compression,
+                    schema=schema,
+                    chunk_rows=chunk_rows,
+                )
+        return blob.name
+
+    @contextmanager
+    def open_upload(
+        self,
+        filename,
+        mode="raw",
+        partitions=None,
+        if_exists="replace",
+        content_type=None,
+        chunk_size=None,
+    ):
+        """ Opens a writable file object for the blob `upload` would write
+        `filename` to, so data is sent to GCS while it is produced. The object
+        is finalized when the block exits and deleted if the block raises.
+        Clients without streaming uploads buffer the data and upload it at the
+        end instead."""
+        if if_exists == "pass":
+            raise ValueError("if_exists='pass' is not supported for streamed uploads")
+        blob = self._get_blob(filename, mode, partitions, if_exists, chunk_size)
+        if not hasattr(blob, "open"):
+            with tempfile.SpooledTemporaryFile(
+                max_size=constants.STREAM_BUFFER_MAX_BYTES.value
+            ) as f:
+                yield f
+                f.seek(0)
+                blob.upload_from_file(f, content_type=content_type, timeout=None)
+            return
+        f = blob.open("wb", content_type=content_type)
+        try:
+            yield f
+        except BaseException:
+            # Closing commits what was written, so the partial blob is removed
+            f.close()
+            blob.delete()
+            raise
+        f.close()
+
     def download(
         self,
         filename,
@@ -60,4 +232,134 @@ class StoragePlus(bd.Storage):
             raise Exception(
                         f"Data already exists at {_file_path}. "
                         "Set if_exists to 'replace' to overwrite data"
-                    )
\ No newline at end of file
+                    )
+
+
+class TablePlus(bd.Table):
+    """ `bd.Table` that also creates and appends to staging tables backed by
+    Parquet files. CSV tables are handled by `bd.Table` itself."""
+
+    def __init__(self, table_id, dataset_id, **kwargs):
+        super().__init__(table_id, dataset_id, **kwargs)
+
+    def _parquet_external_config(self):
+        external_config = bigquery.ExternalConfig("PARQUET")
+        # Parquet files carry their own schema
+        external_config.autodetect = True
+        external_config.source_uris = f"gs://{self.bucket_name}/staging/{self.dataset_id}/{self.table_id}/*"
+        if self._is_partitioned():
+            hive_partitioning = bigquery.external_config.HivePartitioningOptions()
+            hive_partitioning.mode = "AUTO"
+            hive_partitioning.source_uri_prefix = self.uri.format(
+                dataset=self.dataset_id, table=self.table_id
+            ).replace("*", "")
+            external_config.hive_partitioning = hive_partitioning
+        return external_config
+
+    def staging_source_format(self):
+        """ Format of the files read by the staging table, e.g. "csv", or None
+        if the table does not exist."""
+        try:
+            table = self.client["bigquery_staging"].get_table(
+                self.table_full_name["staging"]
+            )
+        except NotFound:
+            return None
+        if table.external_data_configuration is None:
+            return None
+        return table.external_data_configuration.source_format.lower()
+
+    def staging_columns(self):
+        """ Column names of the staging table, or None if it does not exist."""
+        try:
+            table = self.client["bigquery_staging"].get_table(
+                self.table_full_name["staging"]
+            )
+        except NotFound:
+            return None
+        return [field.name for field in table.schema]
+
+    def check_source_format(self, source_format):
+        """ Raises ValueError if the staging table exists and reads files in a
+        format other than `source_format`. Its files must then be moved out of
+        the staging folder and the table recreated, since BigQuery cannot read
+        CSV and Parquet files in the same table."""
+        existing = self.staging_source_format()
+        if existing is not None and existing != source_format.lower():
+            raise ValueError(
+                f"Staging table {self.dataset_id}.{self.table_id} reads {existing} files, "
+                f"but file_format is {source_format}. Move the {existing} files out of "
+                f"gs://{self.bucket_name}/staging/{self.dataset_id}/{self.table_id} and "
+                "recreate the staging table before changing its format"
+            )
+
+    def create(
+        self,
+        path=None,
+        if_table_exists="raise",
+        if_storage_data_exists="raise",
+        source_format="csv",
+        **kwargs,
+    ):
+        """ Creates the staging table. For `source_format="parquet"`, the table
+        config files (table_config.yaml, publish.sql) must already exist."""
+        check_file_format(source_format)
+        if if_table_exists == "pass":
+            # Passing over a table in another format would leave it unreadable
+            self.check_source_format(source_format)
+        if source_format == "csv":
+            return super().create(
+                path=path,
+                if_table_exists=if_table_exists,
+                if_storage_data_exists=if_storage_data_exists,
+                source_format=source_format,
+                **kwargs,
+            )
+
+        if path is not None:
+            StoragePlus(
+                dataset_id=self.dataset_id, table_id=self.table_id, **self.main_vars
+            ).upload(path, mode="staging", if_exists=if_storage_data_exists)
+
+        Dataset(self.dataset_id, **self.main_vars).create(if_exists="pass")
+
+        table = bigquery.Table(self.table_full_name["staging"])
+        table.external_data_configuration = self._parquet_external_config()
+
+        if self.table_exists("staging"):
+            if if_table_exists == "pass":
+                return None
+            elif if_table_exists == "raise":
+                raise FileExistsError(
+                    "Table already exists, choose replace if you want to overwrite it"
+                )
+            self.delete(mode="staging")
+
+        self.client["bigquery_staging"].create_table(table)
+
+    def append(
+        self,
+        filepath,
+        partitions=None,
+        if_exists="replace",
+        chunk_size=None,
+        check_exists=True,
+        **upload_args,
+    ):
+        """ Same as `bd.Table.append`, but also uploads Parquet files. Callers
+        that already know the staging table exists, e.g. from the table state
+        cache, can skip the check with `check_exists=False`."""
+        if check_exists and not self.table_exists("staging"):
+            raise BaseDosDadosException(
+                "You cannot append to a table that does not exist"
+            )
+        StoragePlus(
+            dataset_id=self.dataset_id, table_id=self.table_id, **self.main_vars
+        ).upload(
+            filepath,
+            mode="staging",
+            partitions=partitions,
+            if_exists=if_exists,
+            chunk_size=chunk_size,
+            **upload_args,
+        )
@@ -0,0 +1,72 @@
+"""
+Cache of which BigQuery tables exist, shared by every pod through Redis.
+Only existing tables are cached, since a table that exists is not expected
+to disappear, while a missing one is about to be created. Callers must
+invalidate the state of a table when an operation on it fails.
+"""
+from redis.exceptions import RedisError
+
+from repositories.helpers.clients import get_redis
+from repositories.helpers.constants import constants
+from repositories.helpers.logging import logger
+
+# "native" is the table written by the Storage Write API sink
+MODES = ["staging", "prod", "native"]
+
+
+def _key(dataset_id: str, table_id: str, mode: str) -> str:
+    return f"table_state:{dataset_id}.{table_id}:{mode}"
+
+
+def mark_table_exists(dataset_id: str, table_id: str, mode: str, source_format: str = None):
+    """Records that the `mode` table exists, e.g. right after creating it, and
+    the format of its files, if known"""
+    try:
+        get_redis().set(
+            _key(dataset_id, table_id, mode),
+            source_format or 1,
+            ex=constants.TABLE_STATE_TTL.value,
+        )
+    except RedisError as e:
+        logger.warning(f"Could not cache state of {dataset_id}.{table_id}: {e}")
+
+
+def is_table_cached(dataset_id: str, table_id: str, mode: str, source_format: str = None) -> bool:
+    """Whether the `mode` table is known to exist, with files in `source_format`
+    if given. False if Redis is unavailable"""
+    try:
+        state = get_redis().get(_key(dataset_id, table_id, mode))
+        if source_format is not None and state is not None:
+            return state.decode() == source_format
+        return bool(state)
+    except RedisError as e:
+        logger.warning(f"Could not read state of {dataset_id}.{table_id}: {e}")
+        return False
+
+
+def table_exists(tb, mode: str) -> bool:
+    """
+    Same as `tb.table_exists(mode)`, but answered from the cache when possible.
+    :param tb: A `bd.Table` (or subclass) object. A `TablePlus` if `source_format` is given.
+    :param mode: One of MODES.
+    :param source_format: The configured file format, e.g. "csv". A table cached
+        with another format is checked again, so a format change is not hidden.
+    :return: Whether the table exists.
+    :raises ValueError: If the table exists with files in another format.
+    """
+    if is_table_cached(tb.dataset_id, tb.table_id, mode, source_format):
+        return True
+    exists = tb.table_exists(mode)
+    if exists:
+        if source_format is not None:
+            tb.check_source_format(source_format)
+        mark_table_exists(tb.dataset_id, tb.table_id, mode, source_format)
+    return exists
+
+
+def invalidate_table_state(dataset_id: str, table_id: str):
+    """Forgets the cached state of the table in every mode"""
+    try:
+        get_redis().delete(*[_key(dataset_id, table_id, mode) for mode in MODES])
+    except RedisError as e:
+        logger.warning(f"Could not invalidate state of {dataset_id}.{table_id}: {e}")
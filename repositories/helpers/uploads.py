@@ -0,0 +1,116 @@
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from google.api_core.exceptions import ServerError, TooManyRequests
+
+from repositories.helpers.constants import constants
+from repositories.helpers.logging import logger
+
+# Errors worth retrying, raised by GCS and BigQuery on transient failures
+TRANSIENT_ERRORS = (
+    ServerError,
+    TooManyRequests,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+)
+
+
+class UploadError(Exception):
+    """Raised when uploads fail, with the exception of each one in `errors`"""
+
+    def __init__(self, errors: dict):
+        self.errors = errors
+        super().__init__(
+            f"{len(errors)} upload(s) failed: "
+            + "; ".join(f"{name}: {error!r}" for name, error in errors.items())
+        )
+
+
+class UploadExecutor:
+    """
+    Runs independent uploads in a bounded thread pool, retrying transient
+    errors with jittered exponential backoff. Failures do not cancel the
+    other uploads; they are raised together, as an UploadError, on `wait`.
+
+    Usage:
+        with UploadExecutor() as executor:
+            executor.submit("raw", st.upload, raw_path, mode="raw")
+            executor.submit("staging", st.upload, staging_path, mode="staging")
+    """
+
+    def __init__(
+        self,
+        max_workers: int = constants.UPLOAD_MAX_WORKERS.value,
+        max_retries: int = constants.UPLOAD_MAX_RETRIES.value,
+        backoff_factor: float = constants.UPLOAD_BACKOFF_FACTOR.value,
+        log=logger,
+    ):
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.log = log
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = {}
+
+    def backoff(self, attempt: int) -> float:
+        """Seconds to wait before retrying, with full jitter"""
+        return random.uniform(0, self.backoff_factor * 2 ** attempt)
+
+    def _run(self, name: str, fn, max_retries: int, *args, **kwargs):
+        for attempt in range(max_retries + 1):
+            try:
+                return fn(*args, **kwargs)
+            except TRANSIENT_ERRORS as e:
+                if attempt == max_retries:
+                    raise
+                self.log.warning(f"Upload {name} failed ({e}), retrying")
+                time.sleep(self.backoff(attempt))
+
+    def submit(self, name: str, fn, *args, max_retries: int = None, **kwargs):
+        """
+        Schedules `fn(*args, **kwargs)`.
+        :param name: Identifies the upload in logs and errors, e.g. the blob path.
+        :param fn: The upload function. It must be safe to call again on retries.
+        :param max_retries: Retries for this upload. Default is the executor's.
+            Use 0 for steps that are not safe to repeat, like table creation or
+            appends, which may have succeeded before the error was raised.
+        """
+        if name in self._futures:
+            raise ValueError(f"Upload {name} was already submitted")
+        max_retries = self.max_retries if max_retries is None else max_retries
+        self._futures[name] = self._pool.submit(
+            self._run, name, fn, max_retries, *args, **kwargs
+        )
+
+    def wait(self) -> dict:
+        """
+        Waits for every submitted upload.
+        :return: The result of each upload, keyed by name.
+        :raises UploadError: If any upload failed, after all of them finished.
+        """
+        results, errors = {}, {}
+        for name, future in self._futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                errors[name] = e
+        self._futures = {}
+        if errors:
+            raise UploadError(errors)
+        return results
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.wait()
+        finally:
+            self.shutdown()
+        return False
+
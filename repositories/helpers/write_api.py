@@ -0,0 +1,284 @@
+"""
+Sink that streams treated rows straight into native, partitioned BigQuery
+tables through the Storage Write API, instead of saving files to GCS and
+appending them to the basedosdados external tables.
+
+Rows are serialized with a protobuf message built at runtime from the table
+schema, the same mapping of column names to BigQuery types used for Parquet
+files, and appended to a write stream in pending mode. The stream is
+committed once every append succeeds, so a failed write adds no rows and can
+be retried as a whole.
+"""
+import json
+from datetime import date
+from pathlib import Path
+
+import pandas as pd
+from google.cloud import bigquery
+from google.protobuf import descriptor_pb2, descriptor_pool, json_format, message_factory
+
+from repositories.helpers.clients import get_bigquery_client, get_bigquery_write_client
+from repositories.helpers.constants import constants
+from repositories.helpers.table_state import (
+    invalidate_table_state,
+    is_table_cached,
+    mark_table_exists,
+)
+
+BACKENDS = ["bigquery", "local"]
+
+_FieldProto = descriptor_pb2.FieldDescriptorProto
+
+# BigQuery column types and the protobuf types the Write API accepts for them
+PROTO_TYPES = {
+    "STRING": _FieldProto.TYPE_STRING,
+    "INT64": _FieldProto.TYPE_INT64,
+    "FLOAT64": _FieldProto.TYPE_DOUBLE,
+    "NUMERIC": _FieldProto.TYPE_STRING,
+    "BOOL": _FieldProto.TYPE_BOOL,
+    "DATE": _FieldProto.TYPE_INT32,
+    "DATETIME": _FieldProto.TYPE_STRING,
+    "TIMESTAMP": _FieldProto.TYPE_INT64,
+}
+
+PARTITION_TYPES = ["DATE", "DATETIME", "TIMESTAMP"]
+
+_EPOCH = date(1970, 1, 1)
+
+
+def build_descriptor(schema: dict, name: str = "Row") -> descriptor_pb2.DescriptorProto:
+    """
+    Builds the protobuf descriptor of a table row.
+    :param schema: Mapping of column names to BigQuery types, e.g. {"linha": "STRING"}.
+    :param name: Name of the message.
+    :return: The message descriptor, with one optional field per column.
+    """
+    descriptor = descriptor_pb2.DescriptorProto(name=name)
+    for number, (column, bq_type) in enumerate(schema.items(), start=1):
+        if bq_type.upper() not in PROTO_TYPES:
+            raise ValueError(
+                f"Type {bq_type} of column {column} is not supported. "
+                f"Use one of {list(PROTO_TYPES.keys())}")
+        descriptor.field.add(
+            name=column,
+            number=number,
+            type=PROTO_TYPES[bq_type.upper()],
+            label=_FieldProto.LABEL_OPTIONAL,
+        )
+    return descriptor
+
+
+def build_message_class(descriptor: descriptor_pb2.DescriptorProto):
+    """Builds the message class of `descriptor`, in a pool of its own"""
+    file_proto = descriptor_pb2.FileDescriptorProto(
+        name=f"{descriptor.name}.proto", package="maestro", syntax="proto2"
+    )
+    file_proto.message_type.add().CopyFrom(descriptor)
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(file_proto)
+    message_descriptor = pool.FindMessageTypeByName(f"maestro.{descriptor.name}")
+    if hasattr(message_factory, "GetMessageClass"):
+        return message_factory.GetMessageClass(message_descriptor)
+    return message_factory.MessageFactory(pool).GetPrototype(message_descriptor)
+
+
+def _to_json_string(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+
+def _convert_column(values: pd.Series, bq_type: str) -> pd.Series:
+    """Converts a column to the values its protobuf field takes. Missing values
+    are kept as they are, so the field is left unset."""
+    bq_type = bq_type.upper()
+    if bq_type == "TIMESTAMP":
+        # Microseconds since epoch, in UTC
+        values = pd.to_datetime(values, utc=True)
+        return values.map(lambda x: x.value // 1000, na_action="ignore")
+    if bq_type == "DATETIME":
+        values = pd.to_datetime(values)
+        return values.map(lambda x: x.strftime("%Y-%m-%d %H:%M:%S.%f"), na_action="ignore")
+    if bq_type == "DATE":
+        # Days since epoch
+        values = pd.to_datetime(values)
+        return values.map(lambda x: (x.date() - _EPOCH).days, na_action="ignore")
+    if bq_type in ["STRING", "NUMERIC"]:
+        return values.map(_to_json_string, na_action="ignore")
+    return values
+
+
+def serialize_rows(df: pd.DataFrame, schema: dict, message_class) -> list:
+    """
+    Serializes the rows of `df` as protobuf messages.
+    :param df: The dataframe to serialize.
+    :param schema: Mapping of column names to BigQuery types.
+    :param message_class: Class built by `build_message_class` from `schema`.
+    :return: A list with the serialized bytes of each row.
+    """
+    columns = {
+        column: _convert_column(df[column], bq_type).astype(object)
+        for column, bq_type in schema.items()
+    }
+    rows = []
+    for values in zip(*columns.values()):
+        message = message_class(
+            **{
+                column: value
+                for column, value in zip(columns.keys(), values)
+                if not pd.isna(value)
+            }
+        )
+        rows.append(message.SerializeToString())
+    return rows
+
+
+def batch_rows(rows: list, max_bytes: int = constants.WRITE_API_MAX_REQUEST_BYTES.value):
+    """Splits serialized `rows` in batches of at most `max_bytes`, one per append"""
+    batch, size = [], 0
+    for row in rows:
+        if batch and size + len(row) > max_bytes:
+            yield batch
+            batch, size = [], 0
+        batch.append(row)
+        size += len(row)
+    if batch:
+        yield batch
+
+
+class WriteAPISink:
+    """
+    Streams treated rows to native BigQuery tables, partitioned by day of
+    `partition_column`. Tables are created on the first write.
+
+    The `bigquery` backend appends to a pending write stream in the prod
+    project, committed at the end of each write. The `local` backend goes through the same serialization, but
+    writes the decoded rows to JSON lines files in `local_dir`, for tests and
+    local runs.
+    """
+
+    def __init__(
+        self,
+        backend: str = "bigquery",
+        table_suffix: str = "_native",
+        partition_column: str = "timestamp_captura",
+        local_dir: str = None,
+    ):
+        if backend not in BACKENDS:
+            raise ValueError(f"Backend must be one of {BACKENDS}, got {backend}")
+        self.backend = backend
+        self.table_suffix = table_suffix
+        self.partition_column = partition_column
+        self.local_dir = Path(local_dir or "data/write_api")
+
+    def _create_table(self, dataset_id: str, table_id: str, schema: dict):
+        client = get_bigquery_client(mode="prod")
+        table = bigquery.Table(
+            f"{client.project}.{dataset_id}.{table_id}",
+            schema=[
+                bigquery.SchemaField(column, bq_type.upper())
+                for column, bq_type in schema.items()
+            ],
+        )
+        table.time_partitioning = bigquery.TimePartitioning(
+            type_=bigquery.TimePartitioningType.DAY, field=self.partition_column
+        )
+        # Costs the same request as checking whether the table exists
+        client.create_table(table, exists_ok=True)
+
+    def _append_bigquery(self, dataset_id: str, table_id: str, descriptor, rows: list):
+        from google.cloud.bigquery_storage_v1 import types, writer
+
+        client = get_bigquery_write_client(mode="prod")
+        project = get_bigquery_client(mode="prod").project
+        stream = client.create_write_stream(
+            parent=client.table_path(project, dataset_id, table_id),
+            write_stream=types.WriteStream(type_=types.WriteStream.Type.PENDING),
+        )
+        template = types.AppendRowsRequest(
+            write_stream=stream.name,
+            proto_rows=types.AppendRowsRequest.ProtoData(
+                writer_schema=types.ProtoSchema(proto_descriptor=descriptor)
+            ),
+        )
+        append_stream = writer.AppendRowsStream(client, template)
+        try:
+            futures, offset = [], 0
+            for batch in batch_rows(rows):
+                # Offsets make retried appends of the same batch idempotent
+                futures.append(
+                    append_stream.send(
+                        types.AppendRowsRequest(
+                            offset=offset,
+                            proto_rows=types.AppendRowsRequest.ProtoData(
+                                rows=types.ProtoRows(serialized_rows=batch)
+                            ),
+                        )
+                    )
+                )
+                offset += len(batch)
+            for future in futures:
+                future.result()
+        finally:
+            append_stream.close()
+        client.finalize_write_stream(name=stream.name)
+        # Rows become visible only now, all at once
+        response = client.batch_commit_write_streams(
+            types.BatchCommitWriteStreamsRequest(
+                parent=stream.name.split("/streams/")[0],
+                write_streams=[stream.name],
+            )
+        )
+        if response.stream_errors:
+            raise RuntimeError(
+                f"Could not commit rows to {dataset_id}.{table_id}: "
+                f"{[error.error_message for error in response.stream_errors]}")
+
+    def _append_local(self, dataset_id: str, table_id: str, message_class, rows: list):
+        path = self.local_dir / f"{dataset_id}.{table_id}.jsonl"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("a") as f:
+            for row in rows:
+                record = json_format.MessageToDict(
+                    message_class.FromString(row), preserving_proto_field_name=True
+                )
+                f.write(json.dumps(record) + "\n")
+
+    def write(self, dataset_id: str, table_id: str, df: pd.DataFrame, schema: dict) -> int:
+        """
+        Writes the rows of `df` to the native table of `table_id`.
+        :param dataset_id: Dataset of the table.
+        :param table_id: The basedosdados table, suffixed with `table_suffix`.
+        :param df: The treated dataframe.
+        :param schema: Mapping of column names to BigQuery types. Other columns are ignored.
+        :return: The number of written rows.
+        """
+        if not schema:
+            raise ValueError(
+                f"A schema is required to stream {dataset_id}.{table_id} to BigQuery")
+        partition_type = schema.get(self.partition_column, "").upper()
+        if partition_type not in PARTITION_TYPES:
+            raise ValueError(
+                f"Partition column {self.partition_column} must be in the schema, "
+                f"with one of the types {PARTITION_TYPES}")
+        if df.empty:
+            return 0
+
+        table_id = table_id + self.table_suffix
+        descriptor = build_descriptor(schema)
+        message_class = build_message_class(descriptor)
+        rows = serialize_rows(df, schema, message_class)
+        if self.backend == "local":
+            self._append_local(dataset_id, table_id, message_class, rows)
+            return len(rows)
+
+        try:
+            if not is_table_cached(dataset_id, table_id, "native"):
+                self._create_table(dataset_id, table_id, schema)
+                mark_table_exists(dataset_id, table_id, "native")
+            self._append_bigquery(dataset_id, table_id, descriptor, rows)
+        except Exception:
+            invalidate_table_state(dataset_id, table_id)
+            raise
+        return len(rows)
+
@@ -16,6 +16,42 @@ def bd_client(context):
         "dataset_id": Field(
             str, is_required=True, description="Dataset used in the pipeline"
         ),
+        "file_format": Field(
+            str,
+            is_required=False,
+            default_value="csv",
+            description="Format of the staging files, csv or parquet",
+        ),
+        "compression": Field(
+            str,
+            is_required=False,
+            default_value="snappy",
+            description="Parquet compression codec (snappy, zstd or gzip)",
+        ),
+        "schema": Field(
+            dict,
+            is_required=False,
+            description="BigQuery type of each staging column, used for Parquet files",
+        ),
+        "raw_compression": Field(
+            str,
+            is_required=False,
+            description="Compression of the raw files (gzip or zstd). Uncompressed if not set",
+        ),
+        "upload_mode": Field(
+            str,
+            is_required=False,
+            default_value="file",
+            description="How treated data reaches GCS: `file` saves it locally first, "
+            "`memory` uploads it straight from the dataframe",
+        ),
+        "write_api": Field(
+            dict,
+            is_required=False,
+            description="Streams treated rows to a native table with the Storage Write API "
+            "instead of appending files to the external table. Takes the WriteAPISink "
+            "arguments and `archive_raw` (default true) to keep uploading raw files",
+        ),
     }
 )
 def basedosdados_config(context):
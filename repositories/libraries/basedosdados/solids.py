@@ -16,6 +16,16 @@ import basedosdados as bd
 from basedosdados import Table, Storage
 from repositories.libraries.jinja2.solids import render
 from repositories.helpers.io import get_credentials_from_env
+from repositories.helpers.metrics import get_metrics
+from repositories.helpers.serialization import save_dataframe
+from repositories.helpers.storage import StoragePlus, TablePlus
+from repositories.helpers.uploads import UploadExecutor
+from repositories.helpers.write_api import WriteAPISink
+from repositories.helpers.table_state import (
+    invalidate_table_state,
+    mark_table_exists,
+    table_exists,
+)
 
 
 # @solid(retry_policy=RetryPolicy(max_retries=3, delay=5))
@@ -70,7 +80,7 @@ def config_mapping_fn(config):
         },
     }
 @solid(required_resource_keys={'basedosdados_config'})
-def bq_upload(context, filepath,raw_filepath=None, partitions=None):
+def bq_upload(context, filepath,raw_filepath=None, partitions=None, treated_data=None):
     table_id = context.resources.basedosdados_config['table_id']
     dataset_id=context.resources.basedosdados_config['dataset_id']
     context.log.info(f"""
@@ -81,58 +91,162 @@ def bq_upload(context, filepath,raw_filepath=None, partitions=None):
     table_id = {table_id}, type = {type(table_id)}
     partitions = {partitions}, type = {type(partitions)}
     """)
-    # Upload raw to staging
-    if raw_filepath:
-        st = Storage(
-            table_id = table_id,
-            dataset_id=dataset_id
+    write_api = context.resources.basedosdados_config.get("write_api")
+    archive_raw = True
+    if write_api is not None and treated_data is not None:
+        # With the Write API, the raw archive in GCS is optional
+        archive_raw = write_api.get("archive_raw", True)
+
+    # Raw and treated data go to independent blobs, so they are uploaded together
+    with UploadExecutor(log=context.log) as executor:
+        if raw_filepath and archive_raw:
+            st = StoragePlus(
+                table_id = table_id,
+                dataset_id=dataset_id
+            )
+            context.log.info(f"Uploading raw file: {raw_filepath} to bucket {st.bucket_name} at {st.bucket_name}/{dataset_id}/{table_id}")
+            executor.submit(
+                raw_filepath, upload_raw, st, raw_filepath, partitions
+            )
+        executor.submit(
+            filepath,
+            upload_treated,
+            context,
+            dataset_id,
+            table_id,
+            filepath,
+            partitions,
+            treated_data,
+            # Appends and table creation are not safe to repeat
+            max_retries=0,
         )
-        context.log.info(f"Uploading raw file: {raw_filepath} to bucket {st.bucket_name} at {st.bucket_name}/{dataset_id}/{table_id}")
+
+    # Delete local Files
+    context.log.info(f"Deleting local files: {raw_filepath}, {filepath}")
+    cleanup_local(filepath, raw_filepath)
+
+def upload_raw(st, raw_filepath, partitions=None):
+    """Uploads a raw file, measuring the upload"""
+    with get_metrics().stage(st.dataset_id, st.table_id, "upload_raw") as measure:
+        measure["bytes"] = Path(raw_filepath).stat().st_size
         st.upload(path=raw_filepath, partitions=partitions, mode='raw', if_exists='replace')
-    
+
+def upload_treated(context, dataset_id, table_id, filepath, partitions=None, treated_data=None):
+    """Uploads treated data to the table set up in `basedosdados_config`: streamed
+    with the Write API, appended from memory or appended from `filepath`"""
+    with get_metrics().stage(dataset_id, table_id, "upload_treated") as measure:
+        if treated_data is not None:
+            measure["rows"] = treated_data.shape[0]
+        _upload_treated(context, dataset_id, table_id, filepath, partitions, treated_data)
+
+def _upload_treated(context, dataset_id, table_id, filepath, partitions=None, treated_data=None):
+    config = context.resources.basedosdados_config
+    if config.get("write_api") is not None and treated_data is not None:
+        write_api = dict(config["write_api"])
+        write_api.pop("archive_raw", None)
+        # Rows go straight to the native table, skipping the staging files
+        n_rows = WriteAPISink(**write_api).write(
+            dataset_id, table_id, treated_data, config.get("schema")
+        )
+        context.log.info(f"Streamed {n_rows} rows to {dataset_id}.{table_id} with the Write API")
+        return
+
     # creates and publish table if it does not exist, append to it otherwise
+    source_format = config.get("file_format", "csv")
+    if config.get("upload_mode") == "memory" and treated_data is not None:
+        if append_dataframe(
+            context, dataset_id, table_id, treated_data, Path(filepath).stem, partitions
+        ):
+            return
+        # Creating the table needs local files, so the first run saves them
+        save_dataframe(
+            treated_data,
+            filepath,
+            file_format=source_format,
+            compression=config.get("compression"),
+            schema=config.get("schema"),
+        )
     if partitions:
         # If table is partitioned, get parent directory wherein partitions are stored
         tb_dir = filepath.split(partitions)[0]
-        create_or_append_table(context, dataset_id, table_id, tb_dir)
+        create_or_append_table(context, dataset_id, table_id, tb_dir, source_format)
     else:
-        create_or_append_table(context, dataset_id, table_id, filepath)
+        create_or_append_table(context, dataset_id, table_id, filepath, source_format)
 
-    # Delete local Files
-    context.log.info(f"Deleting local files: {raw_filepath}, {filepath}")
-    cleanup_local(filepath, raw_filepath)
-
-def create_or_append_table(context, dataset_id, table_id, path):
-    tb = Table(
+def create_or_append_table(context, dataset_id, table_id, path, source_format="csv"):
+    tb = TablePlus(
         table_id = table_id,
         dataset_id= dataset_id
     )
-    if not tb.table_exists('staging'):
-        context.log.info(
-                "Table does not exist in STAGING, creating table...")
-        tb.create(
-            path=path,
-            if_table_exists="pass",
-            if_storage_data_exists="replace",
-            if_table_config_exists="pass",
-        )
-        context.log.info("Table created in STAGING")
-    else:
-        context.log.info(
-            "Table already exists in STAGING, appending to it...")
-        tb.append(
-            filepath=path, 
+    metrics = get_metrics()
+    try:
+        with metrics.stage(dataset_id, table_id, "table_staging"):
+            if not table_exists(tb, "staging", source_format):
+                context.log.info(
+                        "Table does not exist in STAGING, creating table...")
+                tb.create(
+                    path=path,
+                    if_table_exists="pass",
+                    if_storage_data_exists="replace",
+                    if_table_config_exists="pass",
+                    source_format=source_format,
+                )
+                mark_table_exists(dataset_id, table_id, "staging", source_format)
+                context.log.info("Table created in STAGING")
+            else:
+                context.log.info(
+                    "Table already exists in STAGING, appending to it...")
+                tb.append(
+                    filepath=path, 
+                    if_exists="replace",
+                    timeout=600,
+                    chunk_size=1024*1024*10,
+                    check_exists=False)
+                context.log.info("Appended to table on STAGING successfully.")
+
+        with metrics.stage(dataset_id, table_id, "table_prod"):
+            if not table_exists(tb, "prod"):
+                context.log.info("Table does not exist in PROD, publishing...")
+                tb.publish(if_exists="pass")
+                mark_table_exists(dataset_id, table_id, "prod")
+                context.log.info("Published table in PROD successfully.")
+            else:
+                context.log.info("Table already published in PROD.")
+    except Exception:
+        # The cached state may be what made this fail, e.g. a dropped table
+        invalidate_table_state(dataset_id, table_id)
+        raise
+
+def append_dataframe(context, dataset_id, table_id, df, filename, partitions=None):
+    """Appends `df` to the staging table straight from memory, publishing the
+    table if needed. Returns False, uploading nothing, if the table does not
+    exist in staging yet, since creating it requires local files."""
+    config = context.resources.basedosdados_config
+    tb = TablePlus(table_id=table_id, dataset_id=dataset_id)
+    try:
+        if not table_exists(tb, "staging", config.get("file_format", "csv")):
+            return False
+        context.log.info("Table already exists in STAGING, uploading dataframe to it...")
+        StoragePlus(table_id=table_id, dataset_id=dataset_id).upload_dataframe(
+            df,
+            filename,
+            mode="staging",
+            partitions=partitions,
             if_exists="replace",
-            timeout=600,
-            chunk_size=1024*1024*10)
+            file_format=config.get("file_format", "csv"),
+            compression=config.get("compression"),
+            schema=config.get("schema"),
+        )
         context.log.info("Appended to table on STAGING successfully.")
-
-    if not tb.table_exists("prod"):
-        context.log.info("Table does not exist in PROD, publishing...")
-        tb.publish(if_exists="pass")
-        context.log.info("Published table in PROD successfully.")
-    else:
-        context.log.info("Table already published in PROD.")
+        if not table_exists(tb, "prod"):
+            context.log.info("Table does not exist in PROD, publishing...")
+            tb.publish(if_exists="pass")
+            mark_table_exists(dataset_id, table_id, "prod")
+            context.log.info("Published table in PROD successfully.")
+    except Exception:
+        invalidate_table_state(dataset_id, table_id)
+        raise
+    return True
 
 def cleanup_local(filepath, raw_filepath=None):
     if raw_filepath:
@@ -178,7 +292,7 @@ def append_to_bigquery_v2(context, file_path, partitions, mode, table_id=None):
         table_id = context.resources.basedosdados_config["table_id"]
     dataset_id = context.resources.basedosdados_config["dataset_id"]
 
-    bd.Storage(dataset_id=dataset_id, table_id=table_id).upload(
+    StoragePlus(dataset_id=dataset_id, table_id=table_id).upload(
         file_path, partitions=partitions, mode=mode, if_exists="replace"
     )
 
@@ -195,12 +309,13 @@ def create_table_bq_v2(
 
     context.log.debug(f"Filepath: {file_path}")
 
-    tb = bd.Table(dataset_id=dataset_id, table_id=table_id)
+    tb = TablePlus(dataset_id=dataset_id, table_id=table_id)
     tb.create(
         path=Path(file_path),
         if_table_exists="replace",
         if_storage_data_exists="replace",
         if_table_config_exists=table_config,
+        source_format=Path(file_path).suffix[1:] or "csv",
     )
 
     tb.publish(if_exists=publish_config)
@@ -255,16 +370,23 @@ def append_to_bigquery(
 
     context.log.info(f"Table ID: {table_id} / Dataset ID: {dataset_id}")
 
-    st = bd.Storage(dataset_id=dataset_id, table_id=table_id)
+    st = StoragePlus(dataset_id=dataset_id, table_id=table_id)
 
-    for idx, mode in enumerate(modes):
-        context.log.info(
-            f"Uploading file {file_paths[idx]} to mode {mode} with partitions {partitions}"
-        )
-        st.upload(
-            file_paths[idx], partitions=partitions, mode=mode, if_exists="replace"
-        )
-        Path(file_paths[idx]).unlink(missing_ok=True)
+    with UploadExecutor(log=context.log) as executor:
+        for idx, mode in enumerate(modes):
+            context.log.info(
+                f"Uploading file {file_paths[idx]} to mode {mode} with partitions {partitions}"
+            )
+            executor.submit(
+                f"{mode}/{file_paths[idx]}",
+                st.upload,
+                file_paths[idx],
+                partitions=partitions,
+                mode=mode,
+                if_exists="replace",
+            )
+    for file_path in file_paths[:len(modes)]:
+        Path(file_path).unlink(missing_ok=True)
 
 
 def create_table_bq(
@@ -281,7 +403,7 @@ def create_table_bq(
     if not dataset_id:
         dataset_id = context.resources.basedosdados_config["dataset_id"]
 
-    tb = bd.Table(dataset_id=dataset_id, table_id=table_id)
+    tb = TablePlus(dataset_id=dataset_id, table_id=table_id)
     _file_path = file_path.split(table_id)[0] + table_id
     context.log.debug(_file_path)
     context.log.debug(table_id)
@@ -291,6 +413,7 @@ def create_table_bq(
         if_table_exists="replace",
         if_storage_data_exists="replace",
         if_table_config_exists=table_config,
+        source_format=Path(file_path).suffix[1:] or "csv",
     )
 
     tb.publish(if_exists=publish_config)
@@ -1,7 +1,7 @@
 from dagster import pipeline
 from dagster.core.definitions.mode import ModeDefinition
 
-from repositories.capturas.resources import discord_webhook, timezone_config
+from repositories.capturas.resources import discord_webhook, timezone_config, redis_client
 from repositories.helpers.hooks import (
     discord_message_on_failure,
     discord_message_on_success,
@@ -30,6 +30,7 @@ from repositories.queries.solids import (
             resource_defs={
                 "discord_webhook": discord_webhook,
                 "timezone_config": timezone_config,
+                "redis_client": redis_client,
             },
         ),
     ],
@@ -65,6 +66,7 @@ def update_managed_materialized_views():
             resource_defs={
                 "discord_webhook": discord_webhook,
                 "timezone_config": timezone_config,
+                "redis_client": redis_client,
             },
         ),
     ],
@@ -6,13 +6,12 @@ import datetime
 from pathlib import Path
 
 import pytz
-from redis import Redis
 from pottery import Redlock
-from redis_pal import RedisPal
 from google.cloud.storage.blob import Blob
 from dagster.core.definitions.run_request import PipelineRunReaction, SkipReason
 from dagster import RunRequest, sensor, SensorExecutionContext
 
+from repositories.helpers.clients import get_redis, get_redis_pal
 from repositories.helpers.helpers import read_config
 from repositories.helpers.constants import constants
 from repositories.helpers.datetime import determine_whether_to_execute_or_not, convert_datetime_to_unix_time
@@ -49,7 +48,7 @@ def materialized_views_update_sensor(context: SensorExecutionContext):
     modified_blobs = []
 
     # Get connection to Redis
-    rp = RedisPal(host=constants.REDIS_HOST.value)
+    rp = get_redis_pal()
 
     # Get list of blobs in bucket
     blobs_list = get_list_of_blobs(MATERIALIZED_VIEWS_PREFIX, SENSOR_BUCKET)
@@ -118,7 +117,7 @@ def materialized_views_update_sensor(context: SensorExecutionContext):
 def materialized_views_execute_sensor(context: SensorExecutionContext):
     """Sensor for executing materialized views based on cron expressions."""
     # Setup Redis and Redlock
-    r = Redis(constants.REDIS_HOST.value)
+    r = get_redis()
     lock = Redlock(key=constants.REDIS_KEY_MAT_VIEWS_MATERIALIZE_SENSOR_LOCK.value,
                    auto_release_time=constants.REDIS_LOCK_AUTO_RELEASE_TIME.value, masters=[r])
 
@@ -128,7 +127,7 @@ def materialized_views_execute_sensor(context: SensorExecutionContext):
         yield SkipReason("Another run is already in progress!")
         return
 
-    rp = RedisPal(constants.REDIS_HOST.value)
+    rp = get_redis_pal()
 
     # Get managed materialized views
     managed_materialized_views: dict = rp.get("managed_materialized_views")
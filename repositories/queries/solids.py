@@ -7,9 +7,7 @@ import pytz
 import yaml
 import jinja2
 import networkx as nx
-from redis import Redis
 from pottery import Redlock
-from redis_pal import RedisPal
 from dagster import solid, RetryPolicy
 from dagster.experimental import DynamicOutputDefinition, DynamicOutput
 
@@ -38,12 +36,12 @@ from repositories.queries.utils import (
 )
 
 
-@solid
+@solid(required_resource_keys={"redis_client"})
 def get_materialization_lock(context):
     """
     Get a lock for the materialization process.
     """
-    r = Redis(constants.REDIS_HOST.value)
+    r = context.resources.redis_client.redis
     lock = Redlock(
         key=constants.REDIS_KEY_MAT_VIEWS_MATERIALIZE_LOCK.value, masters=[
             r],
@@ -52,12 +50,12 @@ def get_materialization_lock(context):
     return lock
 
 
-@solid
+@solid(required_resource_keys={"redis_client"})
 def get_materialize_sensor_lock(context):
     """
     Get a lock for the materialization sensor.
     """
-    r = Redis(constants.REDIS_HOST.value)
+    r = context.resources.redis_client.redis
     lock = Redlock(
         key=constants.REDIS_KEY_MAT_VIEWS_MATERIALIZE_SENSOR_LOCK.value, masters=[
             r],
@@ -96,7 +94,10 @@ def release_materialization_process(context, lock, done: Any):
     return True
 
 
-@solid(retry_policy=RetryPolicy(max_retries=3, delay=5))
+@solid(
+    required_resource_keys={"redis_client"},
+    retry_policy=RetryPolicy(max_retries=3, delay=5),
+)
 def delete_managed_views(
     context,
     blob_names,
@@ -104,8 +105,8 @@ def delete_managed_views(
     materialization_lock: Redlock,
 ):
     try:
-        r = Redis(constants.REDIS_HOST.value)
-        rp = RedisPal(constants.REDIS_HOST.value)
+        r = context.resources.redis_client.redis
+        rp = context.resources.redis_client.pal
         lock = Redlock(
             key=constants.REDIS_KEY_MAT_VIEWS_MANAGED_VIEWS_LOCK.value, masters=[
                 r],
@@ -138,6 +139,7 @@ def delete_managed_views(
 
 
 @solid(
+    required_resource_keys={"redis_client"},
     retry_policy=RetryPolicy(max_retries=3, delay=5),
     output_defs=[DynamicOutputDefinition(dict)],
 )
@@ -149,8 +151,8 @@ def update_managed_views(
 ):
     try:
         # Setup Redis and Redlock
-        r = Redis(constants.REDIS_HOST.value)
-        rp = RedisPal(constants.REDIS_HOST.value)
+        r = context.resources.redis_client.redis
+        rp = context.resources.redis_client.pal
         views_lock = Redlock(
             key=constants.REDIS_KEY_MAT_VIEWS_MANAGED_VIEWS_LOCK.value, masters=[
                 r],
@@ -318,7 +320,10 @@ def update_managed_views(
         raise e
 
 
-@solid(retry_policy=RetryPolicy(max_retries=3, delay=30))
+@solid(
+    required_resource_keys={"redis_client"},
+    retry_policy=RetryPolicy(max_retries=3, delay=30),
+)
 def manage_view(context, input_dict):
 
     view_name = input_dict["view_name"]
@@ -326,8 +331,8 @@ def manage_view(context, input_dict):
 
     try:
         # Setup Redis and Redlock
-        r = Redis(constants.REDIS_HOST.value)
-        rp = RedisPal(constants.REDIS_HOST.value)
+        r = context.resources.redis_client.redis
+        rp = context.resources.redis_client.pal
         lock = Redlock(
             key=constants.REDIS_KEY_MAT_VIEWS_MANAGED_VIEWS_LOCK.value, masters=[
                 r],
@@ -565,6 +570,7 @@ def materialize(context, input_dict: dict):
 
 
 @solid(
+    required_resource_keys={"redis_client"},
     retry_policy=RetryPolicy(max_retries=3, delay=30),
     output_defs=[DynamicOutputDefinition(dict)]
 )
@@ -611,8 +617,8 @@ def get_configs_for_materialized_view(context, query_names: list, materializatio
             base_params["run_key"] = "'{}'".format(run_key)
 
             # Few more params
-            r = Redis(constants.REDIS_HOST.value)
-            rp = RedisPal(constants.REDIS_HOST.value)
+            r = context.resources.redis_client.redis
+            rp = context.resources.redis_client.pal
             lock = Redlock(
                 key=constants.REDIS_KEY_MAT_VIEWS_MANAGED_VIEWS_LOCK.value, masters=[
                     r],
@@ -718,6 +724,7 @@ def get_configs_for_materialized_view(context, query_names: list, materializatio
 
 
 @solid(
+    required_resource_keys={"redis_client"},
     retry_policy=RetryPolicy(max_retries=3, delay=5),
     output_defs=[DynamicOutputDefinition(str)]
 )
@@ -729,7 +736,7 @@ def resolve_dependencies_and_execute(context, queries_names, materialization_loc
 
         # Get dependencies
         dependencies = {}
-        rp = RedisPal(constants.REDIS_HOST.value)
+        rp = context.resources.redis_client.pal
         materialized_views: dict = rp.get(
             constants.REDIS_KEY_MAT_VIEWS_MANAGED_VIEWS.value)
         if materialized_views:
@@ -0,0 +1,91 @@
+"""
+This script compares the per-row cost of the previous GPS timestamp
+treatment (pendulum + .apply) with the vectorized one in
+`repositories.helpers.gps`, using synthetic SPPO-like data.
+
+Usage:
+    python scripts/benchmark_gps_normalization.py [n_rows]
+"""
+import sys
+import time
+from pathlib import Path
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+import pendulum
+
+sys.path.append(str(Path(__file__).parent.parent))
+from repositories.helpers.gps import normalize_gps  # noqa: E402
+
+TIMEZONE = "America/Sao_Paulo"
+
+
+def legacy_treatment(df, timestamp):
+    df["timestamp_captura"] = pd.to_datetime(timestamp)
+    df["datahora"] = (
+        df["datahora"]
+        .astype(float)
+        .apply(
+            lambda ms: pd.to_datetime(
+                pendulum.from_timestamp(ms / 1000.0)
+                .replace(tzinfo=None)
+                .set(tz="UTC")
+                .isoformat()
+            )
+        )
+    )
+    df["datahora"] = df["datahora"].apply(lambda x: x.tz_convert(TIMEZONE))
+    df["timestamp_captura"] = df["timestamp_captura"].apply(
+        lambda x: x.tz_convert(TIMEZONE)
+    )
+    mask = (df["timestamp_captura"] - df["datahora"]).apply(
+        lambda x: timedelta(seconds=0) <= x <= timedelta(minutes=1)
+    )
+    return df[mask]
+
+
+def vectorized_treatment(df, timestamp):
+    return normalize_gps(df, "datahora", timestamp, TIMEZONE, unit="ms")
+
+
+def generate_data(n_rows, timestamp):
+    capture_ms = pendulum.parse(timestamp).int_timestamp * 1000
+    rng = np.random.default_rng(0)
+    return pd.DataFrame(
+        {
+            "ordem": [f"A{i:05}" for i in range(n_rows)],
+            "latitude": rng.uniform(-23.0, -22.8, n_rows).astype(str),
+            "longitude": rng.uniform(-43.6, -43.1, n_rows).astype(str),
+            # Lags between -30s and 3min, so part of the rows is filtered out
+            "datahora": (capture_ms - rng.integers(-30_000, 180_000, n_rows)).astype(str),
+            "velocidade": rng.integers(0, 80, n_rows).astype(str),
+            "linha": rng.integers(100, 999, n_rows).astype(str),
+        }
+    )
+
+
+def benchmark(treatment, df, timestamp, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = treatment(df.copy(), timestamp)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+if __name__ == "__main__":
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    timestamp = pendulum.now(TIMEZONE).isoformat()
+    df = generate_data(n_rows, timestamp)
+
+    legacy_time, legacy = benchmark(legacy_treatment, df, timestamp)
+    vectorized_time, vectorized = benchmark(vectorized_treatment, df, timestamp)
+
+    assert legacy.index.equals(vectorized.index), "Filtered rows differ"
+    assert (legacy["datahora"] == vectorized["datahora"]).all(), "Timestamps differ"
+
+    print(f"Rows: {n_rows}, kept after filtering: {vectorized.shape[0]}")
+    print(f"legacy:     {legacy_time:.4f}s ({legacy_time / n_rows * 1e6:.2f} us/row)")
+    print(f"vectorized: {vectorized_time:.4f}s ({vectorized_time / n_rows * 1e6:.2f} us/row)")
+    print(f"speedup:    {legacy_time / vectorized_time:.1f}x")